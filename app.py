@@ -7,20 +7,39 @@ VERSÃO CORRIGIDA - JSON Parsing Robusto
 """
 
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import warnings
 import logging
 import os
 import json
 import re
+import math
+import heapq
+import hashlib
+import html
+import sqlite3
+import pickle
+import queue
+import threading
+import time
+import unicodedata
 import urllib.parse
+import uuid
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import BrokenExecutor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import wait as futures_wait
 from datetime import datetime
-from typing import Optional, Dict, Any, List
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, Tuple, Iterator, Callable, Mapping, NamedTuple
 from io import BytesIO
 import base64
+import codecs
+import csv
 from pathlib import Path
 
 # ✅ IMPORTS DE IA
 import anthropic
+import openai
 from openai import OpenAI
 
 warnings.filterwarnings("ignore")
@@ -247,7 +266,86 @@ span[data-testid="stIconMaterial"] { display: none !important; }
 </style>
 """
 
-st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+
+# ✅ ASSETS ESTÁTICOS: avatar redimensionado e CSS preparados uma vez por processo
+AVATAR_DISPLAY_PX = 130
+AVATAR_SCALE = 2                  # 2x para telas de alta densidade (celulares)
+AVATAR_JPEG_QUALITY = 85
+AVATAR_FALLBACK_URL = "https://ui-avatars.com/api/?name=Marco+Duarte&background=667eea&color=fff&size=200&font-size=0.35"
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STATIC_URL = "app/static"         # rota do server.enableStaticServing
+
+
+class StaticAssets:
+    """Avatar e CSS publicados em static/ com o hash do conteúdo no nome.
+
+    Com o static serving ligado, cada rerun envia só um <link>/<img> apontando para arquivos
+    que o navegador guarda em cache; sem ele, os blobs inline continuam, mas já prontos em memória.
+    """
+
+    @staticmethod
+    def _avatar_bytes(path: str) -> Tuple[bytes, str]:
+        """Avatar recortado em quadrado no tamanho exibido (JPEG); sem Pillow, o arquivo original"""
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            with open(path, "rb") as f:
+                return f.read(), "jpeg"
+        lado = AVATAR_DISPLAY_PX * AVATAR_SCALE
+        with Image.open(path) as img:
+            img = ImageOps.fit(ImageOps.exif_transpose(img).convert("RGB"), (lado, lado), Image.LANCZOS)
+        buffer = BytesIO()
+        img.save(buffer, "JPEG", quality=AVATAR_JPEG_QUALITY, optimize=True, progressive=True)
+        return buffer.getvalue(), "jpeg"
+
+    @staticmethod
+    def _serves(extensao: str) -> bool:
+        if not st.get_option("server.enableStaticServing"):
+            return False
+        try:
+            # Servidor antigo (Tornado): extensões fora da lista saem como text/plain
+            from streamlit.web.server.app_static_file_handler import SAFE_APP_STATIC_FILE_EXTENSIONS
+        except ImportError:
+            return True
+        return f".{extensao}" in SAFE_APP_STATIC_FILE_EXTENSIONS
+
+    @staticmethod
+    def _publish(nome: str, extensao: str, conteudo: bytes) -> Optional[str]:
+        """URL do arquivo em static/ (nome.<hash>.ext) ou None se não der para servir"""
+        if not StaticAssets._serves(extensao):
+            return None
+        arquivo = f"{nome}.{hashlib.sha256(conteudo).hexdigest()[:12]}.{extensao}"
+        destino = os.path.join(STATIC_DIR, arquivo)
+        try:
+            if not os.path.exists(destino):
+                os.makedirs(STATIC_DIR, exist_ok=True)
+                temporario = f"{destino}.{os.getpid()}.tmp"
+                with open(temporario, "wb") as f:
+                    f.write(conteudo)
+                os.replace(temporario, destino)
+        except OSError:
+            return None
+        return f"{STATIC_URL}/{arquivo}"
+
+    @staticmethod
+    @st.cache_resource(show_spinner=False)
+    def build() -> Dict[str, str]:
+        avatar_src = AVATAR_FALLBACK_URL
+        if os.path.exists(AVATAR_PATH):
+            try:
+                conteudo, formato = StaticAssets._avatar_bytes(AVATAR_PATH)
+                avatar_src = (StaticAssets._publish("avatar", "jpg", conteudo)
+                              or f"data:image/{formato};base64,{base64.b64encode(conteudo).decode()}")
+            except Exception:
+                avatar_base64 = get_image_base64(AVATAR_PATH)
+                avatar_src = f"data:image/jpeg;base64,{avatar_base64}" if avatar_base64 else AVATAR_FALLBACK_URL
+        css = CUSTOM_CSS.strip().removeprefix("<style>").removesuffix("</style>").strip()
+        css_url = StaticAssets._publish("finmentor", "css", css.encode())
+        css_html = f'<link rel="stylesheet" href="{css_url}">' if css_url else CUSTOM_CSS
+        return {'avatar_src': avatar_src, 'css_html': css_html}
+
+
+st.markdown(StaticAssets.build()['css_html'], unsafe_allow_html=True)
 
 def init_session_state():
     defaults = {
@@ -256,6 +354,9 @@ def init_session_state():
         'kb_content': '', 'processing': False, 'error_message': None,
         'chat_messages': [],
         'chat_context': '',
+        'chat_cancel': None,
+        'job_id': None,
+        'sessao_id': uuid.uuid4().hex,
         'anthropic_key': '',
         'openai_key': ''
     }
@@ -265,452 +366,3320 @@ def init_session_state():
 
 init_session_state()
 
+# ✅ DADOS DE MERCADO: fontes concorrentes + stale-while-revalidate
+MARKET_TIMEOUT = 5
+# SELIC e IPCA mudam no máximo uma vez por mês; câmbio e bolsa, ao longo do dia
+MARKET_TTLS = {'dolar': 300, 'ibov': 300, 'selic': 6 * 3600, 'ipca': 6 * 3600}
+MARKET_RETRY_SECONDS = 60
+MARKET_REFRESH_SECONDS = 60
+BCB_SGS_URL = "https://api.bcb.gov.br/dados/serie/bcdata.sgs.{serie}/dados/ultimos/1?formato=json"
+
+
+def _yahoo_last_close(symbol: str) -> float:
+    import yfinance as yf
+    hist = yf.Ticker(symbol).history(period='1d', timeout=MARKET_TIMEOUT)
+    if hist.empty:
+        raise ValueError(f"Sem cotação para {symbol}")
+    return float(hist['Close'].iloc[-1])
+
+
+def _bcb_last_value(session, serie: int) -> float:
+    response = session.get(BCB_SGS_URL.format(serie=serie), timeout=MARKET_TIMEOUT)
+    response.raise_for_status()
+    payload = response.json()
+    if not payload:
+        raise ValueError(f"Série SGS {serie} vazia")
+    return float(payload[0]['valor'])
+
+
+# Nome -> provedor(session); o yfinance gerencia a própria sessão HTTP
+DEFAULT_MARKET_PROVIDERS: Dict[str, Callable[[Any], Any]] = {
+    'dolar': lambda session: round(_yahoo_last_close('USDBRL=X'), 2),
+    'ibov': lambda session: f"{int(_yahoo_last_close('^BVSP')):,}".replace(',', '.'),
+    'selic': lambda session: f"{_bcb_last_value(session, 432):.2f}%",
+    'ipca': lambda session: f"{_bcb_last_value(session, 433):.2f}%",
+}
+
+
 class MarketDataFetcher:
+    """Busca as fontes de mercado em paralelo, com TTL por fonte e stale-while-revalidate.
+
+    Valores vencidos continuam sendo servidos enquanto a atualização roda em background;
+    só a primeira leitura de uma fonte (sem valor algum) espera pela rede.
+    Os provedores são injetáveis para permitir testes offline.
+    """
+
+    def __init__(self, providers: Optional[Dict[str, Callable[[Any], Any]]] = None,
+                 ttls: Optional[Dict[str, float]] = None, session=None,
+                 timeout: float = MARKET_TIMEOUT, clock: Callable[[], float] = time.time,
+                 on_update: Optional[Callable[[], None]] = None):
+        self.providers = providers or DEFAULT_MARKET_PROVIDERS
+        self.ttls = {**MARKET_TTLS, **(ttls or {})}
+        self.timeout = timeout
+        self.clock = clock
+        self.on_update = on_update
+        if session is None:
+            import requests
+            session = requests.Session()
+        self.session = session
+        self._entries: Dict[str, Tuple[Any, float]] = {}
+        self._attempts: Dict[str, float] = {}
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=len(self.providers), thread_name_prefix="market")
+
+    def _revalidate(self, name: str) -> Future:
+        with self._lock:
+            future = self._inflight.get(name)
+            if future is None:
+                future = self._pool.submit(self._fetch, name)
+                self._inflight[name] = future
+            return future
+
+    def _fetch(self, name: str) -> None:
+        self._attempts[name] = self.clock()
+        try:
+            value = self.providers[name](self.session)
+            with self._lock:
+                self._entries[name] = (value, self.clock())
+            if self.on_update:
+                self.on_update()
+        except Exception as e:
+            # Mantém o último valor bom; a próxima leitura tenta de novo
+            print(f"Falha ao atualizar {name}: {e}")
+        finally:
+            with self._lock:
+                self._inflight.pop(name, None)
+
+    def get_market_data(self) -> Dict[str, Any]:
+        now = self.clock()
+        cold = []
+        for name in self.providers:
+            entry = self._entries.get(name)
+            if entry is None and name not in self._attempts:
+                cold.append(self._revalidate(name))
+            elif entry is None:
+                # Fonte fora do ar: tenta de novo em background, sem travar a leitura
+                if now - self._attempts[name] > MARKET_RETRY_SECONDS:
+                    self._revalidate(name)
+            elif now - entry[1] > self.ttls.get(name, 300):
+                self._revalidate(name)
+        if cold:
+            futures_wait(cold, timeout=self.timeout + 1)
+        return self.snapshot()
+
+    def snapshot(self) -> Dict[str, Any]:
+        entries = dict(self._entries)
+        data: Dict[str, Any] = {name: entries[name][0] if name in entries else 'N/D' for name in self.providers}
+        fetched = [fetched_at for _, fetched_at in entries.values()]
+        moment = datetime.fromtimestamp(max(fetched)) if fetched else datetime.now()
+        data['timestamp'] = moment.strftime('%d/%m/%Y %H:%M')
+        return data
+
+
+class MarketSnapshot(NamedTuple):
+    """Foto imutável dos indicadores; substituída por inteiro a cada atualização"""
+    data: Mapping[str, Any]
+    updated_at: float
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(self.data)
+
+
+class MarketDataService:
+    """Dono único (por processo) da foto de mercado, atualizada por uma thread agendada.
+
+    A leitura é só uma troca de referência: as páginas nunca esperam pela rede.
+    """
+
+    def __init__(self, fetcher: Optional[MarketDataFetcher] = None, interval: float = MARKET_REFRESH_SECONDS):
+        self.fetcher = fetcher or MarketDataFetcher()
+        self.fetcher.on_update = self._publish
+        self.interval = interval
+        self._snapshot = MarketSnapshot(MappingProxyType(self.fetcher.snapshot()), 0.0)
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, name="market-refresh", daemon=True).start()
+
+    @staticmethod
+    @st.cache_resource(show_spinner=False)
+    def shared() -> "MarketDataService":
+        return MarketDataService()
+
+    def _publish(self) -> None:
+        self._snapshot = MarketSnapshot(MappingProxyType(self.fetcher.snapshot()), time.time())
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.fetcher.get_market_data()
+                self._publish()
+            except Exception as e:
+                print(f"Falha na atualização de mercado: {e}")
+            self._stop.wait(self.interval)
+
+    def latest(self) -> MarketSnapshot:
+        return self._snapshot
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+# ✅ RAG: trechos por seção + índice BM25
+KB_FOLDERS = ("materiais_publicos", "materiais_download")
+KB_TOP_K = 8
+KB_TOKEN_BUDGET = 6000
+KB_CHUNK_MAX_CHARS = 2400
+KB_INDEX_PATH = ".kb_index.sqlite"
+KB_RESYNC_SECONDS = 3600
+KB_WAIT_SECONDS = 15
+KB_XLSX_MAX_ROWS = 400
+KB_XLSX_MAX_CELLS = 12
+
+_STOPWORDS_PT = frozenset("""
+a o e de da do das dos em no na nos nas um uma uns umas para por com sem que se ao aos as os
+ou como mais menos sua seu suas seus ser sao foi pelo pela pelos pelas entre sobre quando onde
+qual quais este esta estes estas isso esse essa esses essas meu minha nao sim ja tem ter muito
+devo preciso quero posso
+""".split())
+
+
+def _extract_text(filepath: str) -> Iterator[str]:
+    with open(filepath, 'r', encoding='utf-8', errors='replace') as f:
+        yield f.read()
+
+
+def _extract_pdf(filepath: str) -> Iterator[str]:
+    # Página a página: o pypdf só decodifica o conteúdo da página quando ela é acessada
+    from pypdf import PdfReader
+    reader = PdfReader(filepath)
+    for numero, page in enumerate(reader.pages, start=1):
+        texto = page.extract_text() or ''
+        if texto.strip():
+            yield f"## Página {numero}\n{texto}"
+
+
+def _extract_docx(filepath: str) -> Iterator[str]:
+    import docx
+    document = docx.Document(filepath)
+    linhas: List[str] = []
+    for paragraph in document.paragraphs:
+        texto = paragraph.text.strip()
+        if not texto:
+            continue
+        estilo = (paragraph.style.name or '').lower() if paragraph.style is not None else ''
+        if estilo.startswith(('heading 1', 'título 1', 'title')):
+            linhas.append(f"## {texto}")
+        elif estilo.startswith(('heading', 'título')):
+            linhas.append(f"### {texto}")
+        else:
+            linhas.append(texto)
+    for table in document.tables:
+        linhas.append("## Tabela")
+        for row in table.rows:
+            linhas.append(" | ".join(cell.text.strip() for cell in row.cells))
+    yield "\n".join(linhas)
+
+
+def _extract_xlsx(filepath: str) -> Iterator[str]:
+    import openpyxl
+    workbook = openpyxl.load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            linhas = [f"## Aba: {sheet.title}"]
+            for row in sheet.iter_rows(values_only=True):
+                celulas = [
+                    f"{v:,.2f}" if isinstance(v, float) else str(v)
+                    for v in row if v is not None and str(v).strip()
+                ]
+                if celulas:
+                    linhas.append(" | ".join(celulas[:KB_XLSX_MAX_CELLS]))
+                if len(linhas) > KB_XLSX_MAX_ROWS:
+                    break
+            yield "\n".join(linhas)
+    finally:
+        workbook.close()
+
+
+# Extensão -> extrator (arquivos sem extensão são tratados como texto)
+KB_EXTRACTORS: Dict[str, Callable[[str], Iterator[str]]] = {
+    '': _extract_text,
+    '.txt': _extract_text,
+    '.md': _extract_text,
+    '.pdf': _extract_pdf,
+    '.docx': _extract_docx,
+    '.xlsx': _extract_xlsx,
+}
+
+
+def _ingest_file(filepath: str) -> Tuple[List[Dict[str, str]], List[str]]:
+    """Extrai, divide e tokeniza um arquivo (executado no pool de processos)"""
+    extractor = KB_EXTRACTORS[os.path.splitext(filepath)[1].lower()]
+    modulo = os.path.basename(filepath)
+    chunks: List[Dict[str, str]] = []
+    for bloco in extractor(filepath):
+        chunks.extend(KnowledgeBaseLoader.split_sections(modulo, bloco))
+    termos = [
+        json.dumps(Counter(_tokenize(f"{c['secao']} {c['texto']}")), separators=(',', ':'))
+        for c in chunks
+    ]
+    return chunks, termos
+
+
+class KnowledgeBaseLoader:
+    @staticmethod
+    def split_sections(modulo: str, content: str) -> List[Dict[str, str]]:
+        """Divide um módulo em trechos por seção (cabeçalhos ## e ###)"""
+        titulo = modulo
+        h2, h3 = '', ''
+        buffer: List[str] = []
+        chunks: List[Dict[str, str]] = []
+
+        def flush():
+            texto = "\n".join(buffer).strip()
+            buffer.clear()
+            if not texto:
+                return
+            secao = " > ".join(p for p in (titulo, h2, h3) if p)
+            # Seções muito longas são quebradas por parágrafo
+            partes, atual = [], ''
+            for paragrafo in re.split(r'\n\s*\n', texto):
+                if atual and len(atual) + len(paragrafo) > KB_CHUNK_MAX_CHARS:
+                    partes.append(atual)
+                    atual = ''
+                atual = f"{atual}\n\n{paragrafo}" if atual else paragrafo
+            if atual:
+                partes.append(atual)
+            for parte in partes:
+                chunks.append({'modulo': modulo, 'secao': secao, 'texto': parte[:KB_CHUNK_MAX_CHARS * 2]})
+
+        for line in content.splitlines():
+            if line.startswith('### '):
+                flush()
+                h3 = line[4:].strip()
+            elif line.startswith('## '):
+                flush()
+                h2, h3 = line[3:].strip(), ''
+            elif line.startswith('# ') and not h2:
+                # Cabeçalho do módulo: a linha "MÓDULO" (ou a primeira) vira o título
+                cabecalho = line[2:].strip()
+                if cabecalho.strip('=#') and (titulo == modulo or 'MÓDULO' in cabecalho.upper()):
+                    titulo = cabecalho
+            elif line.strip() and not line.strip('=-'):
+                # Linhas separadoras só consomem tokens
+                continue
+            else:
+                buffer.append(line)
+        flush()
+        return chunks
+
+    @staticmethod
+    def list_files(folders: Tuple[str, ...] = KB_FOLDERS) -> List[str]:
+        files = []
+        for folder in folders:
+            if not os.path.exists(folder):
+                continue
+            files.extend(
+                os.path.join(folder, filename) for filename in sorted(os.listdir(folder))
+                if not filename.startswith('.') and os.path.splitext(filename)[1].lower() in KB_EXTRACTORS
+            )
+        return files
+
+    @staticmethod
+    def extract_many(filepaths: List[str]) -> Dict[str, Tuple[List[Dict[str, str]], List[str]]]:
+        """Extrai arquivos em paralelo; PDFs grandes são CPU-bound, por isso um pool de processos"""
+        results: Dict[str, Tuple[List[Dict[str, str]], List[str]]] = {}
+        if not filepaths:
+            return results
+
+        def collect(executor) -> None:
+            futures = {executor.submit(_ingest_file, path): path for path in filepaths}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    results[path] = future.result()
+                except (BrokenExecutor, pickle.PicklingError, AttributeError):
+                    raise
+                except Exception as e:
+                    print(f"Erro ao ler {path}: {e}")
+
+        workers = min(len(filepaths), os.cpu_count() or 1)
+        if workers > 1:
+            try:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    collect(pool)
+                return results
+            except (BrokenExecutor, pickle.PicklingError, AttributeError, OSError) as e:
+                # Sem fork (ou script não importável pelo worker): cai para threads
+                print(f"Pool de processos indisponível ({e}), usando threads")
+                results.clear()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            collect(pool)
+        return results
+
+    @staticmethod
+    @st.cache_resource(show_spinner=False)
+    def get_service(folders: Tuple[str, ...] = KB_FOLDERS) -> "KnowledgeBaseService":
+        """Um serviço por processo; a indexação roda fora da thread do script"""
+        return KnowledgeBaseService(folders)
+
+    @staticmethod
+    def get_index() -> "KnowledgeIndex":
+        return KnowledgeBaseLoader.get_service().index(wait=KB_WAIT_SECONDS)
+
+    @staticmethod
+    def retrieve(contexto: str, top_k: int = KB_TOP_K, token_budget: int = KB_TOKEN_BUDGET) -> str:
+        """Retorna apenas os trechos relevantes ao desafio, dentro do orçamento de tokens"""
+        return KnowledgeBaseLoader.get_index().build_context(contexto, top_k, token_budget)
+
+
+def _tokenize(text: str) -> List[str]:
+    """Minúsculas, sem acentos, sem stopwords e com plural simples removido"""
+    normalized = unicodedata.normalize('NFKD', text.lower()).encode('ascii', 'ignore').decode()
+    tokens = []
+    for token in re.findall(r'[a-z0-9]+', normalized):
+        if len(token) < 2 or token in _STOPWORDS_PT:
+            continue
+        if len(token) > 4 and token.endswith('s'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def _estimate_tokens(text: str) -> int:
+    # Aproximação para português (~3.5 caracteres por token)
+    return int(len(text) / 3.5) + 1
+
+
+class KnowledgeIndex:
+    """Índice invertido BM25 em memória sobre os trechos da base de conhecimento"""
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, chunks: List[Dict[str, str]], term_freqs: Optional[List[Dict[str, int]]] = None):
+        self.chunks = chunks
+        if term_freqs is None:
+            term_freqs = [Counter(_tokenize(f"{c['secao']} {c['texto']}")) for c in chunks]
+        self.doc_len = [sum(tf.values()) for tf in term_freqs]
+        self.avgdl = (sum(self.doc_len) / len(self.doc_len)) if self.doc_len else 0.0
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for doc_id, tf in enumerate(term_freqs):
+            for term, freq in tf.items():
+                self.postings[term].append((doc_id, freq))
+        n = len(chunks)
+        self.idf = {
+            term: math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            for term, plist in self.postings.items()
+        }
+
+    def search(self, query: str, top_k: int = KB_TOP_K) -> List[Tuple[float, int]]:
+        scores: Dict[int, float] = defaultdict(float)
+        k1, b, avgdl = self.K1, self.B, self.avgdl or 1.0
+        for term in set(_tokenize(query)):
+            plist = self.postings.get(term)
+            if not plist:
+                continue
+            idf = self.idf[term]
+            for doc_id, freq in plist:
+                norm = k1 * (1 - b + b * self.doc_len[doc_id] / avgdl)
+                scores[doc_id] += idf * freq * (k1 + 1) / (freq + norm)
+        return heapq.nlargest(top_k, ((score, doc_id) for doc_id, score in scores.items()))
+
+    def build_context(self, query: str, top_k: int = KB_TOP_K, token_budget: int = KB_TOKEN_BUDGET) -> str:
+        parts: List[str] = []
+        used = 0
+        for _, doc_id in self.search(query, top_k):
+            chunk = self.chunks[doc_id]
+            bloco = f"[{chunk['secao']}]\n{chunk['texto']}"
+            custo = _estimate_tokens(bloco)
+            if used + custo > token_budget:
+                continue
+            parts.append(bloco)
+            used += custo
+        return "\n\n---\n\n".join(parts)
+
+
+class KnowledgeIndexStore:
+    """Índice persistido em SQLite: texto dos trechos, frequência de termos e hash por arquivo.
+
+    Na sincronização só os arquivos com mtime/tamanho alterados têm o hash recalculado,
+    e só os de conteúdo realmente novo são re-tokenizados.
+    """
+
+    # Incrementar ao mudar o chunking ou o tokenizador (invalida o arquivo inteiro)
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path: str = KB_INDEX_PATH):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        if conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            conn.executescript("""
+                DROP TABLE IF EXISTS files;
+                DROP TABLE IF EXISTS chunks;
+            """)
+            conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL, sha256 TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                path TEXT NOT NULL, ord INTEGER NOT NULL, modulo TEXT NOT NULL, secao TEXT NOT NULL,
+                texto TEXT NOT NULL, termos TEXT NOT NULL, PRIMARY KEY (path, ord)
+            );
+        """)
+        return conn
+
     @staticmethod
-    @st.cache_data(ttl=300)
-    def get_market_data() -> Dict[str, Any]:
-        import yfinance as yf
-        import requests
-        data = {'dolar': None, 'ibov': None, 'selic': None, 'ipca': None, 'timestamp': datetime.now().strftime('%d/%m/%Y %H:%M')}
+    def _sha256(filepath: str) -> str:
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def sync(self, folders: Tuple[str, ...] = KB_FOLDERS) -> KnowledgeIndex:
+        conn = self._connect()
         try:
-            ticker_usd = yf.Ticker('USDBRL=X')
-            hist = ticker_usd.history(period='1d')
-            if not hist.empty: data['dolar'] = round(hist['Close'].iloc[-1], 2)
-        except: data['dolar'] = 'N/D'
+            stored = {
+                row[0]: row[1:] for row in conn.execute("SELECT path, mtime, size, sha256 FROM files")
+                if os.path.dirname(row[0]) in folders
+            }
+            present, touched, changed = set(), [], {}
+            for filepath in KnowledgeBaseLoader.list_files(folders):
+                present.add(filepath)
+                stat = os.stat(filepath)
+                previous = stored.get(filepath)
+                if previous and previous[0] == stat.st_mtime and previous[1] == stat.st_size:
+                    continue
+                sha = self._sha256(filepath)
+                if previous and previous[2] == sha:
+                    touched.append((stat.st_mtime, stat.st_size, filepath))
+                else:
+                    changed[filepath] = (stat.st_mtime, stat.st_size, sha)
+
+            # A extração (lenta) acontece fora da transação de escrita
+            extracted = KnowledgeBaseLoader.extract_many(list(changed))
+
+            with conn:
+                conn.executemany("UPDATE files SET mtime = ?, size = ? WHERE path = ?", touched)
+                for filepath, (chunks, termos) in extracted.items():
+                    conn.execute("DELETE FROM chunks WHERE path = ?", (filepath,))
+                    conn.executemany(
+                        "INSERT INTO chunks (path, ord, modulo, secao, texto, termos) VALUES (?, ?, ?, ?, ?, ?)",
+                        [
+                            (filepath, ordem, c['modulo'], c['secao'], c['texto'], termos[ordem])
+                            for ordem, c in enumerate(chunks)
+                        ]
+                    )
+                    conn.execute("INSERT OR REPLACE INTO files (path, mtime, size, sha256) VALUES (?, ?, ?, ?)",
+                                 (filepath, *changed[filepath]))
+                for removed in set(stored) - present:
+                    conn.execute("DELETE FROM chunks WHERE path = ?", (removed,))
+                    conn.execute("DELETE FROM files WHERE path = ?", (removed,))
+            return self.load(conn, folders)
+        finally:
+            conn.close()
+
+    def load(self, conn: Optional[sqlite3.Connection] = None,
+             folders: Tuple[str, ...] = KB_FOLDERS) -> KnowledgeIndex:
+        """Carrega o índice persistido sem tocar nos arquivos de origem"""
+        own = conn is None
+        conn = conn or self._connect()
+        try:
+            chunks, term_freqs = [], []
+            rows = conn.execute("SELECT path, modulo, secao, texto, termos FROM chunks ORDER BY path, ord")
+            for path, modulo, secao, texto, termos in rows:
+                if os.path.dirname(path) not in folders:
+                    continue
+                chunks.append({'modulo': modulo, 'secao': secao, 'texto': texto})
+                term_freqs.append(json.loads(termos))
+            return KnowledgeIndex(chunks, term_freqs)
+        finally:
+            if own:
+                conn.close()
+
+
+class KnowledgeBaseService:
+    """Mantém o índice atual do processo e o re-sincroniza em background.
+
+    Leitores nunca esperam pela extração de PDFs: recebem o último índice publicado
+    (o persistido, carregado em milissegundos) enquanto a sincronização roda numa thread.
+    """
+
+    def __init__(self, folders: Tuple[str, ...] = KB_FOLDERS):
+        self.folders = folders
+        self.store = KnowledgeIndexStore(KB_INDEX_PATH)
+        self._index = KnowledgeIndex([])
+        self._ready = threading.Event()
+        self._syncing = threading.Lock()
+        self._last_sync = 0.0
+        self.refresh()
+
+    def refresh(self) -> None:
+        if self._syncing.locked():
+            return
+        threading.Thread(target=self._sync, name="kb-sync", daemon=True).start()
+
+    def _sync(self) -> None:
+        if not self._syncing.acquire(blocking=False):
+            return
         try:
-            ticker_ibov = yf.Ticker('^BVSP')
-            hist = ticker_ibov.history(period='1d')
-            if not hist.empty: data['ibov'] = f"{int(hist['Close'].iloc[-1]):,}".replace(',', '.')
-        except: data['ibov'] = 'N/D'
+            self._last_sync = time.time()
+            try:
+                if not self._index.chunks:
+                    persisted = self.store.load(folders=self.folders)
+                    if persisted.chunks:
+                        self._index = persisted
+                        self._ready.set()
+                self._index = self.store.sync(self.folders)
+            except sqlite3.Error as e:
+                print(f"Índice persistido indisponível ({e}), reconstruindo em memória")
+                extracted = KnowledgeBaseLoader.extract_many(KnowledgeBaseLoader.list_files(self.folders))
+                chunks = [c for path in sorted(extracted) for c in extracted[path][0]]
+                self._index = KnowledgeIndex(chunks)
+        finally:
+            self._ready.set()
+            self._syncing.release()
+
+    def index(self, wait: float = 0) -> KnowledgeIndex:
+        if time.time() - self._last_sync > KB_RESYNC_SECONDS:
+            self.refresh()
+        # Só o primeiro uso (sem índice persistido) pode precisar esperar
+        self._ready.wait(wait)
+        return self._index
+
+
+# ✅ STREAMING: parser JSON incremental
+STRATEGY_STREAMING = True
+
+class IncrementalJSONParser:
+    """Lê o JSON da estratégia em pedaços e emite cada campo de primeiro nível assim que ele fecha.
+
+    Uma única varredura linear: cada caractere recebido é examinado uma vez, com controle de
+    string/escape/profundidade. Texto antes do primeiro "{" (ex.: cercas markdown) é ignorado.
+    """
+
+    def __init__(self):
+        self.fields: Dict[str, Any] = {}
+        self._text = ''
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._state = 'inicio'  # inicio -> chave -> dois_pontos -> valor -> apos_valor -> fim
+        self._start = -1
+        self._key: Optional[str] = None
+
+    def _emit(self, end: int, out: List[Tuple[str, Any]]) -> None:
         try:
-            response = requests.get('https://api.bcb.gov.br/dados/serie/bcdata.sgs.432/dados/ultimos/1?formato=json', timeout=5)
-            if response.status_code == 200:
-                selic_data = response.json()
-                if selic_data: data['selic'] = f"{float(selic_data[0]['valor']):.2f}%"
-        except: data['selic'] = 'N/D'
+            # strict=False aceita quebras de linha cruas dentro das strings
+            value = json.loads(self._text[self._start:end].strip(), strict=False)
+        except json.JSONDecodeError:
+            value = None
+        # null ou valor ilegível também sai: quem consome aplica o padrão do schema
+        if self._key is not None:
+            self.fields[self._key] = value
+            out.append((self._key, value))
+        self._state, self._start = 'apos_valor', -1
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        out: List[Tuple[str, Any]] = []
+        self._text += chunk
+        text = self._text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._state == 'chave':
+                        try:
+                            self._key = json.loads(text[self._start:i + 1], strict=False)
+                        except json.JSONDecodeError:
+                            self._key = None
+                        self._state = 'dois_pontos'
+                    elif self._depth == 1 and self._state == 'valor':
+                        self._emit(i + 1, out)
+                continue
+
+            if self._state == 'inicio':
+                if ch == '{':
+                    self._depth, self._state = 1, 'chave'
+                continue
+            if self._state == 'fim':
+                break
+
+            if ch == '"':
+                self._in_string = True
+                if self._depth == 1 and self._state in ('chave', 'valor') and self._start < 0:
+                    self._start = i
+            elif ch in '{[':
+                if self._depth == 1 and self._state == 'valor' and self._start < 0:
+                    self._start = i
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 1 and self._state == 'valor':
+                    self._emit(i + 1, out)
+                elif self._depth == 0:
+                    if self._state == 'valor' and self._start >= 0:
+                        self._emit(i, out)
+                    self._state = 'fim'
+            elif self._depth == 1:
+                if ch == ':' and self._state == 'dois_pontos':
+                    self._state, self._start = 'valor', -1
+                elif ch == ',':
+                    if self._state == 'valor' and self._start >= 0:
+                        self._emit(i, out)
+                    self._state, self._start = 'chave', -1
+                elif not ch.isspace() and self._state == 'valor' and self._start < 0:
+                    # Início de número, true/false/null
+                    self._start = i
+        self._pos = len(text)
+        return out
+
+
+# ✅ REPARO DE JSON: varredura única e linear sobre a saída do modelo
+class JSONRepair:
+    """Parser tolerante para o JSON devolvido pelo modelo.
+
+    Tenta primeiro o `json.loads` nativo; se falhar, faz uma única varredura linear com máquina de
+    estados (string/escape/pilha de delimitadores) que corrige quebras de linha e caracteres de
+    controle dentro de strings, escapes inválidos, vírgulas finais e fecha strings, chaves e
+    colchetes abertos quando a resposta foi cortada por max_tokens. Devolve os reparos aplicados.
+    """
+
+    _TOKEN = re.compile(r'\s*(?:([{}\[\],:"])|([^\s{}\[\],:"]+))')
+    _IN_STRING = re.compile(r'["\\\x00-\x1f]')
+    _VALID_ESCAPES = frozenset('"\\/bfnrtu')
+    _CONTROL = {'\n': '\\n', '\r': '\\r', '\t': '\\t'}
+
+    @classmethod
+    def parse(cls, text: str) -> Tuple[Dict[str, Any], List[str]]:
+        start = text.find('{')
+        if start == -1:
+            raise ValueError("Não foi possível encontrar JSON válido na resposta")
+        reparos: List[str] = []
+        if text[:start].strip():
+            reparos.append("texto antes do JSON removido")
+
+        # Caminhos rápidos (parser em C): JSON válido e, depois, JSON com controles crus em strings
+        end = text.rfind('}')
+        if end > start:
+            candidate = text[start:end + 1]
+            for strict in (True, False):
+                try:
+                    data = json.loads(candidate, strict=strict)
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(data, dict):
+                    if not strict:
+                        reparos.append("caractere de controle em string")
+                    if text[end + 1:].strip():
+                        reparos.append("texto após o JSON removido")
+                    return data, reparos
+                break
+
+        out: List[str] = []
+        stack: List[List[str]] = []  # [delimitador de fechamento, estado: k/c/v/a]
+        comma: Optional[int] = None    # posição em `out` da última vírgula ainda "pendurada"
+        literal: Optional[int] = None  # posição do último literal solto (número/true/false/null)
+        i, n = start, len(text)
+        while i < n:
+            m = cls._TOKEN.match(text, i)
+            if m is None:
+                break
+            i = m.end()
+            struct, bare = m.group(1), m.group(2)
+
+            if bare is not None:
+                out.append(bare)
+                comma, literal = None, len(out) - 1
+                if stack:
+                    stack[-1][1] = 'a'
+                continue
+            literal = None
+
+            if struct == '"':
+                out.append('"')
+                j, closed = i, False
+                while True:
+                    ms = cls._IN_STRING.search(text, j)
+                    if ms is None:
+                        out.append(text[j:])
+                        i = n
+                        break
+                    k = ms.start()
+                    out.append(text[j:k])
+                    c = text[k]
+                    if c == '"':
+                        i, closed = k + 1, True
+                        break
+                    if c == '\\':
+                        nxt = text[k + 1:k + 2]
+                        if nxt and nxt in cls._VALID_ESCAPES:
+                            out.append(text[k:k + 2])
+                            j = k + 2
+                        else:
+                            if nxt:
+                                out.append('\\\\')
+                                reparos.append("escape inválido duplicado")
+                            j = k + 1
+                        continue
+                    out.append(cls._CONTROL.get(c, ''))
+                    reparos.append("quebra de linha em string" if c in '\n\r' else "caractere de controle em string")
+                    j = k + 1
+                out.append('"')
+                if not closed:
+                    reparos.append("string truncada fechada")
+                comma = None
+                if stack:
+                    stack[-1][1] = 'c' if stack[-1][1] == 'k' else 'a'
+            elif struct in '{[':
+                out.append(struct)
+                comma = None
+                stack.append(['}', 'k'] if struct == '{' else [']', 'v'])
+            elif struct in '}]':
+                if comma is not None:
+                    out[comma] = ''
+                    comma = None
+                    reparos.append("vírgula final removida")
+                if not stack:
+                    break
+                closer = stack.pop()[0]
+                if struct != closer:
+                    reparos.append(f"'{struct}' trocado por '{closer}'")
+                out.append(closer)
+                if not stack:
+                    if text[i:].strip():
+                        reparos.append("texto após o JSON removido")
+                    break
+                stack[-1][1] = 'a'
+            elif struct == ',':
+                out.append(',')
+                comma = len(out) - 1
+                if stack:
+                    stack[-1][1] = 'k' if stack[-1][0] == '}' else 'v'
+            else:  # ':'
+                out.append(':')
+                comma = None
+                if stack:
+                    stack[-1][1] = 'v'
+
+        if stack:
+            # Resposta cortada: remove a sobra e fecha o que ficou aberto
+            if comma is not None:
+                out[comma] = ''
+            if literal is not None:
+                try:
+                    json.loads(out[literal])
+                except json.JSONDecodeError:
+                    out[literal] = 'null'
+            estado = stack[-1][1]
+            if estado == 'c':
+                out.append(':null')
+            elif estado == 'v' and stack[-1][0] == '}':
+                out.append('null')
+            out.append(''.join(frame[0] for frame in reversed(stack)))
+            reparos.append(f"{len(stack)} delimitador(es) fechado(s) (resposta truncada)")
+
         try:
-            response = requests.get('https://api.bcb.gov.br/dados/serie/bcdata.sgs.433/dados/ultimos/1?formato=json', timeout=5)
-            if response.status_code == 200:
-                ipca_data = response.json()
-                if ipca_data: data['ipca'] = f"{float(ipca_data[0]['valor']):.2f}%"
-        except: data['ipca'] = 'N/D'
-        return data
+            data = json.loads(''.join(out))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"JSON inválido após correções: {str(e)}")
+        if not isinstance(data, dict):
+            raise ValueError("A resposta não é um objeto JSON")
+        return data, reparos
+
+
+# ✅ SCHEMA DA ESTRATÉGIA: declarado uma vez e compilado em um normalizador
+STRATEGY_MAX_CHARS = 40000          # texto total aceito antes de recusar a resposta
+STRATEGY_MAX_TREE_DEPTH = 5
+STRATEGY_MAX_TREE_CHILDREN = 6
+STRATEGY_MAX_TREE_NODES = 60
+STRATEGY_META_KEYS = ('json_reparos',)
+
+
+def _texto(max_chars: int, padrao: str = "", opcional: bool = False, descricao: str = "") -> Dict[str, Any]:
+    return {'tipo': 'texto', 'max': max_chars, 'padrao': padrao, 'opcional': opcional, 'descricao': descricao}
+
+
+def _lista(item: Dict[str, Any], max_itens: int, padrao: Any = (), descricao: str = "") -> Dict[str, Any]:
+    return {'tipo': 'lista', 'item': item, 'max': max_itens, 'padrao': padrao, 'descricao': descricao}
+
+
+def _numero(minimo: float, maximo: float, descricao: str = "") -> Dict[str, Any]:
+    """Número opcional, limitado a [minimo, maximo]; ausente vira None"""
+    return {'tipo': 'numero', 'min': minimo, 'max': maximo, 'descricao': descricao}
+
+
+def _objeto(campos: Dict[str, Dict[str, Any]], padrao: Any = None, descricao: str = "") -> Dict[str, Any]:
+    return {'tipo': 'objeto', 'campos': campos, 'padrao': padrao, 'descricao': descricao}
+
+
+STRATEGY_TREE_NODE = {
+    'condicao': _texto(200, descricao="Condição ou cenário do ramo"),
+    'acao': _texto(400, opcional=True, descricao="Recomendação para o cenário"),
+    # Premissas numéricas usadas pela simulação da árvore (TreeSimulator)
+    'valor_estimado': _numero(-1e12, 1e12, descricao="Impacto financeiro estimado do ramo, em R$"),
+    'probabilidade': _numero(0.0, 1.0, descricao="Probabilidade do cenário, de 0 a 1"),
+    'sensibilidade_cambio': _numero(-10.0, 10.0, descricao="Variação % do valor para cada 1% de alta do dólar"),
+    'sensibilidade_selic': _numero(-10.0, 10.0, descricao="Variação % do valor para cada 1% de alta relativa da SELIC"),
+    'sensibilidade_ipca': _numero(-10.0, 10.0, descricao="Variação % do valor para cada 1% de alta relativa do IPCA"),
+}
+
+STRATEGY_SCHEMA: Dict[str, Dict[str, Any]] = {
+    'titulo': _texto(120, "Não especificado", descricao="Título da estratégia (máx 60 caracteres)"),
+    'area_identificada': _texto(120, "Não especificado", descricao="Área financeira principal"),
+    'kpis_relevantes': _lista(_texto(80), 12, ("VPL", "TIR", "Payback")),
+    'frameworks_utilizados': _lista(_texto(120), 10, ("Análise de Viabilidade",)),
+    'analise_dos_dados': _texto(8000, "Análise não disponível", descricao="Análise concisa em 2-3 parágrafos"),
+    'resumo': _texto(3000, "Não especificado", descricao="Resumo executivo em 1 parágrafo"),
+    'modelagem_matematica': _texto(3000, opcional=True, descricao="Fórmulas em texto simples, sem LaTeX"),
+    'video_sugestao': _objeto(descricao="Vídeo do YouTube para aprofundar o tema", campos={
+        'titulo': _texto(150, "Análise Financeira"),
+        'termo_busca': _texto(150, "análise financeira investimentos"),
+        'motivo': _texto(400, "Aprofundar conhecimentos sobre o tema"),
+    }),
+    'template_sugerido': _objeto(descricao="Template Excel para o usuário preencher", campos={
+        'nome': _texto(120, "Análise Financeira"),
+        'colunas': _lista(_texto(60), 20, ("Período", "Valor", "Acumulado")),
+        'linhas_exemplo': _lista({'tipo': 'registro', 'max': 20, 'max_valor': 120}, 50,
+                                 descricao="Linhas de exemplo: objetos coluna -> valor"),
+        'formulas_sugeridas': _lista(_texto(200), 20, descricao="Fórmulas Excel em português, ex.: =SOMA(B2:B10)"),
+    }, padrao={
+        "nome": "Análise Financeira",
+        "colunas": ("Período", "Valor", "Acumulado"),
+        "linhas_exemplo": ({"Período": "Mês 1", "Valor": "1000", "Acumulado": "1000"},),
+        "formulas_sugeridas": ("=SOMA(B:B)",),
+    }),
+    'componentes': {'tipo': 'arvore', 'raiz': _texto(300, "Qual a melhor decisão?"), 'no': STRATEGY_TREE_NODE,
+                    'descricao': "Árvore de decisão: pergunta raiz e ramos condição -> ação",
+                    'padrao': {"pergunta_raiz": "Qual a melhor decisão?", "filhos": ()}},
+    'checklist_implementacao': _lista(_texto(300), 20, ("Revisar análise", "Implementar recomendações"),
+                                      descricao="Passos de implementação"),
+    'riscos_mitigacoes': _lista(_objeto({
+        'risco': _texto(300, "Risco não especificado"),
+        'mitigacao': _texto(400, "Não especificado"),
+    }), 15),
+}
+
+# Fallback único (congelado na compilação); só o texto bruto e o aviso mudam a cada uso
+STRATEGY_FALLBACK = {
+    "titulo": "Análise Financeira",
+    "area_identificada": "Finanças Corporativas",
+    "kpis_relevantes": ("VPL", "TIR", "Payback"),
+    "frameworks_utilizados": ("Análise de Viabilidade",),
+    "resumo": "A análise foi processada. Veja os detalhes acima.",
+    "modelagem_matematica": "",
+    "video_sugestao": {
+        "titulo": "Análise de Investimentos",
+        "termo_busca": "análise investimentos VPL TIR",
+        "motivo": "Aprofundar conhecimento em análise de viabilidade"
+    },
+    "template_sugerido": {
+        "nome": "Fluxo de Caixa",
+        "colunas": ("Período", "Entrada", "Saída", "Saldo"),
+        "linhas_exemplo": ({"Período": "Mês 1", "Entrada": "10000", "Saída": "5000", "Saldo": "5000"},),
+        "formulas_sugeridas": ("=B2-C2",)
+    },
+    "componentes": {
+        "pergunta_raiz": "O investimento é viável?",
+        "filhos": (
+            {"condicao": "VPL > 0", "acao": "Investimento recomendado", "filhos": ()},
+            {"condicao": "VPL < 0", "acao": "Reavaliar premissas", "filhos": ()}
+        )
+    },
+    "checklist_implementacao": (
+        "Validar premissas do modelo",
+        "Calcular cenários alternativos",
+        "Apresentar para stakeholders"
+    ),
+    "riscos_mitigacoes": (
+        {"risco": "Variação cambial", "mitigacao": "Considerar hedge"},
+        {"risco": "Cenário macroeconômico", "mitigacao": "Análise de sensibilidade"}
+    ),
+}
+
+
+def _freeze(value: Any) -> Any:
+    if isinstance(value, Mapping):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value: Any) -> Any:
+    """Cópia mutável (e serializável) de um fragmento congelado"""
+    if isinstance(value, Mapping):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+
+class StrategyTooLarge(ValueError):
+    pass
+
+
+class StrategySchema:
+    """Validador/normalizador compilado a partir de STRATEGY_SCHEMA.
+
+    Cada campo vira uma função `(valor, orçamento) -> (valor_normalizado, ok)` que converte tipos,
+    corta textos e listas nos limites e usa o padrão congelado quando o valor é inválido.
+    `ok=False` marca o campo como reprovado (ausente ou de tipo errado); o orçamento de caracteres
+    é compartilhado pelo documento inteiro e estourá-lo recusa a resposta.
+    """
+
+    def __init__(self, schema: Dict[str, Dict[str, Any]], max_chars: int = STRATEGY_MAX_CHARS):
+        self.schema = schema
+        self.max_chars = max_chars
+        self.campos = {nome: self._compile(spec) for nome, spec in schema.items()}
+        self.fallback = _freeze(STRATEGY_FALLBACK)
+        self.tool_schema = self.json_schema(list(schema))
+
+    @staticmethod
+    @st.cache_resource(show_spinner=False)
+    def shared() -> "StrategySchema":
+        return StrategySchema(STRATEGY_SCHEMA)
+
+    @staticmethod
+    def _gastar(orcamento: List[int], texto: str) -> str:
+        orcamento[0] -= len(texto)
+        if orcamento[0] < 0:
+            raise StrategyTooLarge("Resposta excede o tamanho máximo aceito para renderização")
+        return texto
+
+    def _compile(self, spec: Dict[str, Any]) -> Callable[[Any, List[int]], Tuple[Any, bool]]:
+        tipo = spec['tipo']
+        compilador = {
+            'texto': self._compile_texto, 'numero': self._compile_numero,
+            'lista': self._compile_lista, 'objeto': self._compile_objeto,
+            'registro': self._compile_registro, 'arvore': self._compile_arvore,
+        }[tipo]
+        return compilador(spec)
+
+    def _compile_texto(self, spec: Dict[str, Any]) -> Callable:
+        max_chars, padrao, opcional = spec['max'], spec['padrao'], spec['opcional']
+        gastar = self._gastar
+
+        def normalizar(valor: Any, orcamento: List[int]) -> Tuple[Any, bool]:
+            if isinstance(valor, bool) or not isinstance(valor, (str, int, float)):
+                return padrao, opcional and valor is None
+            texto = str(valor).strip()
+            if not texto:
+                return padrao, opcional
+            if len(texto) > max_chars:
+                texto = texto[:max_chars - 1].rstrip() + "…"
+            return gastar(orcamento, texto), True
+        return normalizar
+
+    def _compile_numero(self, spec: Dict[str, Any]) -> Callable:
+        minimo, maximo = spec['min'], spec['max']
+
+        def normalizar(valor: Any, orcamento: List[int]) -> Tuple[Any, bool]:
+            if isinstance(valor, str):
+                texto = re.sub(r'[^\d,.\-]', '', valor)
+                if ',' in texto:
+                    texto = texto.replace('.', '').replace(',', '.')
+                try:
+                    valor = float(texto)
+                except ValueError:
+                    return None, True
+            if isinstance(valor, bool) or not isinstance(valor, (int, float)) or math.isnan(valor):
+                return None, True
+            return min(max(float(valor), minimo), maximo), True
+        return normalizar
+
+    def _compile_lista(self, spec: Dict[str, Any]) -> Callable:
+        item, max_itens, padrao = self._compile(spec['item']), spec['max'], _freeze(spec['padrao'])
+
+        def normalizar(valor: Any, orcamento: List[int]) -> Tuple[Any, bool]:
+            if isinstance(valor, (str, dict)):
+                valor = [valor]
+            if not isinstance(valor, list):
+                # Listas sem padrão são opcionais: ausência não reprova o campo
+                return _thaw(padrao), not padrao and valor is None
+            saida, ok = [], True
+            for elemento in valor[:max_itens]:
+                normalizado, item_ok = item(elemento, orcamento)
+                if item_ok:
+                    saida.append(normalizado)
+                ok = ok and item_ok
+            if not saida and padrao:
+                return _thaw(padrao), False
+            return saida, ok
+        return normalizar
+
+    def _compile_objeto(self, spec: Dict[str, Any]) -> Callable:
+        campos = {nome: self._compile(sub) for nome, sub in spec['campos'].items()}
+        padrao = _freeze(spec['padrao'])
+
+        def normalizar(valor: Any, orcamento: List[int]) -> Tuple[Any, bool]:
+            if not isinstance(valor, dict):
+                if padrao is not None:
+                    return _thaw(padrao), False
+                valor = {}
+            saida, ok = {}, True
+            for nome, campo in campos.items():
+                saida[nome], campo_ok = campo(valor.get(nome), orcamento)
+                ok = ok and campo_ok
+            return saida, ok
+        return normalizar
+
+    def _compile_registro(self, spec: Dict[str, Any]) -> Callable:
+        """Linha de exemplo do template: chaves livres, valores convertidos para texto"""
+        max_chaves, max_valor = spec['max'], spec['max_valor']
+        gastar = self._gastar
+
+        def normalizar(valor: Any, orcamento: List[int]) -> Tuple[Any, bool]:
+            if not isinstance(valor, dict):
+                return None, False
+            saida = {}
+            for chave, celula in list(valor.items())[:max_chaves]:
+                texto = "" if celula is None else str(celula)[:max_valor]
+                saida[gastar(orcamento, str(chave)[:max_valor])] = gastar(orcamento, texto)
+            return saida, True
+        return normalizar
+
+    def _compile_arvore(self, spec: Dict[str, Any]) -> Callable:
+        raiz = self._compile(spec['raiz'])
+        no = self._compile_objeto({'campos': spec['no'], 'padrao': None})
+        padrao = _freeze(spec['padrao'])
+
+        def normalizar(valor: Any, orcamento: List[int]) -> Tuple[Any, bool]:
+            if not isinstance(valor, dict):
+                return _thaw(padrao), False
+            pergunta, ok = raiz(valor.get('pergunta_raiz', valor.get('condicao')), orcamento)
+            saida = {'pergunta_raiz': pergunta, 'filhos': []}
+            # Percurso iterativo com limites de profundidade, de filhos por nó e de nós no total
+            pilha, nos = [(valor.get('filhos'), saida['filhos'], 1)], 0
+            while pilha:
+                filhos, destino, nivel = pilha.pop()
+                if not isinstance(filhos, list):
+                    continue
+                for filho in filhos[:STRATEGY_MAX_TREE_CHILDREN]:
+                    if not isinstance(filho, dict) or nos >= STRATEGY_MAX_TREE_NODES:
+                        continue
+                    normalizado, no_ok = no(filho, orcamento)
+                    if not normalizado['condicao']:
+                        continue
+                    nos += 1
+                    normalizado['filhos'] = []
+                    destino.append(normalizado)
+                    if nivel < STRATEGY_MAX_TREE_DEPTH:
+                        pilha.append((filho.get('filhos'), normalizado['filhos'], nivel + 1))
+            return saida, ok
+        return normalizar
+
+    @staticmethod
+    def _obrigatorio(spec: Dict[str, Any]) -> bool:
+        return not (spec.get('opcional') or spec['tipo'] == 'numero' or (spec['tipo'] == 'lista' and not spec['padrao']))
+
+    def _json_objeto(self, campos: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        return {
+            'type': 'object',
+            'properties': {nome: self._json_schema(spec) for nome, spec in campos.items()},
+            'required': [nome for nome, spec in campos.items() if self._obrigatorio(spec)],
+        }
+
+    def _json_schema(self, spec: Dict[str, Any]) -> Dict[str, Any]:
+        tipo = spec['tipo']
+        if tipo == 'texto':
+            out = {'type': 'string'}
+        elif tipo == 'numero':
+            out = {'type': 'number'}
+        elif tipo == 'lista':
+            out = {'type': 'array', 'items': self._json_schema(spec['item']), 'maxItems': spec['max']}
+        elif tipo == 'objeto':
+            out = self._json_objeto(spec['campos'])
+        elif tipo == 'registro':
+            out = {'type': 'object', 'additionalProperties': {'type': 'string'}}
+        else:  # arvore: os nós referenciam a si mesmos via $defs
+            out = {
+                'type': 'object',
+                'properties': {
+                    'pergunta_raiz': self._json_schema(spec['raiz']),
+                    'filhos': {'type': 'array', 'items': {'$ref': '#/$defs/no'}, 'maxItems': STRATEGY_MAX_TREE_CHILDREN},
+                },
+                'required': ['pergunta_raiz', 'filhos'],
+            }
+        if spec.get('descricao'):
+            out['description'] = spec['descricao']
+        return out
+
+    def json_schema(self, campos: List[str]) -> Dict[str, Any]:
+        """JSON Schema (input_schema de ferramenta) restrito aos campos pedidos"""
+        out = self._json_objeto({nome: self.schema[nome] for nome in campos})
+        for nome in campos:
+            if self.schema[nome]['tipo'] == 'arvore':
+                no = self._json_objeto(self.schema[nome]['no'])
+                no['properties']['filhos'] = {'type': 'array', 'items': {'$ref': '#/$defs/no'},
+                                              'maxItems': STRATEGY_MAX_TREE_CHILDREN}
+                out['$defs'] = {'no': no}
+        return out
+
+    def normalize(self, result: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+        """Devolve o documento normalizado e os campos reprovados; levanta StrategyTooLarge"""
+        orcamento = [self.max_chars]
+        saida, falhas = {}, []
+        for nome, campo in self.campos.items():
+            saida[nome], ok = campo(result.get(nome), orcamento)
+            if not ok:
+                falhas.append(nome)
+        for meta in STRATEGY_META_KEYS:
+            if meta in result:
+                saida[meta] = result[meta]
+        return saida, falhas
+
+    def normalize_field(self, nome: str, valor: Any) -> Any:
+        """Normaliza um campo isolado (streaming); None ou tipo errado viram o padrão do schema"""
+        campo = self.campos.get(nome)
+        return valor if campo is None else campo(valor, [self.max_chars])[0]
+
+    def fallback_result(self, raw_content: str, warning: str) -> Dict[str, Any]:
+        result = _thaw(self.fallback)
+        result["analise_dos_dados"] = raw_content[:2000] if raw_content else "Análise não disponível"
+        result["parse_warning"] = warning
+        return result
+
+
+# ✅ PROMPT: prefixo estável (instruções + schema) marcado para o cache de prompt da Anthropic.
+# É um literal (compilado uma única vez com o script), nunca uma f-string montada a cada chamada.
+STRATEGY_PROMPT_INSTRUCTIONS = """Você é o FinMentor, um CFO Virtual especializado em finanças corporativas brasileiras.
+
+TAREFA: Analisar o desafio financeiro e retornar uma estratégia estruturada.
+
+REGRAS CRÍTICAS DE FORMATO:
+1. Retorne APENAS JSON válido, sem markdown, sem ```json, sem texto antes ou depois
+2. Todas as strings devem estar em uma única linha (sem quebras de linha dentro de strings)
+3. Use aspas duplas para todas as strings
+4. Não use caracteres de controle dentro das strings
+5. Para fórmulas matemáticas, use texto simples como "VPL = soma(FC/(1+r)^t)" em vez de LaTeX
+6. Em cada ramo de "componentes", inclua quando possível os números valor_estimado (R$), probabilidade (0 a 1)
+   e sensibilidade_cambio, sensibilidade_selic e sensibilidade_ipca (variação % do valor por 1% de alta do fator)
+
+ESTRUTURA JSON OBRIGATÓRIA:
+{
+  "titulo": "Título da estratégia (máx 60 caracteres)",
+  "area_identificada": "Área financeira principal",
+  "kpis_relevantes": ["KPI1", "KPI2", "KPI3"],
+  "frameworks_utilizados": ["Framework1", "Framework2"],
+  "analise_dos_dados": "Análise concisa em 2-3 parágrafos sem quebras de linha",
+  "resumo": "Resumo executivo em 1 parágrafo",
+  "modelagem_matematica": "VPL = soma dos fluxos descontados",
+  "video_sugestao": {
+    "titulo": "Nome do vídeo sugerido",
+    "termo_busca": "termo para buscar no youtube",
+    "motivo": "Por que este conteúdo é relevante"
+  },
+  "template_sugerido": {
+    "nome": "Nome do template Excel",
+    "colunas": ["Coluna1", "Coluna2", "Coluna3", "Coluna4"],
+    "linhas_exemplo": [
+      {"Coluna1": "Exemplo1", "Coluna2": "100", "Coluna3": "200", "Coluna4": "300"}
+    ],
+    "formulas_sugeridas": ["=SOMA(B2:B10)", "=VPL(taxa;fluxos)"]
+  },
+  "componentes": {
+    "pergunta_raiz": "Qual a decisão principal?",
+    "filhos": [
+      {
+        "condicao": "Se cenário A",
+        "acao": "Recomendação para cenário A",
+        "valor_estimado": 250000,
+        "probabilidade": 0.6,
+        "sensibilidade_cambio": -0.4,
+        "sensibilidade_selic": -0.2,
+        "sensibilidade_ipca": 0.1,
+        "filhos": []
+      },
+      {
+        "condicao": "Se cenário B", 
+        "acao": "Recomendação para cenário B",
+        "filhos": []
+      }
+    ]
+  },
+  "checklist_implementacao": [
+    "Passo 1: Ação específica",
+    "Passo 2: Ação específica",
+    "Passo 3: Ação específica"
+  ],
+  "riscos_mitigacoes": [
+    {
+      "risco": "Descrição do risco",
+      "mitigacao": "Como mitigar"
+    }
+  ]
+}
+
+Retorne APENAS o JSON, começando com { e terminando com }."""
+
+# Modo "tool": o schema vira uma ferramenta de uso forçado e o input estruturado é lido direto
+# do bloco tool_use (sem eco do schema no prompt nem reparo de JSON). Modo "json": texto + JSONRepair.
+STRATEGY_OUTPUT_MODE = "tool"
+STRATEGY_TOOL_NAME = "registrar_estrategia"
+STRATEGY_TOOL_RETRY_MAX_TOKENS = 2048
+
+STRATEGY_TOOL_INSTRUCTIONS = """Você é o FinMentor, um CFO Virtual especializado em finanças corporativas brasileiras.
+
+TAREFA: Analisar o desafio financeiro e registrar a estratégia estruturada com a ferramenta registrar_estrategia.
+
+DIRETRIZES:
+1. Título com no máximo 60 caracteres; resumo executivo em 1 parágrafo; análise em 2-3 parágrafos
+2. Árvore de decisão com condições objetivas e uma recomendação por ramo
+3. Template Excel com colunas, linhas de exemplo e fórmulas em português (ex.: =SOMA(B2:B10))
+4. Fórmulas matemáticas em texto simples, como "VPL = soma(FC/(1+r)^t)", sem LaTeX
+5. Preencha as premissas numéricas dos ramos (valor, probabilidade e sensibilidades) sempre que possível"""
+
+PROMPT_CACHE = {"type": "ephemeral"}
+
+
+# ✅ CLIENTES HTTP REUTILIZÁVEIS (pool de conexões + retry com backoff)
+LLM_TIMEOUT = 90.0
+LLM_CONNECT_TIMEOUT = 10.0
+LLM_MAX_RETRIES = 3
+LLM_POOL_MAX_CONNECTIONS = 20
+LLM_POOL_MAX_KEEPALIVE = 10
+LLM_POOL_KEEPALIVE_EXPIRY = 60.0
+LLM_CLIENT_CACHE_SIZE = 32
+
+
+def _llm_timeout(sdk) -> Any:
+    return sdk.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+
+
+class LLMClient:
+    """Cliente LLM com parsing JSON robusto"""
+    
+    # ✅ Modelo estável
+    MODELO_ESCOLHIDO = "claude-sonnet-4-5-20250929"
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+
+    @staticmethod
+    def _http_client(sdk) -> Any:
+        """Pool HTTP com limites próprios, montado com os tipos exportados pelo próprio SDK"""
+        limits = type(sdk.DEFAULT_CONNECTION_LIMITS)(
+            max_connections=LLM_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_POOL_KEEPALIVE_EXPIRY,
+        )
+        return sdk.DefaultHttpxClient(limits=limits, timeout=_llm_timeout(sdk))
+
+    @staticmethod
+    @st.cache_resource(max_entries=LLM_CLIENT_CACHE_SIZE, show_spinner=False)
+    def anthropic_client(api_key: str) -> anthropic.Anthropic:
+        """Um cliente (e pool de conexões keep-alive) por chave, reaproveitado entre chamadas"""
+        # O SDK refaz 429/5xx/erros de conexão com backoff exponencial até max_retries
+        return anthropic.Anthropic(
+            api_key=api_key,
+            max_retries=LLM_MAX_RETRIES,
+            timeout=_llm_timeout(anthropic),
+            http_client=LLMClient._http_client(anthropic),
+        )
+
+    @staticmethod
+    @st.cache_resource(max_entries=LLM_CLIENT_CACHE_SIZE, show_spinner=False)
+    def openai_client(api_key: str) -> OpenAI:
+        return OpenAI(
+            api_key=api_key,
+            max_retries=LLM_MAX_RETRIES,
+            timeout=_llm_timeout(openai),
+            http_client=LLMClient._http_client(openai),
+        )
+
+    @staticmethod
+    def _get_system_prompt(conhecimento: str, persona: str, mercado: Dict[str, Any],
+                           instrucoes: str = STRATEGY_PROMPT_INSTRUCTIONS) -> List[Dict[str, Any]]:
+        """System prompt em blocos: prefixo cacheável (instruções, depois trechos da base)
+        e um sufixo volátil (perfil + mercado) que fica fora do cache"""
+        # O conhecimento já chega recortado pelo índice (top-k dentro do orçamento de tokens)
+        kb_trechos = conhecimento or "Nenhum trecho relevante encontrado."
+        return [
+            {"type": "text", "text": instrucoes, "cache_control": PROMPT_CACHE},
+            {"type": "text", "text": f"BASE DE CONHECIMENTO (trechos relevantes ao desafio):\n{kb_trechos}",
+             "cache_control": PROMPT_CACHE},
+            {"type": "text", "text": (
+                f"PERFIL DO USUÁRIO: {persona}\n"
+                f"DADOS DE MERCADO: Dólar R$ {mercado.get('dolar', 'N/D')}, IBOVESPA {mercado.get('ibov', 'N/D')} pontos, "
+                f"SELIC {mercado.get('selic', 'N/D')}, IPCA {mercado.get('ipca', 'N/D')}"
+            )},
+        ]
+
+    def _extract_json_from_response(self, text: str) -> Dict[str, Any]:
+        """Extrai JSON de forma robusta, mesmo com texto extra ou resposta truncada"""
+        result, reparos = JSONRepair.parse(text)
+        if reparos:
+            result['json_reparos'] = reparos
+        return result
+
+    @staticmethod
+    def _build_user_prompt(contexto: str) -> str:
+        return f"""DESAFIO DO USUÁRIO:
+{contexto}
+
+Analise o desafio e retorne o JSON estruturado conforme especificado."""
+
+    @staticmethod
+    def _normalize_result(result: Dict[str, Any]) -> Dict[str, Any]:
+        """Garante os campos que a fase 2 espera (tipos, limites e padrões vêm de STRATEGY_SCHEMA)"""
+        return StrategySchema.shared().normalize(result)[0]
+
+    @staticmethod
+    def _fallback_result(raw_content: str, warning: str) -> Dict[str, Any]:
+        """Resposta de fallback com o texto bruto quando o JSON não pôde ser aproveitado"""
+        return StrategySchema.shared().fallback_result(raw_content, warning)
+
+    @staticmethod
+    def _tool_params(input_schema: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "tools": [{
+                "name": STRATEGY_TOOL_NAME,
+                "description": "Registra a estratégia financeira estruturada para o desafio do usuário.",
+                "input_schema": input_schema,
+                "cache_control": PROMPT_CACHE,
+            }],
+            "tool_choice": {"type": "tool", "name": STRATEGY_TOOL_NAME},
+        }
+
+    def _strategy_request(self, contexto: str, persona: str, mercado: Dict[str, Any], kb: str) -> Dict[str, Any]:
+        """Parâmetros da chamada de estratégia para o modo de saída configurado"""
+        request = dict(
+            model=self.MODELO_ESCOLHIDO,
+            max_tokens=4096,  # Reduzido para evitar respostas muito longas
+            temperature=0.3,  # Mais determinístico para JSON
+            messages=[{"role": "user", "content": self._build_user_prompt(contexto)}],
+        )
+        if STRATEGY_OUTPUT_MODE == "tool":
+            request["system"] = self._get_system_prompt(kb, persona, mercado, STRATEGY_TOOL_INSTRUCTIONS)
+            request.update(self._tool_params(StrategySchema.shared().tool_schema))
+        else:
+            request["system"] = self._get_system_prompt(kb, persona, mercado)
+        return request
+
+    @staticmethod
+    def _tool_input(message: Any) -> Dict[str, Any]:
+        for block in message.content:
+            if block.type == "tool_use" and isinstance(block.input, dict):
+                return block.input
+        raise ValueError("O modelo não retornou a estratégia estruturada")
+
+    def _retry_failed_fields(self, client: anthropic.Anthropic, request: Dict[str, Any],
+                             data: Dict[str, Any], falhas: List[str]) -> Dict[str, Any]:
+        """Uma única nova chamada pedindo só os campos reprovados, com schema restrito a eles"""
+        schema = StrategySchema.shared()
+        pedido = (f"{request['messages'][0]['content']}\n\n"
+                  f"A estratégia \"{data.get('titulo', '')}\" já foi registrada, mas os campos "
+                  f"{', '.join(falhas)} vieram ausentes ou inválidos. Registre somente esses campos.")
+        try:
+            response = client.messages.create(**{
+                **request,
+                **self._tool_params(schema.json_schema(falhas)),
+                "max_tokens": STRATEGY_TOOL_RETRY_MAX_TOKENS,
+                "messages": [{"role": "user", "content": pedido}],
+            })
+            correcao = self._tool_input(response)
+        except (anthropic.APIError, ValueError):
+            return data
+        return {**data, **{campo: correcao[campo] for campo in falhas if campo in correcao}}
+
+    def _finish_tool_result(self, client: anthropic.Anthropic, request: Dict[str, Any],
+                            data: Dict[str, Any]) -> Dict[str, Any]:
+        schema = StrategySchema.shared()
+        result, falhas = schema.normalize(data)
+        if falhas:
+            result = schema.normalize(self._retry_failed_fields(client, request, data, falhas))[0]
+        return result
+
+    def generate_strategy(self, contexto: str, persona: str, mercado: Dict[str, Any], kb: str) -> Dict[str, Any]:
+        """Gera estratégia financeira com parsing robusto"""
+        
+        cache = StrategyResponseCache.shared()
+        cache_key = cache.key(contexto, persona, mercado, kb, STRATEGY_OUTPUT_MODE)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return {**cached, 'cache_hit': True, 'cache_key': cache_key}
+
+        client = LLMClient.anthropic_client(self.api_key)
+        request = self._strategy_request(contexto, persona, mercado, kb)
+
+        try:
+            response = client.messages.create(**request)
+
+            if STRATEGY_OUTPUT_MODE == "tool":
+                try:
+                    result = self._finish_tool_result(client, request, self._tool_input(response))
+                except ValueError as e:
+                    return self._fallback_result("", str(e))
+            else:
+                raw_content = response.content[0].text
+
+                # Tenta extrair JSON
+                try:
+                    result = self._normalize_result(self._extract_json_from_response(raw_content))
+                except ValueError as e:
+                    return self._fallback_result(raw_content, str(e))
+            cache.put(cache_key, result)
+            return {**result, 'cache_hit': False, 'cache_key': cache_key}
+                
+        except anthropic.APIError as e:
+            return {"error": True, "message": f"Erro na API Anthropic: {str(e)}"}
+        except Exception as e:
+            return {"error": True, "message": f"Erro inesperado: {str(e)}"}
+
+    def generate_strategy_stream(self, contexto: str, persona: str, mercado: Dict[str, Any],
+                                 kb: str) -> Iterator[Tuple[str, Any]]:
+        """Versão em streaming: emite ("campo", (nome, valor)) assim que cada campo do JSON fecha
+        e termina com ("resultado", dict) já normalizado (ou com o dict de erro)."""
+        cache = StrategyResponseCache.shared()
+        cache_key = cache.key(contexto, persona, mercado, kb, STRATEGY_OUTPUT_MODE)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            yield "resultado", {**cached, 'cache_hit': True, 'cache_key': cache_key}
+            return
+
+        client = LLMClient.anthropic_client(self.api_key)
+        request = self._strategy_request(contexto, persona, mercado, kb)
+        parser = IncrementalJSONParser()
+        schema = StrategySchema.shared()
+        raw_parts: List[str] = []
+        try:
+            with client.messages.stream(**request) as stream:
+                # No modo "tool" o JSON chega em deltas de input_json; no modo "json", como texto
+                for event in stream:
+                    if event.type == "input_json":
+                        delta = event.partial_json
+                    elif event.type == "text":
+                        delta = event.text
+                    else:
+                        continue
+                    raw_parts.append(delta)
+                    for nome, valor in parser.feed(delta):
+                        yield "campo", (nome, schema.normalize_field(nome, valor))
+                final_message = stream.get_final_message() if STRATEGY_OUTPUT_MODE == "tool" else None
+            if final_message is not None:
+                try:
+                    result = self._finish_tool_result(client, request, self._tool_input(final_message))
+                except ValueError as e:
+                    yield "resultado", self._fallback_result("".join(raw_parts), str(e))
+                    return
+                cache.put(cache_key, result)
+                yield "resultado", {**result, 'cache_hit': False, 'cache_key': cache_key}
+                return
+        except anthropic.APIError as e:
+            yield "resultado", {"error": True, "message": f"Erro na API Anthropic: {str(e)}"}
+            return
+        except Exception as e:
+            yield "resultado", {"error": True, "message": f"Erro inesperado: {str(e)}"}
+            return
+
+        raw_content = "".join(raw_parts)
+        try:
+            result = self._normalize_result(self._extract_json_from_response(raw_content))
+        except ValueError as e:
+            yield "resultado", self._fallback_result(raw_content, str(e))
+            return
+        cache.put(cache_key, result)
+        yield "resultado", {**result, 'cache_hit': False, 'cache_key': cache_key}
+
+    @staticmethod
+    def transcribe_audio(audio_bytes: bytes, openai_api_key: str) -> str:
+        if not openai_api_key: 
+            return "[Erro: Chave OpenAI necessária para transcrição]"
+        try:
+            client = LLMClient.openai_client(openai_api_key)
+            audio_file = BytesIO(audio_bytes)
+            audio_file.name = "audio.wav"
+            return client.audio.transcriptions.create(
+                model="whisper-1", 
+                file=audio_file, 
+                language="pt"
+            ).text
+        except Exception as e:
+            return f"[Erro na transcrição: {str(e)}]"
+            
+    @staticmethod
+    def _chat_request(user_message: str, chat_history: List[Dict], main_context: str) -> Dict[str, Any]:
+        messages_payload = []
+        for msg in chat_history[-10:]:
+            if msg["role"] in ["user", "assistant"]:
+                messages_payload.append({"role": msg["role"], "content": msg["content"]})
+        # Breakpoint na última mensagem: o turno seguinte reaproveita todo o histórico do cache
+        messages_payload.append({"role": "user", "content": [
+            {"type": "text", "text": user_message, "cache_control": PROMPT_CACHE}
+        ]})
+        return dict(
+            model="claude-sonnet-4-5-20250929",
+            max_tokens=1000,
+            temperature=0.7,
+            system=[{"type": "text", "cache_control": PROMPT_CACHE, "text": f"""Você é o FinMentor, um CFO Virtual. Responda de forma direta e profissional em português brasileiro.
+                
+Contexto da conversa anterior:
+{main_context[:5000]}"""}],
+            messages=messages_payload
+        )
+
+    @staticmethod
+    def chat_followup(user_message: str, chat_history: List[Dict], main_context: str, kb: str, api_key: str) -> str:
+        client = LLMClient.anthropic_client(api_key)
+        try:
+            response = client.messages.create(**LLMClient._chat_request(user_message, chat_history, main_context))
+            return response.content[0].text.strip()
+        except Exception as e:
+            return f"❌ Erro ao processar: {str(e)}"
+
+    @staticmethod
+    def chat_followup_stream(user_message: str, chat_history: List[Dict], main_context: str, kb: str,
+                             api_key: str, cancel: Optional[threading.Event] = None) -> Iterator[str]:
+        """Gera os deltas de texto da resposta; para (e fecha a conexão) quando `cancel` é sinalizado"""
+        client = LLMClient.anthropic_client(api_key)
+        try:
+            with client.messages.stream(**LLMClient._chat_request(user_message, chat_history, main_context)) as stream:
+                for delta in stream.text_stream:
+                    if cancel is not None and cancel.is_set():
+                        break
+                    yield delta
+        except Exception as e:
+            yield f"❌ Erro ao processar: {str(e)}"
+
+
+# ✅ CACHE DE RESPOSTAS: desafio normalizado + perfil + faixa de mercado
+STRATEGY_CACHE_PATH = os.path.join(".cache", "strategy_responses.sqlite")
+STRATEGY_CACHE_MAX_ENTRIES = 500
+STRATEGY_CACHE_TTL = 24 * 3600
+
+
+class StrategyResponseCache:
+    """Cache em disco (SQLite) das estratégias geradas, com despejo LRU + TTL e contadores de acerto.
+
+    A chave é exata sobre o desafio normalizado (minúsculas, sem acentos nem pontuação),
+    o perfil, uma faixa grossa dos indicadores de mercado, o hash do trecho da base de conhecimento
+    enviado e a versão do prompt/modelo.
+    """
+
+    def __init__(self, path: str = STRATEGY_CACHE_PATH, max_entries: int = STRATEGY_CACHE_MAX_ENTRIES,
+                 ttl: float = STRATEGY_CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY, payload TEXT NOT NULL, created_at REAL NOT NULL,
+                    last_access REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+
+    @staticmethod
+    @st.cache_resource(show_spinner=False)
+    def shared() -> "StrategyResponseCache":
+        return StrategyResponseCache()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def normalize(contexto: str) -> str:
+        texto = unicodedata.normalize('NFKD', contexto.lower()).encode('ascii', 'ignore').decode()
+        return " ".join(re.findall(r'[a-z0-9]+', texto))
+
+    @staticmethod
+    def market_bucket(mercado: Dict[str, Any]) -> Tuple[Any, ...]:
+        """Faixas grossas: câmbio a cada R$ 0,25, IBOVESPA a cada 5 mil pontos, SELIC/IPCA exatos"""
+        def numero(valor: Any) -> Optional[float]:
+            try:
+                return float(str(valor).replace('%', '').replace('.', '').replace(',', '.')
+                             if isinstance(valor, str) else valor)
+            except (TypeError, ValueError):
+                return None
+
+        dolar, ibov = numero(mercado.get('dolar')), numero(mercado.get('ibov'))
+        return (
+            round(dolar * 4) / 4 if dolar is not None else None,
+            int(ibov // 5000) if ibov is not None else None,
+            str(mercado.get('selic', 'N/D')),
+            str(mercado.get('ipca', 'N/D')),
+        )
+
+    def key(self, contexto: str, persona: str, mercado: Dict[str, Any], kb: str = '', variante: str = '') -> str:
+        # O trecho da base de conhecimento entra por hash: editar a base invalida as respostas que o usaram
+        material = json.dumps([
+            self.normalize(contexto), persona, self.market_bucket(mercado), variante,
+            hashlib.sha256(kb.encode()).hexdigest()[:16],
+            LLMClient.MODELO_ESCOLHIDO,
+            hashlib.sha256((STRATEGY_PROMPT_INSTRUCTIONS + STRATEGY_TOOL_INSTRUCTIONS).encode()).hexdigest()[:12],
+        ], ensure_ascii=False)
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT payload FROM responses WHERE key = ? AND created_at > ?",
+                                   (key, now - self.ttl)).fetchone()
+                if row:
+                    conn.execute("UPDATE responses SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            print(f"Cache de respostas indisponível: {e}")
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        # Erros e respostas de fallback nunca entram no cache
+        if result.get('error') or result.get('parse_warning'):
+            return
+        now = time.time()
+        payload = json.dumps({k: v for k, v in result.items() if not k.startswith('cache_')}, ensure_ascii=False)
+        try:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO responses (key, payload, created_at, last_access, hits) "
+                             "VALUES (?, ?, ?, ?, 0)", (key, payload, now, now))
+                conn.execute("DELETE FROM responses WHERE created_at <= ?", (now - self.ttl,))
+                conn.execute("""
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                    )
+                """, (self.max_entries,))
+        except sqlite3.Error as e:
+            print(f"Cache de respostas indisponível: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            with self._connect() as conn:
+                entries = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        except sqlite3.Error:
+            entries = None
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries,
+                'hit_rate': (self.hits / total) if total else 0.0}
+
+
+# ✅ PERFIL DA PLANILHA: leitura em blocos, estatísticas vetorizadas e resumo dentro do orçamento
+UPLOAD_CHUNK_ROWS = 50_000
+UPLOAD_MAX_COLUMNS = 40
+UPLOAD_XLS_MAX_ROWS = 200_000   # .xls é lido inteiro em memória: acima disso o perfil fica parcial
+UPLOAD_TOKEN_BUDGET = 1500
+UPLOAD_TOP_CATEGORIES = 5
+UPLOAD_CATEGORY_CAP = 5000      # distintos mantidos por coluna de texto (acima disso, contagem aproximada)
+UPLOAD_MAX_MONTHS = 24
+UPLOAD_MAX_VALUE_COLUMNS = 3
+UPLOAD_SAMPLE_ROWS = 5
+UPLOAD_SERIES_ROWS = 600        # valores em ordem guardados por coluna de valor (fluxos por período)
+UPLOAD_DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d/%m/%y', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M', '%d-%m-%Y', '%m/%Y')
+_VALUE_HINTS = re.compile(r'valor|total|receita|saldo|custo|despesa|pre[cç]o|montante|amount|entrada|sa[ií]da|fluxo|lucro', re.I)
+_ID_HINTS = re.compile(r'^id$|^id_|c[oó]d|^ano$|^m[eê]s$|n[uú]mero|cpf|cnpj|cep|telefone', re.I)
+
+
+def _fmt_num(valor: float) -> str:
+    """Número no padrão brasileiro (1.234.567,89)"""
+    return f"{valor:,.2f}".replace(',', '_').replace('.', ',').replace('_', '.')
+
+
+class SpreadsheetProfiler:
+    """Perfil de planilhas grandes com memória limitada.
+
+    O arquivo é lido em blocos (`chunksize` no CSV, openpyxl em modo read-only no XLSX) e só as
+    primeiras UPLOAD_MAX_COLUMNS colunas são projetadas. Os tipos são decididos no primeiro bloco;
+    depois cada bloco só atualiza acumuladores (contagens, somas, mínimos/máximos, top categorias
+    e somas mensais), então o consumo de memória não cresce com o número de linhas. O `.xls` antigo,
+    sem leitor em streaming, é limitado a UPLOAD_XLS_MAX_ROWS linhas e o resumo avisa que é parcial.
+    """
+
+    def __init__(self, chunk_rows: int = UPLOAD_CHUNK_ROWS, max_columns: int = UPLOAD_MAX_COLUMNS):
+        self.chunk_rows = chunk_rows
+        self.max_columns = max_columns
+        self.linhas = 0
+        self.total_colunas = 0
+        self.parcial = False
+        self.tipos: Dict[str, str] = {}
+        self.formatos_data: Dict[str, Optional[str]] = {}
+        self.stats: Dict[str, Dict[str, Any]] = {}
+        self.coluna_data: Optional[str] = None
+        self.colunas_valor: List[str] = []
+        self.mensal: Dict[str, Counter] = {}
+        self.coluna_rotulo: Optional[str] = None
+        self.series: Dict[str, List[float]] = {}
+        self.rubricas: Dict[str, float] = {}
+        self.amostra = ''
+
+    @staticmethod
+    def profile(nome: str, dados: bytes) -> Dict[str, Any]:
+        profiler = SpreadsheetProfiler()
+        extensao = nome.lower().rsplit('.', 1)[-1]
+        if extensao == 'csv':
+            chunks = profiler._csv_chunks(dados)
+        elif extensao in ('xlsx', 'xlsm'):
+            chunks = profiler._xlsx_chunks(dados)
+        else:
+            chunks = profiler._excel_chunks(dados)
+        for chunk in chunks:
+            profiler._add(chunk)
+        return profiler._result(nome)
+
+    # --- leitura em blocos ---
+
+    def _csv_chunks(self, dados: bytes) -> Iterator[Any]:
+        import pandas as pd
+        inicio = dados[:65536]
+        try:
+            texto = codecs.getincrementaldecoder('utf-8')().decode(inicio)
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            texto, encoding = inicio.decode('latin-1'), 'latin-1'
+        try:
+            sep = csv.Sniffer().sniff(texto, delimiters=',;\t|').delimiter
+        except csv.Error:
+            sep = ','
+        # Planilhas brasileiras exportadas com ";" usam vírgula decimal
+        decimal = ',' if sep == ';' else '.'
+        header = pd.read_csv(BytesIO(dados), sep=sep, encoding=encoding, nrows=0).columns
+        self.total_colunas = len(header)
+        yield from pd.read_csv(BytesIO(dados), sep=sep, decimal=decimal, encoding=encoding,
+                               usecols=list(header[:self.max_columns]), chunksize=self.chunk_rows)
+
+    def _xlsx_chunks(self, dados: bytes) -> Iterator[Any]:
+        import pandas as pd
+        from openpyxl import load_workbook
+        wb = load_workbook(BytesIO(dados), read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            self.total_colunas = len(header)
+            n = min(len(header), self.max_columns)
+            nomes: List[str] = []
+            for i, h in enumerate(header[:n]):
+                nome = str(h).strip() if h not in (None, '') else f"Coluna {i + 1}"
+                nomes.append(nome if nome not in nomes else f"{nome} ({i + 1})")
+            bloco: List[Tuple[Any, ...]] = []
+            for row in rows:
+                row = row[:n]
+                if all(v is None for v in row):
+                    continue
+                bloco.append(row + (None,) * (n - len(row)))
+                if len(bloco) >= self.chunk_rows:
+                    yield pd.DataFrame(bloco, columns=nomes)
+                    bloco = []
+            if bloco:
+                yield pd.DataFrame(bloco, columns=nomes)
+        finally:
+            wb.close()
+
+    def _excel_chunks(self, dados: bytes) -> Iterator[Any]:
+        # .xls antigo não tem leitor em streaming: lê no máximo UPLOAD_XLS_MAX_ROWS linhas e processa em fatias
+        import pandas as pd
+        df = pd.read_excel(BytesIO(dados), nrows=UPLOAD_XLS_MAX_ROWS + 1)
+        if len(df) > UPLOAD_XLS_MAX_ROWS:
+            self.parcial = True
+            df = df.iloc[:UPLOAD_XLS_MAX_ROWS]
+        self.total_colunas = len(df.columns)
+        df = df.iloc[:, :self.max_columns]
+        for inicio in range(0, len(df), self.chunk_rows):
+            yield df.iloc[inicio:inicio + self.chunk_rows]
+
+    # --- conversões vetorizadas ---
+
+    @staticmethod
+    def _as_number(serie: Any) -> Any:
+        import pandas as pd
+        valores = pd.to_numeric(serie, errors='coerce')
+        if not pd.api.types.is_numeric_dtype(serie) and valores.notna().mean() < 0.9:
+            texto = (serie.astype(str).str.replace(r'[R$\s%]', '', regex=True)
+                     .str.replace('.', '', regex=False).str.replace(',', '.', regex=False))
+            valores = pd.to_numeric(texto, errors='coerce')
+        return valores
+
+    def _as_date(self, coluna: str, serie: Any) -> Any:
+        import pandas as pd
+        return pd.to_datetime(serie, errors='coerce', format=self.formatos_data.get(coluna))
+
+    @staticmethod
+    def _date_format(amostra: Any) -> Tuple[bool, Optional[str]]:
+        """(é data?, formato explícito) decidido sobre uma amostra da coluna"""
+        import pandas as pd
+        if pd.api.types.is_datetime64_any_dtype(amostra):
+            return True, None
+        if amostra.map(lambda v: isinstance(v, datetime)).mean() >= 0.9:
+            return True, None
+        texto = amostra.astype(str)
+        for formato in UPLOAD_DATE_FORMATS:
+            if pd.to_datetime(texto, errors='coerce', format=formato).notna().mean() >= 0.9:
+                return True, formato
+        return False, None
+
+    def _detect(self, chunk: Any) -> None:
+        import pandas as pd
+        for coluna in chunk.columns:
+            amostra = chunk[coluna].dropna().head(500)
+            if amostra.empty or pd.api.types.is_bool_dtype(amostra):
+                tipo = 'texto'
+            elif pd.api.types.is_numeric_dtype(amostra):
+                tipo = 'numero'
+            else:
+                e_data, formato = self._date_format(amostra)
+                if e_data:
+                    tipo = 'data'
+                    self.formatos_data[coluna] = formato
+                elif self._as_number(amostra).notna().mean() >= 0.9:
+                    tipo = 'numero'
+                else:
+                    tipo = 'texto'
+            self.tipos[coluna] = tipo
+            self.stats[coluna] = {'nulos': 0, 'validos': 0}
+
+        datas = [c for c, t in self.tipos.items() if t == 'data']
+        numeros = [c for c, t in self.tipos.items() if t == 'numero' and not _ID_HINTS.search(str(c))]
+        self.coluna_data = datas[0] if datas else None
+        preferidas = [c for c in numeros if _VALUE_HINTS.search(str(c))]
+        self.colunas_valor = (preferidas or numeros)[:UPLOAD_MAX_VALUE_COLUMNS]
+        self.mensal = {c: Counter() for c in self.colunas_valor} if self.coluna_data else {}
+        self.series = {c: [] for c in self.colunas_valor}
+        textos = [c for c, t in self.tipos.items() if t == 'texto']
+        self.coluna_rotulo = textos[0] if textos else None
+        self.amostra = chunk.head(UPLOAD_SAMPLE_ROWS).to_string(max_colwidth=30)
+
+    def _add_rubricas(self, rotulos: Any, valores: Any) -> None:
+        """Soma as linhas de demonstrativo (Ativo Circulante, EBITDA...) reconhecidas pelo rótulo"""
+        rotulos = (rotulos.astype(str).str.normalize('NFKD').str.encode('ascii', 'ignore')
+                   .str.decode('ascii').str.lower().str.strip())
+        for chave, padrao in FINANCE_RUBRICAS.items():
+            mascara = rotulos.str.match(padrao)
+            if mascara.any():
+                self.rubricas[chave] = self.rubricas.get(chave, 0.0) + float(valores[mascara].sum())
+
+    # --- acumulação por bloco ---
+
+    def _add(self, chunk: Any) -> None:
+        import pandas as pd
+        if not self.tipos:
+            self._detect(chunk)
+        self.linhas += len(chunk)
+        numeros: Dict[str, Any] = {}
+        for coluna, tipo in self.tipos.items():
+            st_col = self.stats[coluna]
+            serie = chunk[coluna]
+            if tipo == 'numero':
+                valores = numeros[coluna] = self._as_number(serie)
+                validos = int(valores.notna().sum())
+                if validos:
+                    st_col['soma'] = st_col.get('soma', 0.0) + float(valores.sum())
+                    st_col['min'] = min(st_col.get('min', math.inf), float(valores.min()))
+                    st_col['max'] = max(st_col.get('max', -math.inf), float(valores.max()))
+            elif tipo == 'data':
+                valores = self._as_date(coluna, serie)
+                if coluna == self.coluna_data:
+                    datas = valores
+                validos = int(valores.notna().sum())
+                if validos:
+                    st_col['min'] = min(st_col.get('min', valores.min()), valores.min())
+                    st_col['max'] = max(st_col.get('max', valores.max()), valores.max())
+            else:
+                contagem = serie.dropna().astype(str).value_counts()
+                validos = int(contagem.sum())
+                categorias = st_col.setdefault('categorias', Counter())
+                categorias.update(contagem.to_dict())
+                if len(categorias) > UPLOAD_CATEGORY_CAP:
+                    st_col['categorias'] = Counter(dict(categorias.most_common(UPLOAD_CATEGORY_CAP // 2)))
+                    st_col['aproximado'] = True
+            st_col['validos'] += validos
+            st_col['nulos'] += len(serie) - validos
+
+        for coluna, serie in self.series.items():
+            falta = UPLOAD_SERIES_ROWS - len(serie)
+            if falta > 0:
+                serie.extend(numeros[coluna].iloc[:falta].fillna(0.0).tolist())
+        # Demonstrativos são pequenos: rótulos só são examinados nas primeiras linhas
+        if self.coluna_rotulo is not None and self.colunas_valor and self.linhas <= FINANCE_MAX_STATEMENT_ROWS:
+            self._add_rubricas(chunk[self.coluna_rotulo], numeros[self.colunas_valor[0]])
+
+        if self.mensal:
+            meses = datas.dt.to_period('M')
+            frame = pd.DataFrame({c: numeros[c] for c in self.colunas_valor})
+            agrupado = frame.groupby(meses).sum(min_count=1)
+            for coluna in self.colunas_valor:
+                self.mensal[coluna].update({str(mes): float(v) for mes, v in agrupado[coluna].dropna().items()})
+
+    def _result(self, nome: str) -> Dict[str, Any]:
+        colunas = []
+        for coluna, tipo in self.tipos.items():
+            st_col = dict(self.stats[coluna], nome=str(coluna), tipo=tipo)
+            if 'categorias' in st_col:
+                st_col['distintos'] = len(st_col['categorias'])
+                st_col['top'] = st_col.pop('categorias').most_common(UPLOAD_TOP_CATEGORIES)
+            if tipo == 'numero' and st_col['validos']:
+                st_col['media'] = st_col['soma'] / st_col['validos']
+            colunas.append(st_col)
+        meses = sorted({m for serie in self.mensal.values() for m in serie})[-UPLOAD_MAX_MONTHS:]
+        return {
+            'arquivo': nome,
+            'linhas': self.linhas,
+            'total_colunas': self.total_colunas,
+            'parcial': self.parcial,
+            'colunas': colunas,
+            'coluna_data': self.coluna_data,
+            'colunas_valor': self.colunas_valor,
+            'mensal': {c: {m: self.mensal[c].get(m, 0.0) for m in meses} for c in self.mensal},
+            'series': self.series,
+            'rubricas': self.rubricas,
+            'amostra': self.amostra,
+        }
+
+    @staticmethod
+    def summarize(perfil: Dict[str, Any], token_budget: int = UPLOAD_TOKEN_BUDGET) -> str:
+        """Texto compacto para o prompt: seções em ordem de prioridade até esgotar o orçamento"""
+        cabecalho = f"{perfil['linhas']:,} linhas × {perfil['total_colunas']} colunas".replace(',', '.')
+        if perfil['total_colunas'] > len(perfil['colunas']):
+            cabecalho += f" (primeiras {len(perfil['colunas'])} analisadas)"
+        if perfil.get('parcial'):
+            cabecalho += f" — resumo parcial: só as primeiras {UPLOAD_XLS_MAX_ROWS:,} linhas do .xls foram lidas".replace(',', '.')
+        linhas = [cabecalho]
+        if perfil['coluna_data']:
+            linhas.append(f"Coluna de data: {perfil['coluna_data']}")
+        if perfil['colunas_valor']:
+            linhas.append(f"Colunas de valor: {', '.join(map(str, perfil['colunas_valor']))}")
+
+        linhas.append("COLUNAS:")
+        for c in perfil['colunas']:
+            nulos = f" · nulos {c['nulos']}" if c['nulos'] else ""
+            if c['tipo'] == 'numero' and c['validos']:
+                linhas.append(f"- {c['nome']} [número] soma {_fmt_num(c['soma'])} · média {_fmt_num(c['media'])} · "
+                              f"mín {_fmt_num(c['min'])} · máx {_fmt_num(c['max'])}{nulos}")
+            elif c['tipo'] == 'data' and c['validos']:
+                linhas.append(f"- {c['nome']} [data] {c['min']:%Y-%m-%d} a {c['max']:%Y-%m-%d}{nulos}")
+            elif c['tipo'] == 'texto' and c['validos']:
+                top = ", ".join(f"{valor[:30]} ({n})" for valor, n in c['top'])
+                distintos = f"mais de {UPLOAD_CATEGORY_CAP}" if c.get('aproximado') else str(c['distintos'])
+                linhas.append(f"- {c['nome']} [texto] {distintos} distintos · top: {top}{nulos}")
+            else:
+                linhas.append(f"- {c['nome']} [vazia]")
+
+        if perfil['mensal']:
+            colunas = list(perfil['mensal'])
+            linhas.append(f"AGREGADO MENSAL ({perfil['coluna_data']}; soma de {', '.join(map(str, colunas))}):")
+            meses = list(next(iter(perfil['mensal'].values())))
+            # Os meses mais recentes são os mais relevantes: entram primeiro quando o orçamento aperta
+            mensais = [f"{m}: " + " | ".join(_fmt_num(perfil['mensal'][c][m]) for c in colunas) for m in meses]
+        else:
+            mensais = []
+
+        orcamento = token_budget
+        saida: List[str] = []
+        for linha in linhas:
+            custo = _estimate_tokens(linha)
+            if custo > orcamento:
+                break
+            saida.append(linha)
+            orcamento -= custo
+        recentes: List[str] = []
+        for linha in reversed(mensais):
+            custo = _estimate_tokens(linha)
+            if custo > orcamento:
+                break
+            recentes.append(linha)
+            orcamento -= custo
+        saida.extend(reversed(recentes))
+        amostra = f"AMOSTRA ({UPLOAD_SAMPLE_ROWS} primeiras linhas):\n{perfil['amostra']}"
+        if _estimate_tokens(amostra) <= orcamento:
+            saida.append(amostra)
+        return "\n".join(saida)
+
+
+# ✅ MOTOR FINANCEIRO: cálculos determinísticos (NumPy) sobre a planilha e a foto de mercado
+FINANCE_SELIC_FALLBACK = 0.15        # usada só quando a SELIC do serviço de mercado não está disponível
+FINANCE_TERMINAL_GROWTH = 0.035      # g do valor terminal quando o IPCA não está disponível
+FINANCE_BETA = 1.0
+FINANCE_MARKET_PREMIUM = 0.05        # Rm - Rf do CAPM
+FINANCE_DEBT_SPREAD = 0.03           # Kd = SELIC + spread
+FINANCE_TAX_RATE = 0.34              # IR + CSLL
+FINANCE_DEBT_WEIGHT = 0.40           # D/V quando a planilha não traz dívida e PL
+FINANCE_SENSITIVITY_BP = 0.02        # VPL recalculado com a taxa ±2 p.p.
+FINANCE_IRR_ITERATIONS = 100
+FINANCE_MAX_STATEMENT_ROWS = 2000
+
+# Rubrica -> padrão do rótulo (minúsculo, sem acento) em demonstrativos no formato conta/valor
+FINANCE_RUBRICAS: Dict[str, str] = {
+    'receita': r'(receita|faturamento)( operacional)?( liquida| bruta| total)?$',
+    'lucro_liquido': r'(lucro|resultado) liquido',
+    'ativo_total': r'ativo( total)?$',
+    'patrimonio_liquido': r'patrimonio liquido',
+    'ativo_circulante': r'ativo circulante',
+    'passivo_circulante': r'passivo circulante',
+    'estoques': r'estoques?$',
+    'disponibilidades': r'(disponibilidades|caixa e equivalentes|caixa$)',
+    'divida': r'(divida bruta|divida$|emprestimos e financiamentos)',
+    'ebitda': r'(ebitda|lajida)',
+    'despesas_financeiras': r'despesas? financeiras?',
+    'nopat': r'nopat',
+    'capital_investido': r'capital investido',
+}
+_ENTRADA_HINTS = re.compile(r'entrada|receita|recebimento', re.I)
+_SAIDA_HINTS = re.compile(r'sa[ií]da|despesa|custo|pagamento', re.I)
+
+
+def _fmt_pct(valor: Optional[float]) -> str:
+    return f"{valor * 100:.2f}%".replace('.', ',') if valor is not None else "n/d"
+
+
+def _fmt_razao(valor: float) -> str:
+    return f"{valor:.2f}".replace('.', ',')
+
+
+def _fmt_periodos(valor: Optional[float], investimento_inicial: bool = True) -> str:
+    """Payback: sem saída no período 0 não há o que recuperar, o que é diferente de nunca recuperar"""
+    if not investimento_inicial:
+        return "n/a (sem investimento inicial)"
+    if valor is None:
+        return "não recupera no horizonte"
+    return f"{valor:.1f} períodos".replace('.', ',')
+
+
+def _taxa(valor: Any) -> Optional[float]:
+    """'15.00%' / '10,5' / 0.105 -> 0.15 / 0.105 / 0.105"""
+    try:
+        numero = float(str(valor).replace('%', '').replace(',', '.').strip())
+    except (TypeError, ValueError):
+        return None
+    return numero / 100 if numero > 1 or '%' in str(valor) else numero
+
+
+class FinanceEngine:
+    """Indicadores financeiros calculados localmente, sem pedir aritmética ao modelo.
+
+    As funções de fluxo de caixa recebem matrizes (séries × períodos, período 0 = investimento) e
+    avaliam todas as séries de uma vez; a TIR usa bisseção vetorizada, que sempre converge quando
+    há troca de sinal no intervalo.
+    """
+
+    @staticmethod
+    def _fluxos(flows: Any) -> Any:
+        import numpy as np
+        return np.atleast_2d(np.asarray(flows, dtype=float))
+
+    @staticmethod
+    def npv(rates: Any, flows: Any) -> Any:
+        import numpy as np
+        flows = FinanceEngine._fluxos(flows)
+        rates = np.asarray(rates, dtype=float).reshape(-1, 1)
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            fatores = (1.0 + rates) ** -np.arange(flows.shape[1])
+            # Períodos zerados (séries completadas com 0) não contam: 0 × inf viraria NaN com taxas próximas de −100%
+            return np.where(flows != 0, flows * fatores, 0.0).sum(axis=1)
+
+    @staticmethod
+    def irr(flows: Any, low: float = -0.99, high: float = 10.0) -> Any:
+        import numpy as np
+        flows = FinanceEngine._fluxos(flows)
+        lo = np.full(len(flows), low)
+        hi = np.full(len(flows), high)
+        npv_lo = FinanceEngine.npv(lo, flows)
+        npv_hi = FinanceEngine.npv(hi, flows)
+        valido = ~np.isnan(npv_lo) & ~np.isnan(npv_hi) & (np.sign(npv_lo) != np.sign(npv_hi))
+        for _ in range(FINANCE_IRR_ITERATIONS):
+            meio = (lo + hi) / 2
+            npv_meio = FinanceEngine.npv(meio, flows)
+            mesmo_lado = np.sign(npv_meio) == np.sign(npv_lo)
+            lo = np.where(mesmo_lado, meio, lo)
+            npv_lo = np.where(mesmo_lado, npv_meio, npv_lo)
+            hi = np.where(mesmo_lado, hi, meio)
+        return np.where(valido, (lo + hi) / 2, np.nan)
+
+    @staticmethod
+    def mirr(flows: Any, finance_rate: float, reinvest_rate: float) -> Any:
+        import numpy as np
+        flows = FinanceEngine._fluxos(flows)
+        n = flows.shape[1]
+        t = np.arange(n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vp_negativos = -(np.where(flows < 0, flows, 0.0) / (1 + finance_rate) ** t).sum(axis=1)
+            vf_positivos = (np.where(flows > 0, flows, 0.0) * (1 + reinvest_rate) ** (n - 1 - t)).sum(axis=1)
+            resultado = (vf_positivos / vp_negativos) ** (1 / max(n - 1, 1)) - 1
+        return np.where((vp_negativos > 0) & (vf_positivos > 0), resultado, np.nan)
+
+    @staticmethod
+    def payback(flows: Any, rate: Optional[float] = None) -> Any:
+        """Períodos até o acumulado ficar positivo (interpolado); descontado quando `rate` é dado"""
+        import numpy as np
+        flows = FinanceEngine._fluxos(flows)
+        if rate is not None:
+            flows = flows * (1.0 + rate) ** -np.arange(flows.shape[1])
+        acumulado = np.cumsum(flows, axis=1)
+        positivo = acumulado >= 0
+        idx = positivo.argmax(axis=1)
+        linhas = np.arange(len(flows))
+        valido = positivo.any(axis=1) & (idx > 0) & (flows[:, 0] < 0)
+        anterior = acumulado[linhas, np.maximum(idx - 1, 0)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fracao = -anterior / flows[linhas, idx]
+        return np.where(valido, idx - 1 + fracao, np.nan)
+
+    @staticmethod
+    def capm(rf: Any, beta: Any = FINANCE_BETA, premium: Any = FINANCE_MARKET_PREMIUM) -> Any:
+        return rf + beta * premium
+
+    @staticmethod
+    def wacc(equity: Any, debt: Any, ke: Any, kd: Any, tax: Any = FINANCE_TAX_RATE) -> Any:
+        total = equity + debt
+        return equity / total * ke + debt / total * kd * (1 - tax)
+
+    @staticmethod
+    def dcf(flows: Any, rate: float, growth: float) -> Dict[str, float]:
+        """Fluxos anuais descontados na mesma convenção do VPL (o primeiro em t = 0, sem desconto)
+        mais valor terminal de Gordon sobre o último fluxo, trazido de t = n − 1"""
+        import numpy as np
+        flows = np.asarray(flows, dtype=float)
+        vp_fluxos = float(FinanceEngine.npv(rate, flows)[0])
+        terminal = flows[-1] * (1 + growth) / (rate - growth)
+        vp_terminal = float(terminal / (1 + rate) ** (len(flows) - 1))
+        return {'vp_fluxos': vp_fluxos, 'vp_terminal': vp_terminal, 'valor': vp_fluxos + vp_terminal}
+
+    @staticmethod
+    def dupont(lucro: float, receita: float, ativo: float, pl: float) -> Dict[str, float]:
+        margem, giro, alavancagem = lucro / receita, receita / ativo, ativo / pl
+        return {'margem_liquida': margem, 'giro_ativo': giro, 'alavancagem': alavancagem,
+                'roe': margem * giro * alavancagem}
+
+    @staticmethod
+    def _series_de_caixa(perfil: Dict[str, Any]) -> Tuple[str, Dict[str, List[float]]]:
+        """Séries candidatas a fluxo de caixa: somas mensais quando há data; senão, linha a linha"""
+        if perfil.get('mensal'):
+            periodicidade, series = 'mensal', {c: list(v.values()) for c, v in perfil['mensal'].items()}
+        else:
+            periodicidade, series = 'período', {c: list(v) for c, v in perfil.get('series', {}).items()}
+        entradas = [c for c in series if _ENTRADA_HINTS.search(str(c))]
+        saidas = [c for c in series if _SAIDA_HINTS.search(str(c))]
+        if entradas and saidas:
+            series = {f"{entradas[0]} − {saidas[0]}": [e - s for e, s in zip(series[entradas[0]], series[saidas[0]])]}
+        return periodicidade, {c: v for c, v in series.items() if len(v) >= 2}
+
+    @staticmethod
+    def _rubricas(perfil: Dict[str, Any]) -> Dict[str, float]:
+        rubricas = dict(perfil.get('rubricas') or {})
+        # Demonstrativo em uma linha só, com uma coluna por conta
+        if perfil.get('linhas') == 1:
+            for coluna in perfil.get('colunas', []):
+                nome = unicodedata.normalize('NFKD', coluna['nome'].lower()).encode('ascii', 'ignore').decode().strip()
+                for chave, padrao in FINANCE_RUBRICAS.items():
+                    if chave not in rubricas and coluna.get('soma') is not None and re.match(padrao, nome):
+                        rubricas[chave] = coluna['soma']
+        return rubricas
+
+    @staticmethod
+    def analyze(perfil: Optional[Dict[str, Any]], mercado: Dict[str, Any]) -> Dict[str, Any]:
+        import numpy as np
+        premissas: List[str] = []
+        selic = _taxa(mercado.get('selic'))
+        if selic is None:
+            selic = FINANCE_SELIC_FALLBACK
+            premissas.append(f"SELIC indisponível: usada {_fmt_pct(selic)}")
+        ipca_mensal = _taxa(mercado.get('ipca'))
+        crescimento = (1 + ipca_mensal) ** 12 - 1 if ipca_mensal is not None else FINANCE_TERMINAL_GROWTH
+
+        rubricas = FinanceEngine._rubricas(perfil) if perfil else {}
+        ke = FinanceEngine.capm(selic)
+        kd = selic + FINANCE_DEBT_SPREAD
+        if rubricas.get('divida', 0) > 0 and rubricas.get('patrimonio_liquido', 0) > 0:
+            pesos = (rubricas['patrimonio_liquido'], rubricas['divida'])
+        else:
+            pesos = (1 - FINANCE_DEBT_WEIGHT, FINANCE_DEBT_WEIGHT)
+            premissas.append(f"Estrutura de capital padrão: {FINANCE_DEBT_WEIGHT:.0%} dívida")
+        wacc = float(FinanceEngine.wacc(pesos[0], pesos[1], ke, kd))
+        relatorio: Dict[str, Any] = {
+            'taxas': {'selic': selic, 'ke': ke, 'kd': kd, 'wacc': wacc, 'crescimento': crescimento},
+            'fluxos': [], 'dcf': None, 'indicadores': {}, 'dupont': None, 'premissas': premissas,
+        }
+
+        # Demonstrativo (contas reconhecidas) não é série de caixa
+        periodicidade, series = FinanceEngine._series_de_caixa(perfil) if perfil and len(rubricas) < 2 else ('', {})
+        if series:
+            nomes = list(series)
+            tamanho = max(len(v) for v in series.values())
+            flows = np.zeros((len(nomes), tamanho))
+            for i, nome in enumerate(nomes):
+                flows[i, :len(series[nome])] = series[nome]
+            if periodicidade == 'mensal':
+                taxa = (1 + selic) ** (1 / 12) - 1
+            else:
+                taxa = selic
+                premissas.append("Linhas tratadas como períodos anuais")
+            # Todas as séries × (taxa − Δ, taxa, taxa + Δ) numa única avaliação
+            deltas = np.array([-FINANCE_SENSITIVITY_BP, 0.0, FINANCE_SENSITIVITY_BP])
+            taxas = ((1 + selic + deltas) ** (1 / 12) - 1) if periodicidade == 'mensal' else selic + deltas
+            vpls = FinanceEngine.npv(np.tile(taxas, len(nomes)), np.repeat(flows, 3, axis=0)).reshape(len(nomes), 3)
+            tirs = FinanceEngine.irr(flows)
+            mtirs = FinanceEngine.mirr(flows, taxa, taxa)
+            paybacks = FinanceEngine.payback(flows)
+            descontados = FinanceEngine.payback(flows, taxa)
+            for i, nome in enumerate(nomes):
+                relatorio['fluxos'].append({
+                    'serie': str(nome), 'periodicidade': periodicidade, 'periodos': len(series[nome]),
+                    'taxa_periodo': taxa, 'vpl': vpls[i, 1], 'vpl_taxa_menor': vpls[i, 0], 'vpl_taxa_maior': vpls[i, 2],
+                    'tir': tirs[i], 'mtir': mtirs[i], 'payback': paybacks[i], 'payback_descontado': descontados[i],
+                    'investimento_inicial': bool(flows[i, 0] < 0),
+                })
+            principal = flows[0, :len(series[nomes[0]])]
+            if periodicidade == 'mensal':
+                # Só anos completos, contados a partir do mês mais recente
+                completos = len(principal) // 12 * 12
+                anuais = principal[len(principal) - completos:].reshape(-1, 12).sum(axis=1)
+            else:
+                anuais = principal
+            if len(anuais) and wacc > crescimento:
+                relatorio['dcf'] = FinanceEngine.dcf(anuais, wacc, crescimento)
+
+        r = rubricas
+        def razao(a: str, b: str) -> Optional[float]:
+            return r[a] / r[b] if r.get(a) is not None and r.get(b) else None
+        indicadores = {
+            'Liquidez Corrente': razao('ativo_circulante', 'passivo_circulante'),
+            'Liquidez Imediata': razao('disponibilidades', 'passivo_circulante'),
+            'Cobertura de Juros (EBITDA/Desp. Fin.)': razao('ebitda', 'despesas_financeiras'),
+            'Dívida/PL': razao('divida', 'patrimonio_liquido'),
+        }
+        if r.get('ativo_circulante') is not None and r.get('estoques') is not None and r.get('passivo_circulante'):
+            indicadores['Liquidez Seca'] = (r['ativo_circulante'] - r['estoques']) / r['passivo_circulante']
+        if r.get('divida') is not None and r.get('ebitda'):
+            indicadores['Dívida Líquida/EBITDA'] = (r['divida'] - r.get('disponibilidades', 0.0)) / r['ebitda']
+        if r.get('nopat') is not None and r.get('capital_investido') is not None:
+            indicadores['EVA'] = r['nopat'] - r['capital_investido'] * wacc
+        relatorio['indicadores'] = {k: v for k, v in indicadores.items() if v is not None}
+        if all(r.get(k) for k in ('lucro_liquido', 'receita', 'ativo_total', 'patrimonio_liquido')):
+            relatorio['dupont'] = FinanceEngine.dupont(r['lucro_liquido'], r['receita'], r['ativo_total'],
+                                                       r['patrimonio_liquido'])
+        return FinanceEngine._plain(relatorio)
+
+    @staticmethod
+    def _plain(valor: Any) -> Any:
+        """float nativo (NaN -> None) em toda a estrutura: o relatório vai para a sessão e para o prompt"""
+        if isinstance(valor, dict):
+            return {k: FinanceEngine._plain(v) for k, v in valor.items()}
+        if isinstance(valor, list):
+            return [FinanceEngine._plain(v) for v in valor]
+        if isinstance(valor, int):
+            return valor
+        if isinstance(valor, float) or type(valor).__module__ == 'numpy':
+            numero = float(valor)
+            return None if math.isnan(numero) or math.isinf(numero) else numero
+        return valor
+
+    @staticmethod
+    def summarize(relatorio: Dict[str, Any]) -> str:
+        """Bloco de texto para o prompt, com os números prontos"""
+        pct, per = _fmt_pct, _fmt_periodos
+        taxas = relatorio['taxas']
+        linhas = [f"Taxas: SELIC {pct(taxas['selic'])} · Ke (CAPM) {pct(taxas['ke'])} · Kd {pct(taxas['kd'])} · "
+                  f"WACC {pct(taxas['wacc'])} · g {pct(taxas['crescimento'])}"]
+        for f in relatorio['fluxos']:
+            linhas.append(
+                f"Fluxo '{f['serie']}' ({f['periodos']} períodos, {f['periodicidade']}): VPL {_fmt_num(f['vpl'])} "
+                f"(taxa ±{FINANCE_SENSITIVITY_BP * 100:.0f} p.p.: {_fmt_num(f['vpl_taxa_maior'])} a {_fmt_num(f['vpl_taxa_menor'])}) · "
+                f"TIR {pct(f['tir'])} por período · MTIR {pct(f['mtir'])} · " + (
+                    f"payback {per(f['payback'])} (descontado: {per(f['payback_descontado'])})"
+                    if f['investimento_inicial'] else f"payback {per(None, False)}"))
+        if relatorio['dcf']:
+            d = relatorio['dcf']
+            linhas.append(f"DCF (WACC, anual; primeiro fluxo em t = 0, como no VPL): VP fluxos {_fmt_num(d['vp_fluxos'])} + VP terminal "
+                          f"{_fmt_num(d['vp_terminal'])} = {_fmt_num(d['valor'])}")
+        if relatorio['dupont']:
+            d = relatorio['dupont']
+            linhas.append(f"DuPont: margem {pct(d['margem_liquida'])} × giro {_fmt_razao(d['giro_ativo'])} × "
+                          f"alavancagem {_fmt_razao(d['alavancagem'])} = ROE {pct(d['roe'])}")
+        for nome, valor in relatorio['indicadores'].items():
+            linhas.append(f"{nome}: {_fmt_num(valor) if nome == 'EVA' else _fmt_razao(valor)}")
+        if relatorio['premissas']:
+            linhas.append("Premissas: " + "; ".join(relatorio['premissas']))
+        return "\n".join(linhas)
+
+
+# ✅ SIMULAÇÃO DA ÁRVORE: Monte Carlo vetorizado e tornado sobre os ramos de `componentes`
+SIM_DRAWS = 20_000
+SIM_SEED = 20240601                  # semente fixa: a mesma estratégia produz sempre os mesmos números
+SIM_FATORES = ('cambio', 'selic', 'ipca')
+SIM_NOMES_FATORES = {'cambio': 'Câmbio (USDBRL)', 'selic': 'SELIC', 'ipca': 'IPCA'}
+SIM_VOLATILIDADES = (0.15, 0.20, 0.25)                 # desvio relativo de cada fator no horizonte da decisão
+SIM_CORRELACOES = ((1.0, 0.3, 0.4), (0.3, 1.0, 0.5), (0.4, 0.5, 1.0))
+SIM_PERCENTIS = (5, 50, 95)
+
+
+class TreeSimulator:
+    """Avalia numericamente a árvore de decisão sem nova chamada ao modelo.
+
+    Cada nó com `valor_estimado` vale `valor × (1 + Σ sensibilidade_k × choque_k)`, com choques
+    relativos de câmbio, SELIC e IPCA sorteados de uma normal multivariada correlacionada. Nós sem
+    valor próprio combinam os filhos pela probabilidade (pesos iguais se faltar). Os sorteios, o
+    cenário base e os cenários do tornado (±1 desvio em um fator por vez) formam uma única matriz
+    de choques que atravessa a árvore uma vez, de forma vetorizada.
+    """
+
+    @staticmethod
+    def _choques(draws: int, seed: int = SIM_SEED) -> Any:
+        import numpy as np
+        sigma = np.array(SIM_VOLATILIDADES)
+        covariancia = np.array(SIM_CORRELACOES) * np.outer(sigma, sigma)
+        sorteios = np.random.default_rng(seed).multivariate_normal(np.zeros(len(sigma)), covariancia, size=draws)
+        tornado = np.repeat(np.diag(sigma), 2, axis=0) * np.tile([-1.0, 1.0], len(sigma))[:, None]
+        return np.vstack([sorteios, np.zeros((1, len(sigma))), tornado])
+
+    @staticmethod
+    def _nos(componentes: Dict[str, Any]) -> List[Tuple[Dict[str, Any], int, int]]:
+        """(nó, índice do pai, nível) em pré-ordem: todo filho vem depois do pai"""
+        nos: List[Tuple[Dict[str, Any], int, int]] = []
+        pilha = [(componentes, -1, 0)]
+        while pilha:
+            no, pai, nivel = pilha.pop()
+            indice = len(nos)
+            nos.append((no, pai, nivel))
+            for filho in reversed(no.get('filhos') or []):
+                if isinstance(filho, dict):
+                    pilha.append((filho, indice, nivel + 1))
+        return nos
+
+    @staticmethod
+    def run(componentes: Any, mercado: Dict[str, Any], draws: int = SIM_DRAWS) -> Optional[Dict[str, Any]]:
+        import numpy as np
+        if not isinstance(componentes, dict):
+            return None
+        nos = TreeSimulator._nos(componentes)
+        if not any(isinstance(no.get('valor_estimado'), (int, float)) for no, _, _ in nos):
+            return None
+
+        choques = TreeSimulator._choques(draws)
+        filhos: Dict[int, List[int]] = defaultdict(list)
+        for indice, (_, pai, _) in enumerate(nos):
+            if pai >= 0:
+                filhos[pai].append(indice)
+
+        valores: Dict[int, Any] = {}
+        for indice in reversed(range(len(nos))):  # pós-ordem: filhos antes do pai
+            no = nos[indice][0]
+            base = no.get('valor_estimado')
+            if isinstance(base, (int, float)):
+                sensibilidades = np.array([no.get(f'sensibilidade_{f}') or 0.0 for f in SIM_FATORES])
+                valores[indice] = base * (1.0 + choques @ sensibilidades)
+                continue
+            com_valor = [j for j in filhos[indice] if j in valores]
+            if com_valor:
+                pesos = np.array([nos[j][0].get('probabilidade') for j in com_valor], dtype=float)
+                if np.isnan(pesos).any() or pesos.sum() <= 0:
+                    pesos = np.ones(len(com_valor))
+                valores[indice] = np.stack([valores[j] for j in com_valor], axis=1) @ (pesos / pesos.sum())
+
+        indices = sorted(valores)
+        matriz = np.stack([valores[i] for i in indices])                  # nós × cenários
+        sorteios, base, tornado = matriz[:, :draws], matriz[:, draws], matriz[:, draws + 1:]
+        percentis = np.percentile(sorteios, SIM_PERCENTIS, axis=1)
+        esperados = sorteios.mean(axis=1)
+        prejuizo = (sorteios < 0).mean(axis=1)
+        variacoes = (tornado - base[:, None]).reshape(len(indices), len(SIM_FATORES), 2)
+
+        ramos = []
+        for linha, indice in enumerate(indices):
+            no, _, nivel = nos[indice]
+            impactos = [{'fator': SIM_NOMES_FATORES[f], 'baixa': float(variacoes[linha, k, 0]),
+                         'alta': float(variacoes[linha, k, 1])} for k, f in enumerate(SIM_FATORES)]
+            impactos.sort(key=lambda item: -abs(item['alta'] - item['baixa']))
+            ramos.append({
+                'ramo': no.get('condicao') or no.get('pergunta_raiz') or '', 'nivel': nivel,
+                'valor_base': float(base[linha]), 'valor_esperado': float(esperados[linha]),
+                **{f'p{p}': float(percentis[k, linha]) for k, p in enumerate(SIM_PERCENTIS)},
+                'prob_prejuizo': float(prejuizo[linha]), 'tornado': impactos,
+            })
+
+        primeiro_nivel = [r for r in ramos if r['nivel'] == 1]
+        return {
+            'sorteios': draws,
+            'fatores': [{'fator': SIM_NOMES_FATORES[f], 'base': mercado.get({'cambio': 'dolar'}.get(f, f), 'N/D'),
+                         'volatilidade': v} for f, v in zip(SIM_FATORES, SIM_VOLATILIDADES)],
+            'ramos': ramos,
+            'melhor_ramo': max(primeiro_nivel, key=lambda r: r['valor_esperado'])['ramo'] if primeiro_nivel else None,
+        }
+
+
+# ✅ DIAGRAMA DA ÁRVORE: DOT → SVG fora da thread do script, em cache pelo hash do grafo
+GRAPH_MAX_NODES = 40            # nós desenhados; o excedente vira um nó "+N ramos" recolhido
+GRAPH_DEFAULT_DEPTH = 2         # níveis abertos por padrão; ramos mais fundos começam recolhidos
+GRAPH_LABEL_CHARS = 60
+GRAPH_CACHE_ENTRIES = 64
+GRAPH_WORKERS = 2
+GRAPH_WAIT_SECONDS = 2.0        # espera máxima do script pelo layout antes de cair para o texto
+GRAPH_CORES = ('#667eea', '#764ba2', '#2d3748')   # raiz, nível 1, demais níveis
+
+
+def _rotulo_curto(texto: Any, limite: int = GRAPH_LABEL_CHARS) -> str:
+    texto = " ".join(str(texto).split())
+    return texto[:limite - 1] + "…" if len(texto) > limite else texto
+
+
+def _dot_texto(texto: Any, limite: int = GRAPH_LABEL_CHARS) -> str:
+    return _rotulo_curto(texto, limite).replace('\\', '\\\\').replace('"', '\\"')
+
+
+class TreeDiagram:
+    """Layout Graphviz da árvore de `componentes`, calculado num pool próprio.
+
+    O SVG fica num LRU de futures indexado pelo hash do DOT: reruns, turnos do chat e sessões
+    com a mesma árvore reaproveitam o layout; o pipeline já dispara o cálculo ao terminar o job.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, Future]" = OrderedDict()
+        self._pool = ThreadPoolExecutor(max_workers=GRAPH_WORKERS, thread_name_prefix="arvore-svg")
+
+    @staticmethod
+    @st.cache_resource(show_spinner=False)
+    def shared() -> "TreeDiagram":
+        return TreeDiagram()
+
+    @staticmethod
+    def _tamanho(node: Any) -> int:
+        total, pilha = 0, [node]
+        while pilha:
+            atual = pilha.pop()
+            if isinstance(atual, dict):
+                total += 1
+                filhos = atual.get('filhos')
+                if isinstance(filhos, list):
+                    pilha.extend(filhos)
+        return total
+
+    @staticmethod
+    def _filhos(node: Dict) -> List[Dict]:
+        filhos = node.get('filhos')
+        return [f for f in filhos if isinstance(f, dict)] if isinstance(filhos, list) else []
+
+    @staticmethod
+    def branches(componentes: Dict) -> List[Tuple[str, str]]:
+        """(caminho, rótulo) dos ramos que começam recolhidos: as opções de expansão"""
+        ramos: List[Tuple[str, str]] = []
+        pilha: List[Tuple[Dict, str, int]] = [(componentes, "0", 0)]
+        while pilha:
+            node, caminho, nivel = pilha.pop()
+            filhos = TreeDiagram._filhos(node)
+            if filhos and nivel >= GRAPH_DEFAULT_DEPTH:
+                ramos.append((caminho, _rotulo_curto(node.get('condicao', ''), 40)))
+            pilha.extend((f, f"{caminho}.{i}", nivel + 1) for i, f in reversed(list(enumerate(filhos))))
+        return ramos
+
+    @staticmethod
+    def to_dot(componentes: Dict, expandidos: frozenset = frozenset()) -> str:
+        """DOT em largura (BFS): com o limite de nós, somem primeiro os níveis mais fundos"""
+        linhas = [
+            'digraph arvore {',
+            '  graph [rankdir=TB, bgcolor="transparent", nodesep=0.3, ranksep=0.4];',
+            '  node [shape=box, style="rounded,filled", fontname="Helvetica", fontsize=11, fontcolor="white", '
+            'color="#667eea", margin="0.15,0.08"];',
+            '  edge [color="#94A3B8", arrowsize=0.7];',
+        ]
+        fila = deque([(componentes, "0", 0)])
+        desenhados = 1
+        while fila:
+            node, caminho, nivel = fila.popleft()
+            nome = "n" + caminho.replace(".", "_")
+            if nivel == 0:
+                rotulo = f"❓ {_dot_texto(node.get('pergunta_raiz', 'Qual a decisão?'))}"
+            else:
+                rotulo = _dot_texto(node.get('condicao', ''))
+                if node.get('acao'):
+                    rotulo += f"\\n➡️ {_dot_texto(node['acao'])}"
+            linhas.append(f'  {nome} [label="{rotulo}", fillcolor="{GRAPH_CORES[min(nivel, 2)]}"];')
+            
+            filhos = TreeDiagram._filhos(node)
+            aberto = nivel < GRAPH_DEFAULT_DEPTH or caminho in expandidos
+            ocultos = 0
+            for i, filho in enumerate(filhos):
+                if aberto and desenhados < GRAPH_MAX_NODES:
+                    desenhados += 1
+                    fila.append((filho, f"{caminho}.{i}", nivel + 1))
+                    linhas.append(f'  {nome} -> {nome}_{i};')
+                else:
+                    ocultos += TreeDiagram._tamanho(filho)
+            if ocultos:
+                linhas.append(f'  {nome}_mais [label="+{ocultos} ramo(s) recolhido(s)", style="rounded,dashed", '
+                              f'fontcolor="#94A3B8", color="#94A3B8"];')
+                linhas.append(f'  {nome} -> {nome}_mais [style=dashed];')
+        linhas.append('}')
+        return "\n".join(linhas)
+
+    @staticmethod
+    def _layout(dot: str) -> str:
+        import graphviz
+        svg = graphviz.pipe('dot', 'svg', dot.encode()).decode()
+        svg = svg[svg.index('<svg'):]
+        # Largura fluida (celular) e sem linhas em branco, que encerrariam o bloco HTML do markdown
+        svg = re.sub(r'<svg width="[^"]*" height="[^"]*"', '<svg style="max-width: 100%; height: auto;"', svg, count=1)
+        return "\n".join(linha for linha in svg.splitlines() if linha.strip())
+
+    def svg(self, dot: str) -> Future:
+        """Future do SVG; falha (sem `graphviz`/`dot`) também fica em cache para não repetir a tentativa"""
+        chave = hashlib.sha256(dot.encode()).hexdigest()
+        with self._lock:
+            futuro = self._cache.get(chave)
+            if futuro is not None:
+                self._cache.move_to_end(chave)
+                return futuro
+            futuro = self._pool.submit(self._layout, dot)
+            self._cache[chave] = futuro
+            while len(self._cache) > GRAPH_CACHE_ENTRIES:
+                self._cache.popitem(last=False)
+            return futuro
+
+
+# ✅ PIPELINE DE ENVIO: etapas independentes em paralelo, LLM assim que as entradas ficam prontas
+PIPELINE_WORKERS = 8
+
+
+class StrategyPipeline:
+    """Orquestra o envio de um desafio.
+
+    Foto do mercado, recorte da base de conhecimento e leitura da planilha rodam em paralelo no
+    pool compartilhado; a chamada ao LLM começa assim que as três terminam. O tempo de cada etapa
+    fica em `tempos` e segue junto do resultado final.
+    """
+
+    def __init__(self, contexto: str, persona: str, upload: Optional[Tuple[str, bytes]] = None):
+        self.contexto = contexto
+        self.persona = persona
+        self.upload = upload
+        self.mercado: Dict[str, Any] = {}
+        self.kb = ''
+        self.planilha: Optional[Dict[str, Any]] = None
+        self.financeiro: Optional[Dict[str, Any]] = None
+        self.avisos: List[str] = []
+        self.tempos: Dict[str, float] = {}
+        # Serviços resolvidos na thread do script; as threads do pool só usam os objetos
+        self._market = MarketDataService.shared()
+        self._kb_service = KnowledgeBaseLoader.get_service()
+        self._pool = StrategyPipeline.executor()
+
+    @staticmethod
+    @st.cache_resource(show_spinner=False)
+    def executor() -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+
+    def _timed(self, etapa: str, func: Callable[..., Any], *args: Any) -> Any:
+        inicio = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.tempos[etapa] = time.perf_counter() - inicio
+
+    def _retrieve(self) -> str:
+        index = self._kb_service.index(wait=KB_WAIT_SECONDS)
+        return index.build_context(self.contexto, KB_TOP_K, KB_TOKEN_BUDGET)
+
+    def prepare(self) -> None:
+        inicio = time.perf_counter()
+        pool = self._pool
+        mercado = pool.submit(self._timed, 'mercado', lambda: self._market.latest().as_dict())
+        conhecimento = pool.submit(self._timed, 'conhecimento', self._retrieve)
+        planilha = pool.submit(self._timed, 'planilha', SpreadsheetProfiler.profile, *self.upload) if self.upload else None
+
+        self.mercado = mercado.result()
+        self.kb = conhecimento.result()
+        if planilha is not None:
+            try:
+                self.planilha = planilha.result()
+                resumo = SpreadsheetProfiler.summarize(self.planilha)
+                self.contexto += f"\n\n## DADOS DO ARQUIVO ({self.upload[0]}):\n{resumo}"
+            except Exception as e:
+                self.avisos.append(f"Erro ao ler arquivo: {e}")
+        # O job fica consultável por JOB_TTL: os bytes do upload não precisam viver tanto
+        self.upload = None
+        # Números calculados localmente entram prontos no prompt (planilha + SELIC do mercado)
+        try:
+            self.financeiro = self._timed('financeiro', FinanceEngine.analyze, self.planilha, self.mercado)
+            self.contexto += f"\n\n## CÁLCULOS FINANCEIROS (locais, use estes números):\n{FinanceEngine.summarize(self.financeiro)}"
+        except Exception as e:
+            self.avisos.append(f"Erro nos cálculos financeiros: {e}")
+        self.tempos['preparo'] = time.perf_counter() - inicio
+
+    def events(self, client: "LLMClient", streaming: bool = STRATEGY_STREAMING) -> Iterator[Tuple[str, Any]]:
+        """Mesmos eventos de `generate_strategy_stream`, mais ("aviso", texto) das etapas de preparo"""
+        self.prepare()
+        for aviso in self.avisos:
+            yield "aviso", aviso
+        inicio = time.perf_counter()
+        if streaming:
+            eventos = client.generate_strategy_stream(self.contexto, self.persona, self.mercado, self.kb)
+        else:
+            eventos = iter([("resultado", client.generate_strategy(self.contexto, self.persona, self.mercado, self.kb))])
+        for tipo, payload in eventos:
+            if tipo == "resultado":
+                self.tempos['llm'] = time.perf_counter() - inicio
+                simulacao = None
+                if not payload.get('error'):
+                    try:
+                        simulacao = self._timed('simulacao', TreeSimulator.run, payload.get('componentes'), self.mercado)
+                    except Exception as e:
+                        self.avisos.append(f"Erro na simulação da árvore: {e}")
+                    if isinstance(payload.get('componentes'), dict):
+                        # Layout do diagrama começa já; a fase 2 encontra o SVG no cache
+                        TreeDiagram.shared().svg(TreeDiagram.to_dot(payload['componentes']))
+                payload = {**payload, 'tempos': dict(self.tempos), 'financeiro': self.financeiro,
+                           'simulacao': simulacao}
+            yield tipo, payload
+
+
+# ✅ FILA DE JOBS: a geração roda fora do rerun do script e sobrevive a refresh
+JOB_WORKERS = 4               # chamadas simultâneas ao LLM nesta réplica
+JOB_QUEUE_MAX = 32            # jobs aguardando além dos que estão em execução
+# Envios por sessão (balde de tokens); ajustável por réplica via variável de ambiente
+JOB_RATE_PER_MINUTE = float(os.getenv('FINMENTOR_JOB_RATE_PER_MINUTE', '6'))
+JOB_RATE_BURST = 3
+JOB_TTL = 3600                # jobs terminados ficam consultáveis por 1 hora
+JOB_POLL_SECONDS = 1.0
+
+
+class JobRejected(Exception):
+    pass
+
+
+class StrategyJob:
+    """Estado de um job; `campos` é trocado por uma cópia a cada atualização (leitura sem lock)"""
+
+    def __init__(self, key_hash: str, pipeline: StrategyPipeline):
+        self.id = uuid.uuid4().hex
+        self.key_hash = key_hash
+        self.pipeline = pipeline
+        self.status = 'na_fila'  # na_fila -> executando -> concluido
+        self.campos: Dict[str, Any] = {}
+        self.avisos: List[str] = []
+        self.resultado: Optional[Dict[str, Any]] = None
+        self.criado_em = time.time()
+        self.terminado_em: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status == 'concluido'
+
+
+class StrategyJobQueue:
+    """Fila local de geração de estratégias: fila limitada, pool de workers com limite de
+    concorrência e limite de envios por sessão. Um pico excedente é recusado na hora, com
+    mensagem, em vez de acumular chamadas que estourariam o tempo."""
+
+    def __init__(self, workers: int = JOB_WORKERS, max_queue: int = JOB_QUEUE_MAX,
+                 rate_per_minute: float = JOB_RATE_PER_MINUTE, burst: int = JOB_RATE_BURST,
+                 clock: Callable[[], float] = time.monotonic):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self._clock = clock
+        self._queue: "queue.Queue[Tuple[StrategyJob, str]]" = queue.Queue(maxsize=max_queue)
+        self._jobs: Dict[str, StrategyJob] = {}
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        self._running = 0
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"strategy-job-{i}", daemon=True).start()
+
+    @staticmethod
+    @st.cache_resource(show_spinner=False)
+    def shared() -> "StrategyJobQueue":
+        return StrategyJobQueue()
+
+    @staticmethod
+    def key_hash(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+    def _take_token(self, cliente: str) -> float:
+        """Consome um envio do balde do cliente; devolve 0 ou os segundos até liberar o próximo"""
+        agora = self._clock()
+        tokens, ultimo = self._buckets.get(cliente, (float(self.burst), agora))
+        tokens = min(float(self.burst), tokens + (agora - ultimo) * self.rate)
+        if tokens < 1:
+            self._buckets[cliente] = (tokens, agora)
+            return (1 - tokens) / self.rate
+        self._buckets[cliente] = (tokens - 1, agora)
+        return 0.0
+
+    def _prune(self) -> None:
+        limite = time.time() - JOB_TTL
+        for job_id in [j.id for j in self._jobs.values() if j.done and j.terminado_em < limite]:
+            del self._jobs[job_id]
+
+    def submit(self, api_key: str, pipeline: StrategyPipeline, cliente: str) -> StrategyJob:
+        """`cliente` identifica o balde do limite (a sessão): no deploy com secrets.toml todos
+        compartilham a mesma chave, e um balde por chave limitaria a réplica inteira"""
+        key_hash = self.key_hash(api_key)
+        with self._lock:
+            self._prune()
+            # Só este método enfileira (sob o lock), então a checagem de cheia não tem corrida
+            if self._queue.full():
+                raise JobRejected("Servidor ocupado: fila de análises cheia. Tente novamente em instantes.")
+            espera = self._take_token(cliente)
+            if espera:
+                raise JobRejected(f"Muitas solicitações nesta sessão. Tente novamente em {math.ceil(espera)} s.")
+            job = StrategyJob(key_hash, pipeline)
+            self._jobs[job.id] = job
+            self._queue.put_nowait((job, api_key))
+        return job
+
+    def get(self, job_id: str) -> Optional[StrategyJob]:
+        return self._jobs.get(job_id)
+
+    def position(self, job: StrategyJob) -> int:
+        """Quantos jobs estão na fila à frente deste"""
+        with self._lock:
+            return sum(1 for j in self._jobs.values() if j.status == 'na_fila' and j.criado_em < job.criado_em)
+
+    def stats(self) -> Dict[str, int]:
+        return {'fila': self._queue.qsize(), 'executando': self._running,
+                'limite': self.workers, 'capacidade': self.max_queue}
+
+    def _work(self) -> None:
+        while True:
+            job, api_key = self._queue.get()
+            with self._lock:
+                self._running += 1
+            job.status = 'executando'
+            try:
+                resultado = None
+                for tipo, payload in job.pipeline.events(LLMClient(api_key)):
+                    if tipo == "campo":
+                        campo, valor = payload
+                        job.campos = {**job.campos, campo: valor}
+                    elif tipo == "aviso":
+                        job.avisos = job.avisos + [payload]
+                    else:
+                        resultado = payload
+                job.resultado = resultado or {"error": True, "message": "A geração foi interrompida antes de terminar."}
+            except Exception as e:
+                job.resultado = {"error": True, "message": f"Erro inesperado: {str(e)}"}
+            finally:
+                job.terminado_em = time.time()
+                job.status = 'concluido'
+                with self._lock:
+                    self._running -= 1
+                self._queue.task_done()
+
+
+# ✅ TEMPLATES EXCEL: endereçados pelo conteúdo, memoizados e gerados só no clique do download
+EXCEL_CACHE_ENTRIES = 64
+EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def _deferred_downloads() -> bool:
+    """st.download_button aceita um callable em `data` (executado só no clique) quando o gerenciador de
+    mídia tem `add_deferred` (1.52+); antes disso o callable é rejeitado com "Invalid binary data format".
+    Detectar o recurso evita depender do número da versão."""
+    try:
+        from streamlit.runtime.media_file_manager import MediaFileManager
+    except ImportError:
+        return False
+    return hasattr(MediaFileManager, 'add_deferred')
 
-class KnowledgeBaseLoader:
-    @staticmethod
-    @st.cache_data(ttl=3600)
-    def load_knowledge_base(folder: str = "materiais_publicos") -> str:
-        content_parts = []
-        if not os.path.exists(folder):
-            return ""
-        for filename in sorted(os.listdir(folder)):
-            if not filename.endswith('.txt'):
-                continue
-            filepath = os.path.join(folder, filename)
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    content_parts.append(f"\n\n{'='*80}\n")
-                    content_parts.append(f"MÓDULO: {filename}\n")
-                    content_parts.append(f"{'='*80}\n\n")
-                    content_parts.append(content)
-            except Exception as e:
-                print(f"Erro ao ler {filename}: {e}")
-                continue
-        return "".join(content_parts)
 
+DEFERRED_DOWNLOADS = _deferred_downloads()
 
-class LLMClient:
-    """Cliente LLM com parsing JSON robusto"""
-    
-    # ✅ Modelo estável
-    MODELO_ESCOLHIDO = "claude-sonnet-4-5-20250929"
 
-    def __init__(self, api_key: str):
-        self.api_key = api_key
+def download_data(gerar: Callable[[], bytes]) -> Any:
+    """`data` para st.download_button: o próprio gerador quando o Streamlit adia o download, senão os bytes"""
+    return gerar if DEFERRED_DOWNLOADS else gerar()
 
-    @staticmethod
-    def _get_system_prompt(conhecimento: str) -> str:
-        """System prompt otimizado para JSON válido"""
-        # Limita conhecimento para evitar timeout
-        kb_truncated = conhecimento[:50000] if conhecimento else ""
-        
-        return f"""Você é o FinMentor, um CFO Virtual especializado em finanças corporativas brasileiras.
 
-TAREFA: Analisar o desafio financeiro e retornar uma estratégia estruturada.
+EXCEL_BLANK_ROWS = 10
+EXCEL_CONSTANT_MEMORY_ROWS = 5000    # acima disso, linhas vão direto para disco (memória fixa)
+EXCEL_MAX_ROWS = 100_000             # teto do campo "Linhas da projeção" (~10 s e ~115 MB no pior caso)
+EXCEL_CENARIOS = (                   # (nome, variação do fluxo, variação da taxa anual)
+    ('Pessimista', -0.20, FINANCE_SENSITIVITY_BP),
+    ('Base', 0.0, 0.0),
+    ('Otimista', 0.20, -FINANCE_SENSITIVITY_BP),
+)
+# Funções do Excel em português → nomes gravados no arquivo (o Excel traduz na abertura)
+EXCEL_FUNCOES = {
+    'SOMA': 'SUM', 'SOMASE': 'SUMIF', 'SOMASES': 'SUMIFS', 'MÉDIA': 'AVERAGE', 'MEDIA': 'AVERAGE',
+    'MÁXIMO': 'MAX', 'MAXIMO': 'MAX', 'MÍNIMO': 'MIN', 'MINIMO': 'MIN', 'CONT.SE': 'COUNTIF',
+    'CONT.VALORES': 'COUNTA', 'CONT.NÚM': 'COUNT', 'SE': 'IF', 'SEERRO': 'IFERROR', 'E': 'AND', 'OU': 'OR',
+    'PROCV': 'VLOOKUP', 'PROCH': 'HLOOKUP', 'ÍNDICE': 'INDEX', 'INDICE': 'INDEX', 'CORRESP': 'MATCH',
+    'ARRED': 'ROUND', 'VPL': 'NPV', 'TIR': 'IRR', 'MTIR': 'MIRR', 'PGTO': 'PMT', 'VP': 'PV', 'VF': 'FV',
+    'TAXA': 'RATE', 'NPER': 'NPER', 'HOJE': 'TODAY',
+}
+_EXCEL_FUNCOES_RE = re.compile(
+    r'(?<![\w.])(' + '|'.join(re.escape(f) for f in sorted(EXCEL_FUNCOES, key=len, reverse=True)) + r')\s*\(',
+    re.I)
+_EXCEL_NUMERO_RE = re.compile(r'-?\d{1,3}(\.\d{3})*(,\d+)?|-?\d+(,\d+)?')
+_EXCEL_MENSAL_RE = re.compile(r'm[eê]s|mensal|data', re.I)
 
-REGRAS CRÍTICAS DE FORMATO:
-1. Retorne APENAS JSON válido, sem markdown, sem ```json, sem texto antes ou depois
-2. Todas as strings devem estar em uma única linha (sem quebras de linha dentro de strings)
-3. Use aspas duplas para todas as strings
-4. Não use caracteres de controle dentro das strings
-5. Para fórmulas matemáticas, use texto simples como "VPL = soma(FC/(1+r)^t)" em vez de LaTeX
 
-BASE DE CONHECIMENTO (resumida):
-{kb_truncated[:20000]}
+def _excel_numero(valor: Any) -> Optional[float]:
+    """Valor de exemplo como número ("R$ 1.200,50", "15%", 300) ou None se for texto"""
+    if isinstance(valor, bool):
+        return None
+    if isinstance(valor, (int, float)):
+        return float(valor)
+    if not isinstance(valor, str):
+        return None
+    texto = re.sub(r'[R$\s%]', '', valor)
+    if _EXCEL_NUMERO_RE.fullmatch(texto):
+        numero = float(texto.replace('.', '').replace(',', '.'))
+    elif re.fullmatch(r'-?\d+\.\d+', texto):
+        numero = float(texto)
+    else:
+        return None
+    return numero / 100 if '%' in valor else numero
 
-ESTRUTURA JSON OBRIGATÓRIA:
-{{
-  "titulo": "Título da estratégia (máx 60 caracteres)",
-  "area_identificada": "Área financeira principal",
-  "kpis_relevantes": ["KPI1", "KPI2", "KPI3"],
-  "frameworks_utilizados": ["Framework1", "Framework2"],
-  "analise_dos_dados": "Análise concisa em 2-3 parágrafos sem quebras de linha",
-  "resumo": "Resumo executivo em 1 parágrafo",
-  "modelagem_matematica": "VPL = soma dos fluxos descontados",
-  "video_sugestao": {{
-    "titulo": "Nome do vídeo sugerido",
-    "termo_busca": "termo para buscar no youtube",
-    "motivo": "Por que este conteúdo é relevante"
-  }},
-  "template_sugerido": {{
-    "nome": "Nome do template Excel",
-    "colunas": ["Coluna1", "Coluna2", "Coluna3", "Coluna4"],
-    "linhas_exemplo": [
-      {{"Coluna1": "Exemplo1", "Coluna2": "100", "Coluna3": "200", "Coluna4": "300"}}
-    ],
-    "formulas_sugeridas": ["=SOMA(B2:B10)", "=VPL(taxa;fluxos)"]
-  }},
-  "componentes": {{
-    "pergunta_raiz": "Qual a decisão principal?",
-    "filhos": [
-      {{
-        "condicao": "Se cenário A",
-        "acao": "Recomendação para cenário A",
-        "filhos": []
-      }},
-      {{
-        "condicao": "Se cenário B", 
-        "acao": "Recomendação para cenário B",
-        "filhos": []
-      }}
-    ]
-  }},
-  "checklist_implementacao": [
-    "Passo 1: Ação específica",
-    "Passo 2: Ação específica",
-    "Passo 3: Ação específica"
-  ],
-  "riscos_mitigacoes": [
-    {{
-      "risco": "Descrição do risco",
-      "mitigacao": "Como mitigar"
-    }}
-  ]
-}}
 
-Retorne APENAS o JSON, começando com {{ e terminando com }}."""
+def _excel_nome(texto: str, usados: set) -> str:
+    """Nome definido válido e único (sem acentos, sem espaços, sem parecer referência de célula)"""
+    base = unicodedata.normalize('NFKD', str(texto)).encode('ascii', 'ignore').decode()
+    base = re.sub(r'\W+', '_', base).strip('_') or 'Coluna'
+    nome, n = f"Dados_{base}", 2
+    while nome.lower() in usados:
+        nome, n = f"Dados_{base}_{n}", n + 1
+    usados.add(nome.lower())
+    return nome
 
-    def _extract_json_from_response(self, text: str) -> Dict[str, Any]:
-        """Extrai JSON de forma robusta, mesmo com texto extra"""
-        
-        # Remove blocos de código markdown
-        text = re.sub(r'```json\s*', '', text)
-        text = re.sub(r'```\s*', '', text)
-        text = text.strip()
-        
-        # Tenta encontrar o JSON no texto
-        # Procura pelo primeiro { e último }
-        start_idx = text.find('{')
-        end_idx = text.rfind('}')
-        
-        if start_idx == -1 or end_idx == -1 or end_idx <= start_idx:
-            raise ValueError("Não foi possível encontrar JSON válido na resposta")
-        
-        json_str = text[start_idx:end_idx + 1]
-        
-        # Tenta parse direto
-        try:
-            return json.loads(json_str)
-        except json.JSONDecodeError:
-            pass
-        
-        # Tenta corrigir problemas comuns
-        # Remove caracteres de controle exceto \n \r \t
-        json_str = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', json_str)
-        
-        # Substitui quebras de linha dentro de strings por espaços
-        # Isso é feito de forma mais cuidadosa
-        in_string = False
-        result = []
-        i = 0
-        while i < len(json_str):
-            char = json_str[i]
-            
-            if char == '"' and (i == 0 or json_str[i-1] != '\\'):
-                in_string = not in_string
-                result.append(char)
-            elif in_string and char in '\n\r':
-                result.append(' ')
-            else:
-                result.append(char)
-            i += 1
-        
-        json_str = ''.join(result)
-        
-        # Tenta parse novamente
-        try:
-            return json.loads(json_str)
-        except json.JSONDecodeError as e:
-            # Se ainda falhar, retorna erro estruturado
-            raise ValueError(f"JSON inválido após correções: {str(e)}")
 
-    def generate_strategy(self, contexto: str, persona: str, mercado: Dict[str, Any], kb: str) -> Dict[str, Any]:
-        """Gera estratégia financeira com parsing robusto"""
-        
-        client = anthropic.Anthropic(api_key=self.api_key)
-        system_prompt = self._get_system_prompt(kb)
-        
-        user_prompt = f"""DESAFIO DO USUÁRIO:
-{contexto}
+class ExcelTemplateGenerator:
+    @staticmethod
+    def template_key(template_data: Dict) -> str:
+        """Hash do conteúdo do template: o mesmo template_sugerido reaproveita o mesmo arquivo"""
+        material = json.dumps(template_data, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(material.encode()).hexdigest()
 
-PERFIL: {persona}
-DADOS DE MERCADO: Dólar R$ {mercado.get('dolar', 'N/D')}, IBOVESPA {mercado.get('ibov', 'N/D')} pontos, SELIC {mercado.get('selic', 'N/D')}, IPCA {mercado.get('ipca', 'N/D')}
+    @staticmethod
+    @st.cache_data(max_entries=EXCEL_CACHE_ENTRIES, show_spinner=False)
+    def _cached_workbook(chave: str, _template_data: Dict, taxa_anual: Optional[float],
+                         total_linhas: Optional[int]) -> bytes:
+        # Só chave, taxa e linhas entram no hash do cache; o template (prefixo "_") é ignorado pelo Streamlit
+        return ExcelTemplateGenerator.generate_template(_template_data, taxa_anual, total_linhas).getvalue()
 
-Analise o desafio e retorne o JSON estruturado conforme especificado."""
+    @staticmethod
+    def workbook_bytes(template_data: Dict, taxa_anual: Optional[float] = None,
+                       total_linhas: Optional[int] = None) -> bytes:
+        return ExcelTemplateGenerator._cached_workbook(ExcelTemplateGenerator.template_key(template_data),
+                                                       template_data, taxa_anual, total_linhas)
 
-        try:
-            response = client.messages.create(
-                model=self.MODELO_ESCOLHIDO,
-                max_tokens=4096,  # Reduzido para evitar respostas muito longas
-                temperature=0.3,  # Mais determinístico para JSON
-                system=system_prompt,
-                messages=[{"role": "user", "content": user_prompt}]
-            )
-            
-            raw_content = response.content[0].text
-            
-            # Tenta extrair JSON
-            try:
-                result = self._extract_json_from_response(raw_content)
-                
-                # Validação básica dos campos obrigatórios
-                required_fields = ['titulo', 'area_identificada', 'resumo']
-                for field in required_fields:
-                    if field not in result:
-                        result[field] = "Não especificado"
-                
-                # Garante que listas existam
-                if 'kpis_relevantes' not in result or not isinstance(result['kpis_relevantes'], list):
-                    result['kpis_relevantes'] = ["VPL", "TIR", "Payback"]
-                if 'frameworks_utilizados' not in result or not isinstance(result['frameworks_utilizados'], list):
-                    result['frameworks_utilizados'] = ["Análise de Viabilidade"]
-                if 'checklist_implementacao' not in result or not isinstance(result['checklist_implementacao'], list):
-                    result['checklist_implementacao'] = ["Revisar análise", "Implementar recomendações"]
-                if 'riscos_mitigacoes' not in result or not isinstance(result['riscos_mitigacoes'], list):
-                    result['riscos_mitigacoes'] = []
-                
-                # Garante estrutura do vídeo
-                if 'video_sugestao' not in result or not isinstance(result['video_sugestao'], dict):
-                    result['video_sugestao'] = {
-                        "titulo": "Análise Financeira",
-                        "termo_busca": "análise financeira investimentos",
-                        "motivo": "Aprofundar conhecimentos sobre o tema"
-                    }
-                
-                # Garante estrutura do template
-                if 'template_sugerido' not in result or not isinstance(result['template_sugerido'], dict):
-                    result['template_sugerido'] = {
-                        "nome": "Análise Financeira",
-                        "colunas": ["Período", "Valor", "Acumulado"],
-                        "linhas_exemplo": [{"Período": "Mês 1", "Valor": "1000", "Acumulado": "1000"}],
-                        "formulas_sugeridas": ["=SOMA(B:B)"]
-                    }
-                elif 'colunas' not in result['template_sugerido'] or not result['template_sugerido']['colunas']:
-                    result['template_sugerido']['colunas'] = ["Período", "Valor", "Acumulado"]
-                
-                # Garante estrutura dos componentes (árvore de decisão)
-                if 'componentes' not in result or not isinstance(result['componentes'], dict):
-                    result['componentes'] = {
-                        "pergunta_raiz": "Qual a melhor decisão?",
-                        "filhos": []
-                    }
-                
-                return result
-                
-            except ValueError as e:
-                # Retorna resposta de fallback com texto bruto
-                return {
-                    "titulo": "Análise Financeira",
-                    "area_identificada": "Finanças Corporativas",
-                    "kpis_relevantes": ["VPL", "TIR", "Payback"],
-                    "frameworks_utilizados": ["Análise de Viabilidade"],
-                    "analise_dos_dados": raw_content[:2000] if raw_content else "Análise não disponível",
-                    "resumo": "A análise foi processada. Veja os detalhes acima.",
-                    "modelagem_matematica": "",
-                    "video_sugestao": {
-                        "titulo": "Análise de Investimentos",
-                        "termo_busca": "análise investimentos VPL TIR",
-                        "motivo": "Aprofundar conhecimento em análise de viabilidade"
-                    },
-                    "template_sugerido": {
-                        "nome": "Fluxo de Caixa",
-                        "colunas": ["Período", "Entrada", "Saída", "Saldo"],
-                        "linhas_exemplo": [{"Período": "Mês 1", "Entrada": "10000", "Saída": "5000", "Saldo": "5000"}],
-                        "formulas_sugeridas": ["=B2-C2"]
-                    },
-                    "componentes": {
-                        "pergunta_raiz": "O investimento é viável?",
-                        "filhos": [
-                            {"condicao": "VPL > 0", "acao": "Investimento recomendado", "filhos": []},
-                            {"condicao": "VPL < 0", "acao": "Reavaliar premissas", "filhos": []}
-                        ]
-                    },
-                    "checklist_implementacao": [
-                        "Validar premissas do modelo",
-                        "Calcular cenários alternativos",
-                        "Apresentar para stakeholders"
-                    ],
-                    "riscos_mitigacoes": [
-                        {"risco": "Variação cambial", "mitigacao": "Considerar hedge"},
-                        {"risco": "Cenário macroeconômico", "mitigacao": "Análise de sensibilidade"}
-                    ],
-                    "parse_warning": str(e)
-                }
-                
-        except anthropic.APIError as e:
-            return {"error": True, "message": f"Erro na API Anthropic: {str(e)}"}
-        except Exception as e:
-            return {"error": True, "message": f"Erro inesperado: {str(e)}"}
+    @staticmethod
+    def _colunas_unicas(template_data: Dict) -> List[str]:
+        """Nomes de coluna sem repetição: as linhas de exemplo são dicts, então duplicatas não teriam dado próprio"""
+        colunas = [str(c) for c in (template_data.get('colunas') or ['Coluna1', 'Coluna2', 'Coluna3'])]
+        return list(dict.fromkeys(colunas))
 
     @staticmethod
-    def transcribe_audio(audio_bytes: bytes, openai_api_key: str) -> str:
-        if not openai_api_key: 
-            return "[Erro: Chave OpenAI necessária para transcrição]"
-        try:
-            client = OpenAI(api_key=openai_api_key)
-            audio_file = BytesIO(audio_bytes)
-            audio_file.name = "audio.wav"
-            return client.audio.transcriptions.create(
-                model="whisper-1", 
-                file=audio_file, 
-                language="pt"
-            ).text
-        except Exception as e:
-            return f"[Erro na transcrição: {str(e)}]"
-            
+    def _nome_livre(nome: str, colunas: List[str]) -> str:
+        """Nome para coluna calculada que não colide com as do template ("Fluxo de Caixa (calculado)")"""
+        existentes = {c.strip().lower() for c in colunas}
+        candidato, n = nome, 1
+        while candidato.lower() in existentes:
+            candidato = f"{nome} (calculado)" if n == 1 else f"{nome} (calculado {n})"
+            n += 1
+        return candidato
+
     @staticmethod
-    def chat_followup(user_message: str, chat_history: List[Dict], main_context: str, kb: str, api_key: str) -> str:
-        client = anthropic.Anthropic(api_key=api_key)
-        
-        messages_payload = []
-        for msg in chat_history[-10:]:
-            if msg["role"] in ["user", "assistant"]:
-                messages_payload.append({"role": msg["role"], "content": msg["content"]})
-        messages_payload.append({"role": "user", "content": user_message})
-        
-        try:
-            response = client.messages.create(
-                model="claude-sonnet-4-5-20250929",
-                max_tokens=1000,
-                temperature=0.7,
-                system=f"""Você é o FinMentor, um CFO Virtual. Responda de forma direta e profissional em português brasileiro.
-                
-Contexto da conversa anterior:
-{main_context[:5000]}""",
-                messages=messages_payload
-            )
-            return response.content[0].text.strip()
-        except Exception as e:
-            return f"❌ Erro ao processar: {str(e)}"
+    def translate_formula(formula: str) -> str:
+        """=SOMA(B2:B13;C2) → =SUM(B2:B13,C2): nomes e separadores que o xlsxwriter grava"""
+        traduzida = _EXCEL_FUNCOES_RE.sub(lambda m: EXCEL_FUNCOES[m.group(1).upper()] + '(', formula)
+        if ';' in traduzida:
+            traduzida = re.sub(r'(\d),(\d)', r'\1.\2', traduzida).replace(';', ',')
+        return traduzida
 
+    @staticmethod
+    def _modelo(colunas: List[str], linhas: List[Dict]) -> Dict[str, Any]:
+        """Colunas numéricas e como compor o fluxo de caixa a partir delas"""
+        numericas = [c for c in colunas if not _ID_HINTS.search(str(c)) and (
+            any(_excel_numero(r.get(c)) is not None for r in linhas) or (not linhas and _VALUE_HINTS.search(str(c))))]
+        entradas = [c for c in numericas if _ENTRADA_HINTS.search(str(c))]
+        saidas = [c for c in numericas if _SAIDA_HINTS.search(str(c))]
+        if entradas and saidas:
+            fluxo = {'entradas': entradas, 'saidas': saidas, 'coluna': None}
+        elif numericas:
+            preferidas = [c for c in numericas if _VALUE_HINTS.search(str(c))] or numericas
+            fluxo = {'entradas': [], 'saidas': [], 'coluna': preferidas[0]}
+        else:
+            fluxo = None
+        mensal = any(_EXCEL_MENSAL_RE.search(str(c)) for c in colunas)
+        return {'numericas': numericas, 'fluxo': fluxo, 'periodos_ano': 12 if mensal else 1}
 
-class ExcelTemplateGenerator:
     @staticmethod
-    def generate_template(template_data: Dict) -> BytesIO:
-        import pandas as pd
+    def generate_template(template_data: Dict, taxa_anual: Optional[float] = None,
+                          total_linhas: Optional[int] = None) -> BytesIO:
+        """Planilha com modelo vivo: dados, fluxo de caixa, VPL, TIR e cenários em fórmulas reais.
+
+        Cada fórmula leva o resultado já calculado (FinanceEngine), então o arquivo abre pronto sem
+        recálculo. `total_linhas` estende a projeção (linhas em branco com fórmulas); acima de
+        EXCEL_CONSTANT_MEMORY_ROWS o xlsxwriter grava linha a linha em disco, com memória constante.
+        """
+        import numpy as np
+        import xlsxwriter
+        from xlsxwriter.utility import xl_col_to_name
         output = BytesIO()
+        workbook = None
         
         try:
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                colunas = template_data.get('colunas', ['Coluna1', 'Coluna2', 'Coluna3'])
-                linhas = template_data.get('linhas_exemplo', [])
-                
-                # Cria DataFrame
-                if linhas and isinstance(linhas, list):
-                    # Normaliza as linhas para garantir que todas as colunas existam
-                    normalized_rows = []
-                    for row in linhas:
-                        if isinstance(row, dict):
-                            normalized_row = {col: row.get(col, '') for col in colunas}
-                            normalized_rows.append(normalized_row)
-                    df = pd.DataFrame(normalized_rows) if normalized_rows else pd.DataFrame(columns=colunas)
+            colunas = ExcelTemplateGenerator._colunas_unicas(template_data)
+            linhas = template_data.get('linhas_exemplo', [])
+            linhas = [r for r in linhas if isinstance(r, dict)] if isinstance(linhas, list) else []
+            n = max(total_linhas or 0, len(linhas) + EXCEL_BLANK_ROWS)
+            grande = n > EXCEL_CONSTANT_MEMORY_ROWS
+            # constant_memory só vale fora do modo in_memory; as linhas precisam sair em ordem
+            workbook = xlsxwriter.Workbook(output, {'constant_memory': grande, 'in_memory': not grande})
+            modelo = ExcelTemplateGenerator._modelo(colunas, linhas)
+            fluxo = modelo['fluxo']
+            taxa = FINANCE_SELIC_FALLBACK if taxa_anual is None else float(taxa_anual)
+            
+            # Formato do cabeçalho
+            header_format = workbook.add_format({
+                'bold': True, 
+                'bg_color': '#667eea', 
+                'font_color': 'white', 
+                'border': 1, 
+                'align': 'center', 
+                'valign': 'vcenter', 
+                'font_name': 'Arial'
+            })
+            numero_format = workbook.add_format({'num_format': '#,##0.00'})
+            pct_format = workbook.add_format({'num_format': '0.00%'})
+            
+            # Valores numéricos das linhas de exemplo (o restante da projeção começa zerado)
+            valores = {c: np.zeros(n) for c in modelo['numericas']}
+            for i, row in enumerate(linhas):
+                for c in modelo['numericas']:
+                    valores[c][i] = _excel_numero(row.get(c)) or 0.0
+            
+            # Colunas calculadas ganham nome próprio: "Fluxo de Caixa" vindo do template continua sendo dado
+            extras: List[str] = []
+            col_caixa = col_acumulado = None
+            if fluxo:
+                if fluxo['coluna'] is None:
+                    col_caixa = ExcelTemplateGenerator._nome_livre('Fluxo de Caixa', colunas)
+                    extras.append(col_caixa)
+                    caixa = sum(valores[c] for c in fluxo['entradas']) - sum(valores[c] for c in fluxo['saidas'])
                 else:
-                    df = pd.DataFrame(columns=colunas)
-                
-                # Adiciona linhas vazias para o usuário preencher
-                empty_rows = pd.DataFrame([{col: '' for col in colunas} for _ in range(10)])
-                df = pd.concat([df, empty_rows], ignore_index=True)
-                
-                df.to_excel(writer, sheet_name='Dados', index=False)
-                
-                workbook = writer.book
-                worksheet = writer.sheets['Dados']
-                
-                # Formato do cabeçalho
-                header_format = workbook.add_format({
-                    'bold': True, 
-                    'bg_color': '#667eea', 
-                    'font_color': 'white', 
-                    'border': 1, 
-                    'align': 'center', 
-                    'valign': 'vcenter', 
-                    'font_name': 'Arial'
-                })
-                
-                for col_num, value in enumerate(df.columns):
-                    worksheet.write(0, col_num, value, header_format)
-                    worksheet.set_column(col_num, col_num, 18)
+                    caixa = valores[fluxo['coluna']]
+                col_acumulado = ExcelTemplateGenerator._nome_livre('Fluxo Acumulado', colunas)
+                extras.append(col_acumulado)
+                acumulado = np.cumsum(caixa)
+            
+            worksheet = workbook.add_worksheet('Dados')
+            letra = {c: xl_col_to_name(i) for i, c in enumerate(colunas + extras)}
+            if fluxo:
+                origem = letra[col_caixa or fluxo['coluna']]
+            for col_num, value in enumerate(colunas + extras):
+                worksheet.write_string(0, col_num, value, header_format)
+                worksheet.set_column(col_num, col_num, 18)
+            
+            # Linhas de exemplo; as seguintes ficam vazias para o usuário preencher, já ligadas ao modelo
+            for i in range(n):
+                linha = i + 2
+                row = linhas[i] if i < len(linhas) else {}
+                for col_num, col in enumerate(colunas if row else ()):
+                    valor = row.get(col, '')
+                    # Texto do modelo sempre como string: "=B4*2" não pode virar fórmula viva no arquivo.
+                    # Em coluna de valor, o que não é número fica em branco (conta 0, como no valor pré-calculado)
+                    if col in valores:
+                        numero = _excel_numero(valor)
+                        if numero is not None and math.isfinite(numero):
+                            worksheet.write_number(i + 1, col_num, numero)
+                    elif isinstance(valor, (int, float)) and not isinstance(valor, bool) and math.isfinite(valor):
+                        worksheet.write_number(i + 1, col_num, valor)
+                    elif valor not in ('', None):
+                        worksheet.write_string(i + 1, col_num, str(valor))
+                if col_caixa:
+                    formula = '=' + '+'.join(f"{letra[c]}{linha}" for c in fluxo['entradas']) + ''.join(
+                        f"-{letra[c]}{linha}" for c in fluxo['saidas'])
+                    worksheet.write_formula(i + 1, len(colunas), formula, numero_format, caixa[i])
+                if fluxo:
+                    formula = f"={origem}{linha}" if i == 0 else f"={letra[col_acumulado]}{linha - 1}+{origem}{linha}"
+                    worksheet.write_formula(i + 1, len(colunas) + len(extras) - 1, formula, numero_format, acumulado[i])
+            
+            # Intervalos nomeados: fórmulas do modelo leem "Dados_Receita", não "Dados!$B$2:$B$..."
+            usados: set = set()
+            for c in modelo['numericas']:
+                workbook.define_name(_excel_nome(c, usados), f"=Dados!${letra[c]}$2:${letra[c]}${n + 1}")
+            
+            if fluxo:
+                workbook.define_name('Fluxo_caixa', f"=Dados!${origem}$2:${origem}${n + 1}")
+                workbook.define_name('Fluxo_inicial', f"=Dados!${origem}$2")
+                workbook.define_name('Fluxo_futuro', f"=Dados!${origem}$3:${origem}${n + 1}")
+                workbook.define_name('Fluxo_acumulado',
+                                     f"=Dados!${letra[col_acumulado]}$2:${letra[col_acumulado]}${n + 1}")
+                ExcelTemplateGenerator._write_model(workbook, modelo, valores, caixa, taxa, header_format,
+                                                    numero_format, pct_format)
+            
+            # Aba de fórmulas: a sugestão original e a grafia que o Excel grava
+            formulas = template_data.get('formulas_sugeridas', [])
+            if formulas:
+                formula_sheet = workbook.add_worksheet('Fórmulas')
+                formula_sheet.write_string(0, 0, 'Fórmulas Sugeridas', header_format)
+                formula_sheet.write_string(0, 1, 'Sintaxe do arquivo (inglês)', header_format)
+                for i, formula in enumerate(formulas, start=1):
+                    formula_sheet.write_string(i, 0, str(formula))
+                    formula_sheet.write_string(i, 1, ExcelTemplateGenerator.translate_formula(str(formula)))
+                formula_sheet.set_column(0, 1, 50)
+            workbook.close()
                 
-                # Aba de fórmulas
-                formulas = template_data.get('formulas_sugeridas', [])
-                if formulas:
-                    formula_sheet = workbook.add_worksheet('Fórmulas')
-                    formula_sheet.write(0, 0, 'Fórmulas Sugeridas', header_format)
-                    for i, formula in enumerate(formulas, start=1):
-                        formula_sheet.write(i, 0, str(formula))
-                    formula_sheet.set_column(0, 0, 50)
-                    
         except Exception as e:
+            # Fecha o workbook que falhou: no modo constant_memory ele mantém arquivos temporários abertos
+            if workbook is not None and not workbook.fileclosed:
+                try:
+                    workbook.close()
+                except Exception:
+                    pass
             # Se falhar, cria um Excel mínimo
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                pd.DataFrame({'Erro': [str(e)]}).to_excel(writer, index=False)
+            output = BytesIO()
+            workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+            worksheet = workbook.add_worksheet()
+            worksheet.write_string(0, 0, 'Erro')
+            worksheet.write_string(1, 0, str(e))
+            workbook.close()
         
         output.seek(0)
         return output
 
+    @staticmethod
+    def _write_model(workbook: Any, modelo: Dict[str, Any], valores: Dict[str, Any], caixa: Any, taxa: float,
+                     header_format: Any, numero_format: Any, pct_format: Any) -> None:
+        """Aba "Modelo": premissas editáveis, indicadores e tabela de cenários, tudo em fórmulas"""
+        import numpy as np
+        ws = workbook.add_worksheet('Modelo')
+        ws.set_column(0, 0, 32)
+        ws.set_column(1, 3, 18)
+        periodos = modelo['periodos_ano']
+        taxa_periodo = (1 + taxa) ** (1 / periodos) - 1
+        vpl = float(FinanceEngine.npv(taxa_periodo, caixa)[0])
+        tir = float(FinanceEngine.irr(caixa)[0])
+        
+        ws.write_string(0, 0, 'Premissa', header_format)
+        ws.write_string(0, 1, 'Valor', header_format)
+        ws.write_string(1, 0, 'Taxa de desconto anual')
+        ws.write_number(1, 1, taxa, pct_format)
+        ws.write_string(2, 0, 'Períodos por ano')
+        ws.write_number(2, 1, periodos)
+        ws.write_string(3, 0, 'Taxa por período')
+        ws.write_formula(3, 1, '=(1+Taxa_anual)^(1/Periodos_ano)-1', pct_format, taxa_periodo)
+        workbook.define_name('Taxa_anual', '=Modelo!$B$2')
+        workbook.define_name('Periodos_ano', '=Modelo!$B$3')
+        workbook.define_name('Taxa_periodo', '=Modelo!$B$4')
+        
+        ws.write_string(5, 0, 'Indicador', header_format)
+        ws.write_string(5, 1, 'Valor', header_format)
+        linha = 6
+        usados: set = set()
+        for c in modelo['numericas']:
+            ws.write_string(linha, 0, f"Total {c}")
+            ws.write_formula(linha, 1, f"=SUM({_excel_nome(c, usados)})", numero_format, float(valores[c].sum()))
+            linha += 1
+        ws.write_string(linha, 0, 'VPL do fluxo de caixa')
+        ws.write_formula(linha, 1, '=Fluxo_inicial+NPV(Taxa_periodo,Fluxo_futuro)', numero_format, vpl)
+        workbook.define_name('VPL', f"=Modelo!$B${linha + 1}")
+        ws.write_string(linha + 1, 0, 'TIR por período')
+        ws.write_formula(linha + 1, 1, '=IFERROR(IRR(Fluxo_caixa),"")', pct_format, '' if np.isnan(tir) else tir)
+        workbook.define_name('TIR', f"=Modelo!$B${linha + 2}")
+        ws.write_string(linha + 2, 0, 'Resultado acumulado')
+        ws.write_formula(linha + 2, 1, '=INDEX(Fluxo_acumulado,ROWS(Fluxo_acumulado))', numero_format,
+                         float(caixa.sum()))
+        
+        linha += 4
+        for col_num, titulo in enumerate(('Cenário', 'Variação dos fluxos futuros', 'Taxa anual', 'VPL')):
+            ws.write_string(linha, col_num, titulo, header_format)
+        # O investimento inicial fica fixo; o cenário varia os fluxos seguintes e a taxa
+        futuro = np.concatenate(([0.0], caixa[1:]))
+        for nome, choque, delta in EXCEL_CENARIOS:
+            linha += 1
+            taxa_cenario = (1 + taxa + delta) ** (1 / periodos) - 1
+            ws.write_string(linha, 0, nome)
+            ws.write_number(linha, 1, choque, pct_format)
+            ws.write_formula(linha, 2, f"=Taxa_anual{delta:+.4f}" if delta else '=Taxa_anual', pct_format, taxa + delta)
+            ws.write_formula(linha, 3,
+                             f"=Fluxo_inicial+(1+B{linha + 1})*NPV((1+C{linha + 1})^(1/Periodos_ano)-1,Fluxo_futuro)",
+                             numero_format, caixa[0] + (1 + choque) * float(FinanceEngine.npv(taxa_cenario, futuro)[0]))
+
+
+def _esc(texto: Any) -> str:
+    """Texto do modelo pronto para entrar em st.markdown(unsafe_allow_html=True)"""
+    return html.escape(str(texto))
+
+def checklist_html(items: List[str]) -> str:
+    return "".join(f'<div class="checklist-item">✅ {_esc(item)}</div>' for item in items)
+
+def risks_html(risks: List[Dict]) -> str:
+    return "".join(
+        f'<div class="risk-card"><p class="risk-title">⚠️ {_esc(risk.get("risco", "Risco não especificado"))}</p>'
+        f'<p class="risk-mitigation"><strong>Mitigação:</strong> {_esc(risk.get("mitigacao", "Não especificada"))}</p></div>'
+        for risk in risks if isinstance(risk, dict))
 
 def render_checklist(items: List[str]):
-    for item in items:
-        st.markdown(f'<div class="checklist-item">✅ {item}</div>', unsafe_allow_html=True)
+    st.markdown(checklist_html(items), unsafe_allow_html=True)
 
 def render_risks(risks: List[Dict]):
-    for risk in risks:
-        if isinstance(risk, dict):
-            st.markdown(f'''<div class="risk-card">
-                <p class="risk-title">⚠️ {risk.get('risco', 'Risco não especificado')}</p>
-                <p class="risk-mitigation"><strong>Mitigação:</strong> {risk.get('mitigacao', 'Não especificada')}</p>
-            </div>''', unsafe_allow_html=True)
+    st.markdown(risks_html(risks), unsafe_allow_html=True)
 
-def render_tree_node(node: Dict, level: int = 0):
-    if not isinstance(node, dict):
-        return
-        
-    margin_left = f"{level * 2}rem"
-    css_class = "tree-node-root" if level == 0 else "tree-node"
-    icon = "❓" if level == 0 else ("📍" if level == 1 else "📌")
+def render_financials(relatorio: Dict[str, Any]):
+    taxas = relatorio['taxas']
+    cols = st.columns(4)
+    cols[0].metric("SELIC", _fmt_pct(taxas['selic']))
+    cols[1].metric("Ke (CAPM)", _fmt_pct(taxas['ke']))
+    cols[2].metric("WACC", _fmt_pct(taxas['wacc']))
+    cols[3].metric("g (terminal)", _fmt_pct(taxas['crescimento']))
     
-    condicao = node.get('condicao', node.get('pergunta_raiz', ''))
-    acao = node.get('acao', '')
+    for fluxo in relatorio['fluxos']:
+        st.markdown(f"**{fluxo['serie']}** · {fluxo['periodos']} períodos ({fluxo['periodicidade']})")
+        cols = st.columns(4)
+        cols[0].metric("VPL", _fmt_num(fluxo['vpl']) if fluxo['vpl'] is not None else "n/d")
+        cols[1].metric("TIR / período", _fmt_pct(fluxo['tir']))
+        cols[2].metric("MTIR / período", _fmt_pct(fluxo['mtir']))
+        investimento = fluxo.get('investimento_inicial', True)
+        if investimento:
+            cols[3].metric("Payback (desc.)", f"{_fmt_periodos(fluxo['payback'])} "
+                                              f"({_fmt_periodos(fluxo['payback_descontado'])})")
+        else:
+            cols[3].metric("Payback", _fmt_periodos(None, investimento))
     
-    if condicao:
-        st.markdown(f'''<div class="{css_class}" style="margin-left: {margin_left};">
-            <strong>{icon} {condicao}</strong>
-            {f'<br><span>➡️ {acao}</span>' if acao else ''}
-        </div>''', unsafe_allow_html=True)
+    if relatorio['dcf']:
+        dcf = relatorio['dcf']
+        st.markdown(f"**DCF** (primeiro fluxo em t = 0, como no VPL): VP dos fluxos {_fmt_num(dcf['vp_fluxos'])} + VP terminal "
+                    f"{_fmt_num(dcf['vp_terminal'])} = **{_fmt_num(dcf['valor'])}**")
+    
+    if relatorio['dupont']:
+        dupont = relatorio['dupont']
+        cols = st.columns(4)
+        cols[0].metric("Margem Líquida", _fmt_pct(dupont['margem_liquida']))
+        cols[1].metric("Giro do Ativo", _fmt_razao(dupont['giro_ativo']))
+        cols[2].metric("Alavancagem", _fmt_razao(dupont['alavancagem']))
+        cols[3].metric("ROE (DuPont)", _fmt_pct(dupont['roe']))
+    
+    indicadores = list(relatorio['indicadores'].items())
+    for inicio in range(0, len(indicadores), 4):
+        cols = st.columns(4)
+        for col, (nome, valor) in zip(cols, indicadores[inicio:inicio + 4]):
+            col.metric(nome, _fmt_num(valor) if nome == 'EVA' else _fmt_razao(valor))
+    
+    if relatorio['premissas']:
+        st.caption("Premissas: " + "; ".join(relatorio['premissas']))
+
+def render_simulation(simulacao: Dict[str, Any]):
+    import pandas as pd
+    tabela = pd.DataFrame([{
+        'Ramo': ("· " * max(r['nivel'] - 1, 0)) + r['ramo'][:60],
+        'Valor base': _fmt_num(r['valor_base']),
+        'Valor esperado': _fmt_num(r['valor_esperado']),
+        **{f'P{p}': _fmt_num(r[f'p{p}']) for p in SIM_PERCENTIS},
+        'P(prejuízo)': _fmt_pct(r['prob_prejuizo']),
+    } for r in simulacao['ramos']])
+    st.dataframe(tabela, hide_index=True, use_container_width=True)
+    
+    melhor = next((r for r in simulacao['ramos'] if r['ramo'] == simulacao['melhor_ramo']), None)
+    if melhor:
+        st.markdown(f"**Tornado — {melhor['ramo'][:60]}** (variação do valor com ±1 desvio em cada fator)")
+        tornado = pd.DataFrame({t['fator']: {'Baixa do fator': t['baixa'], 'Alta do fator': t['alta']}
+                                for t in melhor['tornado']}).T
+        st.bar_chart(tornado, horizontal=True)
+    
+    fatores = " · ".join(f"{f['fator']} {f['base']} (±{f['volatilidade']:.0%})" for f in simulacao['fatores'])
+    st.caption(f"{simulacao['sorteios']:,} sorteios correlacionados".replace(',', '.') + f" · {fatores}")
+
+def tree_node_html(node: Dict, level: int = 0) -> str:
+    """Árvore inteira num só bloco HTML: percurso em pré-ordem com pilha (sem recursão) e texto escapado"""
+    partes: List[str] = []
+    pilha: List[Tuple[Any, int]] = [(node, level)]
+    # A raiz não conta no limite do schema (STRATEGY_MAX_TREE_NODES nós abaixo dela)
+    while pilha and len(partes) < STRATEGY_MAX_TREE_NODES + 1:
+        node, level = pilha.pop()
+        if not isinstance(node, dict):
+            continue
+        
+        margin_left = f"{level * 2}rem"
+        css_class = "tree-node-root" if level == 0 else "tree-node"
+        icon = "❓" if level == 0 else ("📍" if level == 1 else "📌")
+        
+        condicao = node.get('condicao', node.get('pergunta_raiz', ''))
+        acao = node.get('acao', '')
+        
+        if condicao:
+            acao_html = f'<br><span>➡️ {_esc(acao)}</span>' if acao else ''
+            partes.append(f'<div class="{css_class}" style="margin-left: {margin_left};">'
+                          f'<strong>{icon} {_esc(condicao)}</strong>{acao_html}</div>')
+        
+        filhos = node.get('filhos')
+        if isinstance(filhos, list):
+            pilha.extend((filho, level + 1) for filho in reversed(filhos))
+    return "".join(partes)
+
+
+def render_tree_node(node: Dict, level: int = 0):
+    st.markdown(tree_node_html(node, level), unsafe_allow_html=True)
+
+
+# Corpo da estratégia em HTML, montado uma vez por resposta: reruns (botões, downloads) só reenviam os blocos
+STRATEGY_HTML_CACHE_ENTRIES = 32
+
+
+def response_key(response: Dict) -> str:
+    material = json.dumps(response, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+@st.cache_data(max_entries=STRATEGY_HTML_CACHE_ENTRIES, show_spinner=False)
+def strategy_html(chave: str, _response: Dict) -> Dict[str, str]:
+    """Blocos HTML das seções textuais; a chave é o hash da resposta (o dict em si não é hasheado).
+    Todo texto do modelo passa por `_esc`: ele pode ecoar conteúdo da planilha enviada."""
+    response = _response
+    blocos = {
+        'cabecalho': f'''<div style="text-align: center; padding: 1rem 0;">
+        <span class="focus-badge">{_esc(response.get('area_identificada', 'Finanças'))}</span>
+    </div>
+    <h1 class="strategy-header">{_esc(response.get('titulo', 'Estratégia Financeira'))}</h1>''',
+        'kpis': "".join(f'<span class="kpi-badge">{_esc(k)}</span>' for k in response.get('kpis_relevantes', [])),
+        'frameworks': "".join(f'<span class="focus-badge">{_esc(f)}</span>'
+                              for f in response.get('frameworks_utilizados', [])),
+        'analise': f'<div class="analysis-section">{_esc(response.get("analise_dos_dados", "Análise não disponível"))}</div>',
+        'resumo': f'<div class="strategy-card">{_esc(response.get("resumo", "Resumo não disponível"))}</div>',
+        'arvore': '',
+        'checklist': checklist_html(response.get('checklist_implementacao', [])),
+        'riscos': risks_html(response.get('riscos_mitigacoes', [])),
+    }
+    
+    video = response.get('video_sugestao', {})
+    if isinstance(video, dict):
+        termo = str(video.get('termo_busca', 'análise financeira'))
+        video_url = f"https://www.youtube.com/results?search_query={urllib.parse.quote(termo)}"
+        blocos['video'] = f'''<div class="video-card">
+                <h4>🎬 Vídeo Recomendado</h4>
+                <p class="video-title">{_esc(video.get('titulo', 'Vídeo Recomendado'))}</p>
+                <p class="video-desc">{_esc(video.get('motivo', 'Aprofunde-se neste tema'))}</p>
+                <a href="{_esc(video_url)}" target="_blank">
+                    🔍 Pesquisar "{_esc(termo)}" no YouTube
+                </a>
+            </div>'''
     
-    for filho in node.get('filhos', []):
-        render_tree_node(filho, level + 1)
+    componentes = response.get('componentes', {})
+    if isinstance(componentes, dict) and componentes:
+        blocos['arvore'] = tree_node_html({**componentes, 'pergunta_raiz': componentes.get('pergunta_raiz', 'Qual a decisão?')})
+    return blocos
+
+
+def configured_api_keys() -> Tuple[str, str]:
+    """(Anthropic, OpenAI) do ambiente ou do secrets.toml, sem pedir nada ao usuário"""
+    def ler(nome: str) -> str:
+        valor = os.getenv(nome)
+        if valor:
+            return valor
+        try:
+            return st.secrets.get(nome, '')
+        except Exception:
+            return ''
+    return ler('ANTHROPIC_API_KEY'), ler('OPENAI_API_KEY')
 
 
 def render_phase_1():
@@ -720,8 +3689,7 @@ def render_phase_1():
     </div>''', unsafe_allow_html=True)
     
     # ✅ GERENCIAMENTO DE CHAVES (CLAUDE + OPENAI)
-    ant_key = os.getenv('ANTHROPIC_API_KEY') or st.secrets.get('ANTHROPIC_API_KEY', '')
-    oai_key = os.getenv('OPENAI_API_KEY') or st.secrets.get('OPENAI_API_KEY', '')
+    ant_key, oai_key = configured_api_keys()
     
     if not ant_key:
         st.warning("⚠️ Chave ANTHROPIC necessária para o cérebro do FinMentor")
@@ -788,67 +3756,128 @@ def render_phase_1():
             if not user_challenge.strip():
                 st.error("❌ Descreva seu desafio financeiro.")
             else:
-                st.session_state.ctx = user_challenge
-                
-                with st.spinner("📊 Buscando dados de mercado..."):
-                    st.session_state.market_data = MarketDataFetcher.get_market_data()
-                
-                with st.spinner("📚 Carregando base de conhecimento..."):
-                    st.session_state.kb_content = KnowledgeBaseLoader.load_knowledge_base()
-                
-                if uploaded_file:
-                    try:
-                        import pandas as pd
-                        if uploaded_file.name.endswith('.csv'):
-                            df = pd.read_csv(uploaded_file)
-                        else:
-                            df = pd.read_excel(uploaded_file)
-                        # Limita o tamanho dos dados
-                        df_summary = df.head(50).to_string()
-                        st.session_state.ctx += f"\n\n## DADOS DO ARQUIVO ({uploaded_file.name}):\n{df_summary[:5000]}"
-                    except Exception as e:
-                        st.warning(f"⚠️ Erro ao ler arquivo: {e}")
+                upload = (uploaded_file.name, uploaded_file.getvalue()) if uploaded_file else None
+                pipeline = StrategyPipeline(user_challenge, selected_persona, upload)
                 
-                with st.spinner("🧠 Analisando seu desafio... (pode levar 15-30 segundos)"):
-                    try:
-                        client = LLMClient(st.session_state.anthropic_key)
-                        response = client.generate_strategy(
-                            st.session_state.ctx, 
-                            selected_persona, 
-                            st.session_state.market_data, 
-                            st.session_state.kb_content
-                        )
-                        
-                        if response.get('error'):
-                            st.error(f"❌ {response.get('message')}")
-                        else:
-                            if response.get('parse_warning'):
-                                st.warning(f"⚠️ Aviso de parsing: {response.get('parse_warning')}")
-                            st.session_state.strategy_response = response
-                            st.session_state.fase = 2
-                            st.rerun()
-                    except Exception as e:
-                        st.error(f"❌ Erro: {e}")
+                # A geração vai para a fila de jobs; a fase 2 acompanha o progresso
+                try:
+                    job = StrategyJobQueue.shared().submit(st.session_state.anthropic_key, pipeline,
+                                                           st.session_state.sessao_id)
+                except JobRejected as e:
+                    st.error(f"⏳ {e}")
+                else:
+                    st.session_state.job_id = job.id
+                    st.query_params["job"] = job.id
+                    st.session_state.strategy_response = None
+                    st.session_state.fase = 2
+                    st.rerun()
+
+
+def _render_progressive_tree(componentes: Dict) -> None:
+    if isinstance(componentes, dict):
+        st.markdown("### 🌳 Árvore de Decisão")
+        render_tree_node(componentes)
+
+
+# Campo do JSON -> renderizador, na ordem em que as seções aparecem na página
+_PROGRESSIVE_SECTIONS: List[Tuple[str, Callable[[Any], None]]] = [
+    ('area_identificada', lambda area: st.markdown(
+        f'<div style="text-align: center; padding: 1rem 0;"><span class="focus-badge">{_esc(area)}</span></div>',
+        unsafe_allow_html=True)),
+    ('titulo', lambda titulo: st.markdown(f'<h1 class="strategy-header">{_esc(titulo)}</h1>', unsafe_allow_html=True)),
+    ('kpis_relevantes', lambda kpis: st.markdown(
+        "### 📈 KPIs Relevantes\n\n" + "".join(f'<span class="kpi-badge">{_esc(k)}</span>' for k in kpis),
+        unsafe_allow_html=True) if isinstance(kpis, list) else None),
+    ('analise_dos_dados', lambda analise: st.markdown(
+        f'### 🧠 Análise Chain of Thought\n\n<div class="analysis-section">{_esc(analise)}</div>', unsafe_allow_html=True)),
+    ('resumo', lambda resumo: st.markdown(
+        f'### 📋 Resumo Executivo\n\n<div class="strategy-card">{_esc(resumo)}</div>', unsafe_allow_html=True)),
+    ('modelagem_matematica', lambda modelagem: st.code(modelagem, language='text') if modelagem else None),
+    ('componentes', _render_progressive_tree),
+    ('checklist_implementacao', lambda itens: render_checklist(itens) if isinstance(itens, list) else None),
+    ('riscos_mitigacoes', lambda riscos: render_risks(riscos) if isinstance(riscos, list) else None),
+]
+
+
+def reset_consulta() -> None:
+    """Volta para a fase 1 descartando a estratégia, o job e o chat"""
+    if st.session_state.chat_cancel is not None:
+        st.session_state.chat_cancel.set()
+    st.session_state.fase = 1
+    st.session_state.strategy_response = None
+    st.session_state.job_id = None
+    st.query_params.pop("job", None)
+    st.session_state.audio_transcription = ''
+    st.session_state.chat_messages = []
+    st.session_state.chat_context = ''
+    st.session_state.pop('arvore_expandidos', None)
+    st.session_state.pop('excel_total_linhas', None)
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_job_progress() -> None:
+    """Acompanha o job da estratégia: mostra as seções já prontas e, ao concluir, promove o resultado"""
+    fila = StrategyJobQueue.shared()
+    job = fila.get(st.session_state.job_id)
+    if job is None:
+        st.warning("⚠️ Esta análise não está mais disponível (expirou ou o servidor reiniciou).")
+        if st.button("⬅️ Nova Consulta", key="job_missing_back"):
+            reset_consulta()
+            st.rerun()
+        return
+
+    if job.done:
+        response = job.resultado
+        st.session_state.ctx = job.pipeline.contexto
+        st.session_state.market_data = job.pipeline.mercado
+        st.session_state.kb_content = job.pipeline.kb
+        if response.get('error'):
+            st.error(f"❌ {response.get('message')}")
+            if st.button("⬅️ Nova Consulta", key="job_error_back"):
+                reset_consulta()
+                st.rerun()
+            return
+        st.session_state.strategy_response = response
+        st.rerun()
+        return
+
+    if job.status == 'na_fila':
+        st.info(f"⏳ Na fila: {fila.position(job)} análise(s) à frente da sua.")
+    else:
+        st.info("🧠 Analisando seu desafio... as seções aparecem assim que ficam prontas.")
+    stats = fila.stats()
+    st.caption(f"Fila: {stats['fila']} aguardando · {stats['executando']}/{stats['limite']} em execução")
+    for aviso in job.avisos:
+        st.warning(f"⚠️ {aviso}")
+    campos = job.campos
+    for campo, renderer in _PROGRESSIVE_SECTIONS:
+        if campo in campos:
+            renderer(campos[campo])
 
 
 def render_phase_2():
     response = st.session_state.strategy_response
+    if not response and st.session_state.job_id:
+        render_job_progress()
+        return
     if not response:
         st.session_state.fase = 1
         st.rerun()
         return
     
-    st.markdown(f'''<div style="text-align: center; padding: 1rem 0;">
-        <span class="focus-badge">{response.get('area_identificada', 'Finanças')}</span>
-    </div>
-    <h1 class="strategy-header">{response.get('titulo', 'Estratégia Financeira')}</h1>''', unsafe_allow_html=True)
+    blocos = strategy_html(response_key(response), response)
+    st.markdown(blocos['cabecalho'], unsafe_allow_html=True)
+    if response.get('cache_hit'):
+        st.caption("⚡ Estratégia recuperada do cache para um desafio equivalente.")
+    tempos = response.get('tempos')
+    if tempos:
+        st.caption("⏱️ " + " · ".join(f"{etapa} {segundos:.1f}s" for etapa, segundos in tempos.items()))
+    
+    if response.get('parse_warning'):
+        st.warning(f"⚠️ Aviso de parsing: {response.get('parse_warning')}")
     
     if st.button("⬅️ Nova Consulta"):
-        st.session_state.fase = 1
-        st.session_state.strategy_response = None
-        st.session_state.audio_transcription = ''
-        st.session_state.chat_messages = []
-        st.session_state.chat_context = ''
+        reset_consulta()
         st.rerun()
     
     st.markdown('<div class="custom-divider"></div>', unsafe_allow_html=True)
@@ -857,23 +3886,8 @@ def render_phase_2():
     col_video, col_excel = st.columns(2)
     
     with col_video:
-        video = response.get('video_sugestao', {})
-        if isinstance(video, dict):
-            termo = video.get('termo_busca', 'análise financeira')
-            titulo = video.get('titulo', 'Vídeo Recomendado')
-            motivo = video.get('motivo', 'Aprofunde-se neste tema')
-            
-            encoded_term = urllib.parse.quote(termo)
-            video_url = f"https://www.youtube.com/results?search_query={encoded_term}"
-            
-            st.markdown(f'''<div class="video-card">
-                <h4>🎬 Vídeo Recomendado</h4>
-                <p class="video-title">{titulo}</p>
-                <p class="video-desc">{motivo}</p>
-                <a href="{video_url}" target="_blank">
-                    🔍 Pesquisar "{termo}" no YouTube
-                </a>
-            </div>''', unsafe_allow_html=True)
+        if blocos.get('video'):
+            st.markdown(blocos['video'], unsafe_allow_html=True)
 
     with col_excel:
         template = response.get('template_sugerido', {})
@@ -881,16 +3895,25 @@ def render_phase_2():
             nome_template = template.get('nome', 'Template Financeiro')
             st.markdown(f'''<div class="download-section">
                 <h4>📥 Template Excel</h4>
-                <p>{nome_template}</p>
+                <p>{_esc(nome_template)}</p>
             </div>''', unsafe_allow_html=True)
             
             try:
-                excel_data = ExcelTemplateGenerator.generate_template(template)
+                # O arquivo só é montado no clique (ou lido do cache): reruns do chat não pagam a geração
+                taxa_anual = ((response.get('financeiro') or {}).get('taxas') or {}).get('selic')
+                exemplos = template.get('linhas_exemplo')
+                total_linhas = int(st.number_input(
+                    "Linhas da projeção", min_value=1, max_value=EXCEL_MAX_ROWS,
+                    value=min((len(exemplos) if isinstance(exemplos, list) else 0) + EXCEL_BLANK_ROWS, EXCEL_MAX_ROWS),
+                    step=12, key='excel_total_linhas',
+                    help="Linhas já ligadas ao modelo (fluxo, VPL, TIR) para preencher no Excel"))
+                excel_data = download_data(
+                    lambda: ExcelTemplateGenerator.workbook_bytes(template, taxa_anual, total_linhas))
                 st.download_button(
                     "⬇️ Baixar Template", 
                     excel_data, 
                     f"FinMentor_{nome_template.replace(' ', '_')}.xlsx", 
-                    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", 
+                    EXCEL_MIME, 
                     use_container_width=True
                 )
             except Exception as e:
@@ -902,60 +3925,59 @@ def render_phase_2():
     col1, col2 = st.columns(2)
     with col1:
         st.markdown("### 📈 KPIs Relevantes")
-        kpis = response.get('kpis_relevantes', [])
-        if kpis:
-            st.markdown("".join([f'<span class="kpi-badge">{k}</span>' for k in kpis]), unsafe_allow_html=True)
+        if blocos['kpis']:
+            st.markdown(blocos['kpis'], unsafe_allow_html=True)
     
     with col2:
         st.markdown("### 📚 Frameworks")
-        frameworks = response.get('frameworks_utilizados', [])
-        if frameworks:
-            st.markdown("".join([f'<span class="focus-badge">{f}</span>' for f in frameworks]), unsafe_allow_html=True)
+        if blocos['frameworks']:
+            st.markdown(blocos['frameworks'], unsafe_allow_html=True)
     
     st.markdown('<div class="custom-divider"></div>', unsafe_allow_html=True)
     
     # Análise
     st.markdown("### 🧠 Análise Chain of Thought")
-    analise = response.get('analise_dos_dados', 'Análise não disponível')
-    st.markdown(f'<div class="analysis-section">{analise}</div>', unsafe_allow_html=True)
+    st.markdown(blocos['analise'], unsafe_allow_html=True)
     
     # Resumo
     st.markdown("### 📋 Resumo Executivo")
-    resumo = response.get('resumo', 'Resumo não disponível')
-    st.markdown(f'<div class="strategy-card">{resumo}</div>', unsafe_allow_html=True)
+    st.markdown(blocos['resumo'], unsafe_allow_html=True)
     
     # Modelagem (se existir)
     if response.get('modelagem_matematica'):
         st.markdown("### 📐 Modelagem Matemática")
         st.code(response['modelagem_matematica'], language='text')
     
+    # Cálculos locais (planilha + mercado), independentes do modelo
+    if response.get('financeiro'):
+        st.markdown("### 🧮 Cálculos Financeiros")
+        render_financials(response['financeiro'])
+    
     st.markdown('<div class="custom-divider"></div>', unsafe_allow_html=True)
     
     # Árvore de Decisão
     st.markdown("### 🌳 Árvore de Decisão")
     componentes = response.get('componentes', {})
     if isinstance(componentes, dict) and componentes:
-        pergunta_raiz = componentes.get('pergunta_raiz', 'Qual a decisão?')
-        st.markdown(f'<div class="tree-node-root"><strong>❓ {pergunta_raiz}</strong></div>', unsafe_allow_html=True)
-        
-        for filho in componentes.get('filhos', []):
-            render_tree_node(filho, level=1)
+        render_tree_diagram(componentes, blocos['arvore'])
+    
+    if response.get('simulacao'):
+        st.markdown("#### 🎲 Simulação dos Ramos")
+        render_simulation(response['simulacao'])
     
     st.markdown('<div class="custom-divider"></div>', unsafe_allow_html=True)
     
     # Checklist
-    checklist = response.get('checklist_implementacao', [])
-    if checklist:
+    if blocos['checklist']:
         st.markdown("### ✅ Checklist de Implementação")
-        render_checklist(checklist)
+        st.markdown(blocos['checklist'], unsafe_allow_html=True)
     
     st.markdown('<div class="custom-divider"></div>', unsafe_allow_html=True)
     
     # Riscos
-    riscos = response.get('riscos_mitigacoes', [])
-    if riscos:
+    if blocos['riscos']:
         st.markdown("### ⚠️ Riscos e Mitigações")
-        render_risks(riscos)
+        st.markdown(blocos['riscos'], unsafe_allow_html=True)
 
     st.markdown('<div class="custom-divider"></div>', unsafe_allow_html=True)
     
@@ -972,6 +3994,36 @@ KPIs relevantes: {', '.join(response.get('kpis_relevantes', []))}
 Resumo: {response.get('resumo', '')}
 """
     
+    render_chat()
+
+
+@st.fragment
+def render_tree_diagram(componentes: Dict, texto_html: str):
+    """Diagrama Graphviz com ramos recolhíveis; expandir um ramo reexecuta só este fragmento"""
+    ramos = TreeDiagram.branches(componentes)
+    expandidos = st.multiselect(
+        "Expandir ramos", [caminho for caminho, _ in ramos], format_func=dict(ramos).get,
+        key="arvore_expandidos", placeholder="Ramos recolhidos..."
+    ) if ramos else []
+    dot = TreeDiagram.to_dot(componentes, frozenset(expandidos))
+    futuro = TreeDiagram.shared().svg(dot)
+    futures_wait([futuro], timeout=GRAPH_WAIT_SECONDS)
+    if not futuro.done():
+        st.caption("⏳ Diagrama ainda em montagem; exibindo a versão em texto.")
+        st.markdown(texto_html, unsafe_allow_html=True)
+        return
+    if futuro.exception() is None:
+        st.markdown(f'<div style="text-align: center;">{futuro.result()}</div>', unsafe_allow_html=True)
+    else:
+        # Sem o binário `dot` no servidor: o layout fica por conta do navegador
+        st.graphviz_chart(dot, use_container_width=True)
+    with st.expander("📝 Versão em texto"):
+        st.markdown(texto_html, unsafe_allow_html=True)
+
+
+@st.fragment
+def render_chat():
+    """Chat de follow-up isolado: cada pergunta reexecuta só este fragmento, não a página da estratégia"""
     for msg in st.session_state.chat_messages:
         with st.chat_message(msg["role"]):
             st.markdown(msg["content"])
@@ -982,17 +4034,19 @@ Resumo: {response.get('resumo', '')}
             st.markdown(user_input)
         
         with st.chat_message("assistant"):
-            with st.spinner("Processando..."):
-                response_text = LLMClient.chat_followup(
-                    user_message=user_input,
-                    chat_history=st.session_state.chat_messages,
-                    main_context=st.session_state.chat_context,
-                    kb=st.session_state.kb_content,
-                    api_key=st.session_state.anthropic_key
-                )
-                st.markdown(response_text)
-                st.session_state.chat_messages.append({"role": "assistant", "content": response_text})
-        st.rerun()
+            # Um evento por resposta: "Nova Consulta" sinaliza e o streaming é encerrado
+            st.session_state.chat_cancel = threading.Event()
+            response_text = st.write_stream(LLMClient.chat_followup_stream(
+                user_message=user_input,
+                chat_history=st.session_state.chat_messages,
+                main_context=st.session_state.chat_context,
+                kb=st.session_state.kb_content,
+                api_key=st.session_state.anthropic_key,
+                cancel=st.session_state.chat_cancel
+            ))
+            if not st.session_state.chat_cancel.is_set():
+                st.session_state.chat_messages.append({"role": "assistant", "content": str(response_text).strip()})
+        # A troca já está na tela e no histórico: sem st.rerun(), nada além do fragmento é reexecutado
 
 
 def get_file_icon(filename: str) -> str:
@@ -1006,10 +4060,63 @@ def get_file_icon(filename: str) -> str:
     return icons.get(ext, '📎')
 
 
+# ✅ MATERIAIS DE APOIO: catálogo montado uma vez por processo, arquivo lido só no clique
+MATERIALS_FOLDER = "materiais_download"
+MATERIALS_NAME_MAX = 25
+
+
+class MaterialsCatalog:
+    """Metadados dos materiais (nome, tamanho, mtime, ícone), sem carregar o conteúdo.
+
+    O catálogo só é refeito quando o mtime da pasta muda (arquivo adicionado, removido ou
+    renomeado); cada rerun custa um `stat`, independente de quantos arquivos existam.
+    """
+
+    def __init__(self, pasta: str):
+        self.pasta = pasta
+        self._lock = threading.Lock()
+        self._mtime: Optional[int] = None
+        self._itens: Tuple[Dict[str, Any], ...] = ()
+
+    @staticmethod
+    @st.cache_resource(show_spinner=False)
+    def shared() -> "MaterialsCatalog":
+        return MaterialsCatalog(MATERIALS_FOLDER)
+
+    @staticmethod
+    def _item(entry: Any) -> Dict[str, Any]:
+        info = entry.stat()
+        display_name = entry.name.rsplit('.', 1)[0].replace('_', ' ').replace('-', ' ')
+        if len(display_name) > MATERIALS_NAME_MAX:
+            display_name = display_name[:MATERIALS_NAME_MAX - 3] + "..."
+        return {
+            'arquivo': entry.name, 'caminho': entry.path, 'tamanho': info.st_size,
+            'mtime': info.st_mtime, 'icone': get_file_icon(entry.name), 'nome': display_name,
+        }
+
+    def items(self) -> Optional[Tuple[Dict[str, Any], ...]]:
+        """Materiais em ordem alfabética; None quando a pasta não existe"""
+        try:
+            mtime = os.stat(self.pasta).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            if mtime != self._mtime:
+                with os.scandir(self.pasta) as entradas:
+                    itens = [self._item(e) for e in entradas if not e.name.startswith('.') and e.is_file()]
+                self._itens = tuple(sorted(itens, key=lambda i: i['arquivo']))
+                self._mtime = mtime
+            return self._itens
+
+    @staticmethod
+    def read(caminho: str) -> bytes:
+        with open(caminho, 'rb') as f:
+            return f.read()
+
+
 def main():
     with st.sidebar:
-        avatar_base64 = get_image_base64(AVATAR_PATH) if os.path.exists(AVATAR_PATH) else ""
-        avatar_src = f"data:image/jpeg;base64,{avatar_base64}" if avatar_base64 else "https://ui-avatars.com/api/?name=Marco+Duarte&background=667eea&color=fff&size=200&font-size=0.35"
+        avatar_src = StaticAssets.build()['avatar_src']
         
         st.markdown(f'''<div class="avatar-container">
             <img src="{avatar_src}" class="avatar-image" alt="Marco A. Duarte Jr.">
@@ -1028,37 +4135,47 @@ def main():
         
         st.markdown("---")
         
+        # Garante o refresher de mercado do processo; a primeira busca roda em background
+        market = MarketDataService.shared()
         if st.session_state.market_data is None:
-            st.session_state.market_data = MarketDataFetcher.get_market_data()
+            st.session_state.market_data = market.latest().as_dict()
         
         with st.expander("📚 Materiais de Apoio", expanded=False):
-            materials_folder = "materiais_download"
-            if os.path.exists(materials_folder):
-                files = [f for f in os.listdir(materials_folder) if not f.startswith('.')]
-                if files:
-                    for filename in sorted(files):
-                        filepath = os.path.join(materials_folder, filename)
-                        icon = get_file_icon(filename)
-                        display_name = filename.rsplit('.', 1)[0].replace('_', ' ').replace('-', ' ')
-                        if len(display_name) > 25:
-                            display_name = display_name[:22] + "..."
+            materiais = MaterialsCatalog.shared().items()
+            if materiais is not None:
+                if materiais:
+                    for item in materiais:
+                        # O conteúdo só sai do disco quando o usuário clica (sem bytes por rerun/sessão)
                         try:
-                            with open(filepath, 'rb') as f:
-                                st.download_button(
-                                    label=f"{icon} {display_name}",
-                                    data=f.read(),
-                                    file_name=filename,
-                                    mime="application/octet-stream",
-                                    key=f"sidebar_dl_{filename}",
-                                    use_container_width=True
-                                )
-                        except:
-                            pass
+                            st.download_button(
+                                label=f"{item['icone']} {item['nome']}",
+                                data=download_data(lambda caminho=item['caminho']: MaterialsCatalog.read(caminho)),
+                                file_name=item['arquivo'],
+                                mime="application/octet-stream",
+                                key=f"sidebar_dl_{item['arquivo']}",
+                                help=f"{item['tamanho'] / 1024 / 1024:.1f} MB".replace('.', ','),
+                                use_container_width=True
+                            )
+                        except (OSError, RuntimeError, StreamlitAPIException) as e:
+                            # Um material com problema não derruba a página inteira
+                            st.caption(f"⚠️ {item['arquivo']} indisponível: {e}")
                 else:
                     st.caption("Nenhum material disponível.")
             else:
                 st.caption("📁 Adicione arquivos na pasta `materiais_download`")
     
+    # Um refresh abre outra sessão: o job é recuperado pelo id na URL, mas só com a mesma chave
+    # que o enviou (o link sozinho não dá acesso ao desafio e à planilha de outra pessoa)
+    job_id = st.query_params.get("job")
+    if job_id and st.session_state.job_id is None:
+        job = StrategyJobQueue.shared().get(job_id)
+        ant_key = st.session_state.anthropic_key or configured_api_keys()[0]
+        if job is not None and ant_key and StrategyJobQueue.key_hash(ant_key) == job.key_hash:
+            # A sessão nova não passou pela fase 1: a chave precisa estar pronta para o chat
+            st.session_state.anthropic_key = ant_key
+            st.session_state.job_id = job_id
+            st.session_state.fase = 2
+    
     if st.session_state.fase == 1:
         render_phase_1()
     else:
@@ -0,0 +1,116 @@
+"""
+Micro-benchmark do reparo de JSON
+=================================
+Compara o caminho antigo de `_extract_json_from_response` (regex + find/rfind +
+laço caractere a caractere) com `JSONRepair.parse` sobre um corpus de saídas
+malformadas do modelo (`malformed_outputs.jsonl`: cercas markdown, texto extra,
+quebras de linha em strings, vírgulas finais, escapes inválidos e respostas
+cortadas por max_tokens).
+
+Uso (a partir da raiz do projeto):
+    python benchmarks/json_repair_benchmark.py [repeticoes]
+"""
+
+import json
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import JSONRepair  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "malformed_outputs.jsonl")
+
+
+def legacy_extract(text: str):
+    """Cópia fiel do caminho anterior, mantida só como base de comparação"""
+    text = re.sub(r'```json\s*', '', text)
+    text = re.sub(r'```\s*', '', text)
+    text = text.strip()
+    start_idx = text.find('{')
+    end_idx = text.rfind('}')
+    if start_idx == -1 or end_idx == -1 or end_idx <= start_idx:
+        raise ValueError("Não foi possível encontrar JSON válido na resposta")
+    json_str = text[start_idx:end_idx + 1]
+    try:
+        return json.loads(json_str)
+    except json.JSONDecodeError:
+        pass
+    json_str = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', json_str)
+    in_string = False
+    result = []
+    i = 0
+    while i < len(json_str):
+        char = json_str[i]
+        if char == '"' and (i == 0 or json_str[i - 1] != '\\'):
+            in_string = not in_string
+            result.append(char)
+        elif in_string and char in '\n\r':
+            result.append(' ')
+        else:
+            result.append(char)
+        i += 1
+    json_str = ''.join(result)
+    try:
+        return json.loads(json_str)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"JSON inválido após correções: {str(e)}")
+
+
+def repair_extract(text: str):
+    return JSONRepair.parse(text)[0]
+
+
+def run(label, func, samples, repeticoes):
+    ok = 0
+    for sample in samples:
+        try:
+            func(sample["texto"])
+            ok += 1
+        except ValueError:
+            pass
+    segundos = timeit.timeit(
+        lambda: [_safe(func, s["texto"]) for s in samples], number=repeticoes
+    )
+    por_doc = segundos / (repeticoes * len(samples)) * 1e6
+    print(f"{label:<16} recuperados {ok:>2}/{len(samples)}   {por_doc:8.1f} µs/documento")
+    return ok, por_doc
+
+
+def _safe(func, text):
+    try:
+        return func(text)
+    except ValueError:
+        return None
+
+
+def main():
+    repeticoes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with open(CORPUS, encoding="utf-8") as f:
+        samples = [json.loads(line) for line in f if line.strip()]
+
+    print(f"Corpus: {len(samples)} saídas, {repeticoes} repetições\n")
+    run("legado", legacy_extract, samples, repeticoes)
+    run("JSONRepair", repair_extract, samples, repeticoes)
+
+    # Mesma base de comparação: só as saídas que o caminho antigo também recupera
+    comuns = [s for s in samples if _safe(legacy_extract, s["texto"]) is not None]
+    print(f"\nSomente as {len(comuns)} saídas recuperadas pelos dois:")
+    run("legado", legacy_extract, comuns, repeticoes)
+    run("JSONRepair", repair_extract, comuns, repeticoes)
+
+    print("\nPor amostra (legado / JSONRepair, reparos aplicados):")
+    for sample in samples:
+        antigo = "ok " if _safe(legacy_extract, sample["texto"]) is not None else "falha"
+        try:
+            _, reparos = JSONRepair.parse(sample["texto"])
+            novo = "ok "
+        except ValueError:
+            novo, reparos = "falha", []
+        print(f"  {sample['tipo']:<28} {antigo:<5} / {novo:<5} {', '.join(sorted(set(reparos)))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+"""
+Testes do FinMentor
+===================
+Cobrem as partes puras do app (parsers, motor financeiro, perfil de planilhas, cache e Excel),
+sem Streamlit em execução nem chamadas às APIs. O `app.py` é importado em modo "bare".
+
+Uso (a partir da raiz do projeto):
+    python -m pytest -q
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,78 @@
+from io import BytesIO
+
+import openpyxl
+import pytest
+
+import app
+from app import ExcelTemplateGenerator
+
+TEMPLATE = {
+    'nome': 'Fluxo',
+    'colunas': ['Mês', 'Receitas', 'Custos', 'Nota', 'Ano'],
+    'linhas_exemplo': [
+        {'Mês': 'Jan', 'Receitas': 'R$ 1.000,00', 'Custos': '=B4*2', 'Nota': '=HYPERLINK("http://x")', 'Ano': 2024},
+        {'Mês': 'Fev', 'Receitas': '1200', 'Custos': '400', 'Nota': 'http://exemplo.com'},
+    ],
+    'formulas_sugeridas': ['=SOMA(B2:B13)', '=SE(B2>0;B2*0,1;0)'],
+}
+
+
+def _abrir(template, **kwargs):
+    dados = ExcelTemplateGenerator.generate_template(template, 0.12, **kwargs).getvalue()
+    return openpyxl.load_workbook(BytesIO(dados)), openpyxl.load_workbook(BytesIO(dados), data_only=True)
+
+
+def test_model_text_is_never_written_as_a_formula():
+    wb, _ = _abrir(TEMPLATE)
+    dados = wb['Dados']
+    assert dados['A2'].value == 'Jan' and dados['A2'].data_type == 's'
+    assert dados['D2'].value == '=HYPERLINK("http://x")' and dados['D2'].data_type == 's'
+    assert dados['D3'].value == 'http://exemplo.com' and dados['D3'].data_type == 's'
+    assert dados['D3'].hyperlink is None
+    # Texto em coluna de valor fica em branco: soma como 0, igual ao valor pré-calculado
+    assert dados['C2'].value is None
+    assert dados['B2'].value == 1000 and dados['E2'].value == 2024
+
+
+def test_computed_columns_are_live_formulas_with_cached_values():
+    wb, valores = _abrir(TEMPLATE)
+    cabecalho = [c.value for c in wb['Dados'][1]]
+    assert cabecalho == ['Mês', 'Receitas', 'Custos', 'Nota', 'Ano', 'Fluxo de Caixa', 'Fluxo Acumulado']
+    assert wb['Dados']['F3'].value == '=B3-C3'
+    assert wb['Dados']['G3'].value == '=G2+F3'
+    assert [valores['Dados'][f'G{i}'].value for i in (2, 3)] == [1000, 1800]
+
+
+@pytest.mark.parametrize("total_linhas", [None, 40, app.EXCEL_CONSTANT_MEMORY_ROWS + 10])
+def test_row_count_follows_total_linhas(total_linhas):
+    wb, _ = _abrir(TEMPLATE, total_linhas=total_linhas)
+    esperado = max(total_linhas or 0, len(TEMPLATE['linhas_exemplo']) + app.EXCEL_BLANK_ROWS)
+    dados = wb['Dados']
+    assert dados.max_row == esperado + 1
+    assert dados.cell(esperado + 1, 7).value == f"=G{esperado}+F{esperado + 1}"
+    assert wb.defined_names['Fluxo_caixa'].attr_text == f"Dados!$F$2:$F${esperado + 1}"
+
+
+def test_computed_columns_do_not_clash_with_template_columns():
+    template = {'colunas': ['Mês', 'Receitas', 'Custos', 'Fluxo de Caixa', 'Custos'],
+                'linhas_exemplo': [{'Mês': 'Jan', 'Receitas': '100', 'Custos': '30', 'Fluxo de Caixa': '70'}]}
+    wb, _ = _abrir(template)
+    cabecalho = [c.value for c in wb['Dados'][1]]
+    assert cabecalho == ['Mês', 'Receitas', 'Custos', 'Fluxo de Caixa',
+                         'Fluxo de Caixa (calculado)', 'Fluxo Acumulado']
+    assert wb.defined_names['Dados_Fluxo_de_Caixa'].attr_text.startswith("Dados!$D$2:")
+    assert wb.defined_names['Fluxo_caixa'].attr_text.startswith("Dados!$E$2:")
+
+
+def test_suggested_formulas_get_the_english_syntax():
+    wb, _ = _abrir(TEMPLATE)
+    linhas = [[c.value for c in linha] for linha in wb['Fórmulas'].iter_rows(min_row=2)]
+    assert linhas == [['=SOMA(B2:B13)', '=SUM(B2:B13)'], ['=SE(B2>0;B2*0,1;0)', '=IF(B2>0,B2*0.1,0)']]
+
+
+def test_failed_build_falls_back_to_an_error_sheet(monkeypatch):
+    def falha(*args):
+        raise RuntimeError("modelo quebrado")
+    monkeypatch.setattr(ExcelTemplateGenerator, '_write_model', staticmethod(falha))
+    wb, _ = _abrir(TEMPLATE, total_linhas=app.EXCEL_CONSTANT_MEMORY_ROWS + 10)
+    assert [wb.active['A1'].value, wb.active['A2'].value] == ['Erro', 'modelo quebrado']
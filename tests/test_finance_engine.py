@@ -0,0 +1,84 @@
+import math
+
+import numpy as np
+import pytest
+
+from app import FinanceEngine
+
+FLUXO = [-100.0, 60.0, 60.0]
+
+
+def test_npv_discounts_the_first_flow_at_t0():
+    esperado = -100 + 60 / 1.1 + 60 / 1.1 ** 2
+    assert FinanceEngine.npv(0.10, FLUXO)[0] == pytest.approx(esperado)
+
+
+def test_npv_evaluates_many_rates_at_once():
+    taxas = np.array([0.0, 0.10, 0.20])
+    vpls = FinanceEngine.npv(taxas, np.repeat([FLUXO], 3, axis=0))
+    assert vpls == pytest.approx([20.0, -100 + 60 / 1.1 + 60 / 1.21, -100 + 60 / 1.2 + 60 / 1.44])
+
+
+def test_irr_matches_the_closed_form():
+    # -100 + 60x + 60x² = 0, com x = 1 / (1 + r)
+    x = (-60 + math.sqrt(60 ** 2 + 4 * 60 * 100)) / (2 * 60)
+    assert FinanceEngine.irr(FLUXO)[0] == pytest.approx(1 / x - 1, abs=1e-6)
+
+
+def test_irr_is_nan_without_a_sign_change():
+    assert math.isnan(FinanceEngine.irr([10.0, 20.0])[0])
+
+
+def test_mirr():
+    # VF das entradas a 10%: 60·1,1 + 60 = 126; VP das saídas: 100; 2 períodos
+    assert FinanceEngine.mirr(FLUXO, 0.10, 0.10)[0] == pytest.approx(1.26 ** 0.5 - 1)
+
+
+def test_payback_interpolates_within_the_period():
+    assert FinanceEngine.payback(FLUXO)[0] == pytest.approx(1 + 40 / 60)
+
+
+def test_discounted_payback():
+    # acumulado descontado: -100, -45,45, +4,13 → 1 + (50/1,1) / (60/1,21)
+    assert FinanceEngine.payback(FLUXO, 0.10)[0] == pytest.approx(1 + 50 * 1.1 / 60)
+
+
+@pytest.mark.parametrize("fluxo", [[10.0, 20.0], [-100.0, 10.0, 10.0]])
+def test_payback_is_nan_without_investment_or_recovery(fluxo):
+    assert math.isnan(FinanceEngine.payback(fluxo)[0])
+
+
+def test_dcf_uses_the_same_period_convention_as_npv():
+    fluxo = [-100.0, 50.0, 60.0]
+    dcf = FinanceEngine.dcf(fluxo, 0.10, 0.0)
+    assert dcf['vp_fluxos'] == pytest.approx(FinanceEngine.npv(0.10, fluxo)[0])
+    # Gordon sobre o último fluxo (t = 2): 60 / 0,10, trazido dois períodos
+    assert dcf['vp_terminal'] == pytest.approx(600 / 1.21)
+    assert dcf['valor'] == pytest.approx(dcf['vp_fluxos'] + dcf['vp_terminal'])
+
+
+def test_analyze_reports_dcf_consistent_with_the_series():
+    perfil = {'linhas': 4, 'colunas': [], 'series': {'Fluxo de caixa': [-500, 200, 200, 200]}, 'rubricas': {}}
+    relatorio = FinanceEngine.analyze(perfil, {'selic': '10%'})
+    fluxo = relatorio['fluxos'][0]
+    assert fluxo['vpl'] == pytest.approx(FinanceEngine.npv(0.10, [-500, 200, 200, 200])[0])
+    assert fluxo['investimento_inicial'] is True
+    assert relatorio['dcf']['vp_fluxos'] == pytest.approx(
+        FinanceEngine.npv(relatorio['taxas']['wacc'], [-500, 200, 200, 200])[0])
+
+
+def test_summary_tells_missing_investment_apart_from_no_payback():
+    sem_investimento = {'linhas': 3, 'colunas': [], 'series': {'Fluxo de caixa': [100, 120, 130]}, 'rubricas': {}}
+    texto = FinanceEngine.summarize(FinanceEngine.analyze(sem_investimento, {'selic': '10%'}))
+    assert "payback n/a (sem investimento inicial)" in texto
+
+    sem_retorno = {'linhas': 3, 'colunas': [], 'series': {'Fluxo de caixa': [-500, 10, 10]}, 'rubricas': {}}
+    texto = FinanceEngine.summarize(FinanceEngine.analyze(sem_retorno, {'selic': '10%'}))
+    assert "payback não recupera no horizonte" in texto
+
+
+def test_trailing_zero_periods_do_not_change_npv_or_irr():
+    # Séries são completadas com zeros até o maior tamanho (e o Excel projeta linhas vazias)
+    longo = FLUXO + [0.0] * 3000
+    assert FinanceEngine.npv(-0.99, longo)[0] == pytest.approx(FinanceEngine.npv(-0.99, FLUXO)[0])
+    assert FinanceEngine.irr(longo)[0] == pytest.approx(FinanceEngine.irr(FLUXO)[0], abs=1e-6)
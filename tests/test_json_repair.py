@@ -0,0 +1,62 @@
+import json
+import os
+
+import pytest
+
+from app import JSONRepair
+
+CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "benchmarks", "malformed_outputs.jsonl")
+
+
+def test_valid_json_needs_no_repair():
+    assert JSONRepair.parse('{"a": 1, "b": [true, null]}') == ({"a": 1, "b": [True, None]}, [])
+
+
+def test_markdown_fence_is_stripped():
+    data, reparos = JSONRepair.parse('```json\n{"a": 1}\n```')
+    assert data == {"a": 1}
+    assert reparos == ["texto antes do JSON removido", "texto após o JSON removido"]
+
+
+def test_raw_newline_inside_string():
+    data, reparos = JSONRepair.parse('{"a": "x\ny"}')
+    assert data == {"a": "x\ny"}
+    assert "caractere de controle em string" in reparos
+
+
+def test_trailing_commas_are_removed():
+    data, reparos = JSONRepair.parse('{"a": [1, 2,], }')
+    assert data == {"a": [1, 2]}
+    assert reparos.count("vírgula final removida") == 2
+
+
+def test_invalid_escape_keeps_the_backslash():
+    data, _ = JSONRepair.parse('{"a": "c:\\pasta"}')
+    assert data == {"a": "c:\\pasta"}
+
+
+@pytest.mark.parametrize("texto, esperado", [
+    ('{"a": "abc', {"a": "abc"}),
+    ('{"a": {"b": [1, 2', {"a": {"b": [1, 2]}}),
+])
+def test_truncated_response_is_closed(texto, esperado):
+    data, reparos = JSONRepair.parse(texto)
+    assert data == esperado
+    assert any("resposta truncada" in r for r in reparos)
+
+
+def test_text_without_object_raises():
+    with pytest.raises(ValueError):
+        JSONRepair.parse("não há JSON aqui")
+
+
+def test_benchmark_corpus_always_yields_an_object():
+    with open(CORPUS, encoding="utf-8") as f:
+        casos = [json.loads(linha) for linha in f if linha.strip()]
+    assert casos
+    for caso in casos:
+        data, _ = JSONRepair.parse(caso["texto"])
+        assert isinstance(data, dict), caso["tipo"]
+        if caso["tipo"].startswith("valido") or caso["tipo"] == "cerca_markdown":
+            assert data["titulo"]
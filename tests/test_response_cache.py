@@ -0,0 +1,46 @@
+from app import StrategyResponseCache
+
+MERCADO = {'dolar': '5,01', 'ibov': '128.000', 'selic': '10,50%', 'ipca': '0,40%'}
+
+
+def _cache(tmp_path, **kwargs):
+    return StrategyResponseCache(path=str(tmp_path / 'respostas.sqlite'), **kwargs)
+
+
+def test_key_ignores_case_accents_and_punctuation(tmp_path):
+    cache = _cache(tmp_path)
+    assert (cache.key("Devo investir R$ 500k?", "CFO", MERCADO, "kb")
+            == cache.key("devo   INVESTIR r 500k", "CFO", MERCADO, "kb"))
+
+
+def test_key_covers_persona_variant_and_kb_excerpt(tmp_path):
+    cache = _cache(tmp_path)
+    base = cache.key("desafio", "CFO", MERCADO, "kb", "tool")
+    assert cache.key("desafio", "Analista", MERCADO, "kb", "tool") != base
+    assert cache.key("desafio", "CFO", MERCADO, "kb", "json") != base
+    assert cache.key("desafio", "CFO", MERCADO, "kb editada", "tool") != base
+
+
+def test_key_uses_coarse_market_buckets(tmp_path):
+    cache = _cache(tmp_path)
+    base = cache.key("desafio", "CFO", MERCADO)
+    # câmbio na mesma faixa de R$ 0,25 e IBOVESPA na mesma faixa de 5 mil pontos
+    assert cache.key("desafio", "CFO", {**MERCADO, 'dolar': '5,09', 'ibov': '129.500'}) == base
+    assert cache.key("desafio", "CFO", {**MERCADO, 'dolar': '5,20'}) != base
+    assert cache.key("desafio", "CFO", {**MERCADO, 'selic': '10,75%'}) != base
+
+
+def test_put_get_roundtrip_and_counters(tmp_path):
+    cache = _cache(tmp_path)
+    chave = cache.key("desafio", "CFO", MERCADO)
+    assert cache.get(chave) is None
+    cache.put(chave, {'titulo': 'Estratégia'})
+    assert cache.get(chave) == {'titulo': 'Estratégia'}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_entries_miss(tmp_path):
+    cache = _cache(tmp_path, ttl=-1)
+    chave = cache.key("desafio", "CFO", MERCADO)
+    cache.put(chave, {'titulo': 'Estratégia'})
+    assert cache.get(chave) is None
@@ -0,0 +1,47 @@
+from io import BytesIO
+
+import pandas as pd
+import pytest
+
+import app
+from app import SpreadsheetProfiler
+
+CSV_BR = ("Data;Receita;Custo;Cliente\n"
+          "01/01/2024;1.234,56;R$ 500,00;Alfa\n"
+          "01/02/2024;2.000,00;R$ 700,50;Beta\n"
+          "01/03/2024;3.100,10;R$ 650,00;Alfa\n")
+
+
+@pytest.mark.parametrize("dtype", [object, "string"])
+def test_brazilian_numbers_parse_for_object_and_string_dtypes(dtype):
+    # "string" é o que o pandas 3 infere para texto: dtype != object
+    serie = pd.Series(["1.234,56", "R$ 10,00", "15%", "abc"], dtype=dtype)
+    valores = SpreadsheetProfiler._as_number(serie)
+    assert valores[:3].tolist() == pytest.approx([1234.56, 10.0, 15.0])
+    assert pd.isna(valores[3])
+
+
+def test_numeric_series_is_left_alone():
+    assert SpreadsheetProfiler._as_number(pd.Series([1.5, 2.0])).tolist() == [1.5, 2.0]
+
+
+def test_csv_profile_types_and_totals():
+    perfil = SpreadsheetProfiler.profile('vendas.csv', CSV_BR.encode('utf-8'))
+    colunas = {c['nome']: c for c in perfil['colunas']}
+    assert perfil['linhas'] == 3
+    assert perfil['coluna_data'] == 'Data'
+    assert colunas['Receita']['tipo'] == 'numero'
+    assert colunas['Receita']['soma'] == pytest.approx(6334.66)
+    assert colunas['Custo']['soma'] == pytest.approx(1850.5)
+    assert colunas['Cliente']['tipo'] == 'texto'
+    assert perfil['parcial'] is False
+
+
+def test_legacy_excel_is_capped_and_marked_partial(monkeypatch):
+    monkeypatch.setattr(app, 'UPLOAD_XLS_MAX_ROWS', 30)
+    dados = BytesIO()
+    pd.DataFrame({'Valor': range(50)}).to_excel(dados, index=False)
+    perfil = SpreadsheetProfiler.profile('antigo.xls', dados.getvalue())
+    assert perfil['linhas'] == 30
+    assert perfil['parcial'] is True
+    assert "resumo parcial" in SpreadsheetProfiler.summarize(perfil)
@@ -0,0 +1,50 @@
+import json
+
+from app import IncrementalJSONParser, StrategySchema
+
+DOC = {
+    "titulo": "Expansão {fase 2}",
+    "kpis_relevantes": ["VPL", "TIR \"real\""],
+    "componentes": {"pergunta_raiz": "Investir?", "filhos": [{"condicao": "VPL > 0", "filhos": []}]},
+    "resumo": "linha 1\nlinha 2",
+}
+
+
+def _feed_all(texto, passo):
+    parser = IncrementalJSONParser()
+    emitidos = []
+    for i in range(0, len(texto), passo):
+        emitidos.extend(parser.feed(texto[i:i + passo]))
+    return parser, emitidos
+
+
+def test_fields_close_in_order_whatever_the_chunk_size():
+    texto = json.dumps(DOC, ensure_ascii=False)
+    for passo in (1, 7, len(texto)):
+        parser, emitidos = _feed_all(texto, passo)
+        assert emitidos == list(DOC.items())
+        assert parser.fields == DOC
+
+
+def test_field_is_emitted_as_soon_as_it_closes():
+    parser = IncrementalJSONParser()
+    assert parser.feed('{"titulo": "A", "resumo": "meio') == [("titulo", "A")]
+    assert parser.feed(' texto"}') == [("resumo", "meio texto")]
+
+
+def test_text_before_the_object_is_ignored():
+    _, emitidos = _feed_all('```json\n{"titulo": "A"}\n```', 3)
+    assert emitidos == [("titulo", "A")]
+
+
+def test_null_and_unreadable_values_are_still_emitted():
+    _, emitidos = _feed_all('{"titulo": null, "resumo": nada, "area_identificada": "X"}', 5)
+    assert emitidos == [("titulo", None), ("resumo", None), ("area_identificada", "X")]
+
+
+def test_schema_supplies_the_default_for_streamed_fields():
+    schema = StrategySchema.shared()
+    padrao = schema.normalize({})[0]["titulo"]
+    assert schema.normalize_field("titulo", None) == padrao
+    assert schema.normalize_field("kpis_relevantes", "VPL") == ["VPL"]
+    assert schema.normalize_field("campo_desconhecido", 42) == 42